@@ -8,7 +8,7 @@ import numpy as np
 
 import argparse
 from torch.utils.data import DataLoader
-from data_loader import BraTSAnnotationDataset, BraTSTrainDataset
+from data_loader import BraTSAnnotationDataset, BraTSTrainDataset, TRANSPORT_DTYPES, to_device
 import os
 import nibabel as nib
 
@@ -23,6 +23,14 @@ parser.add_argument('--output_dir', type=str, default=None,
 parser.add_argument('--data_dir', type=str,
     default='/shared/mrfil-data/cddunca2/brats2020/MICCAI_BraTS2020_ValidationData',
         help='Path to directory of datasets to annotate (default: Brats 2020)')
+parser.add_argument('--cache_dir', type=str, default=None,
+        help='Path to the decoded volume cache, see volume_cache.py (default: None)')
+parser.add_argument('--shm_store', type=str, default=None,
+        help='Name of a shared memory store of the decoded volumes, see shm_store.py (default: None)')
+parser.add_argument('--transport_dtype', type=str, default='float32', choices=TRANSPORT_DTYPES,
+        help='dtype images are loaded in before being moved to the device (default: float32)')
+parser.add_argument('--decode_threads', type=int, default=5, metavar='N',
+        help='decode the volumes of a case with N threads, 0 decodes them one by one (default: 5)')
 parser.add_argument('-c', '--checkpoint', type=int, default=None, metavar='N',
         help='Specify a specific checkpoint. The default behavior is to use the\
                 checkpoint with the largest epoch in its name.')
@@ -65,7 +73,9 @@ else:
     device = torch.device('cpu')
 
 brats_data = BraTSAnnotationDataset(args.data_dir, 
-        dims=dims, enhance_feat=args.enhance_feat)
+        dims=dims, enhance_feat=args.enhance_feat, cache_dir=args.cache_dir,
+        transport_dtype=args.transport_dtype, decode_threads=args.decode_threads,
+        shm_store=args.shm_store)
 dataloader = DataLoader(brats_data)
 
 for p, _, files in os.walk(f'{args.dir}/checkpoints/'):
@@ -121,7 +131,7 @@ model = model.to(device)
 with torch.no_grad():
     model.eval()
     for d in tqdm(dataloader):
-        src = d['data'].to(device, dtype=torch.float)
+        src = to_device(d['data'], device)
         output, _ = model(src)
         if args.model == 'CascadeNetLite':
             output = output['biline']
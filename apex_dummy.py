@@ -1,2 +0,0 @@
-def amp():
-    pass
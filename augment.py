@@ -0,0 +1,179 @@
+'''
+Batched data augmentation on the device.
+
+The datasets and batchgenerators augment one sample at a time in numpy,
+which is why rotation and elastic deformation are left out of
+bg_dataloader.get_train_transform. BatchAugmenter augments a whole batch
+with torch on whatever device it's on. Every spatial transform of a
+sample (mirroring, scaling, rotation and elastic deformation) is folded
+into one sampling grid, and the batch is resampled by a single
+grid_sample. The intensity transforms (shift and scale fields, gamma,
+noise and blur) are drawn per sample and applied to the whole batch at
+once. Each transform is applied to a sample with its own probability.
+'''
+import math
+
+import torch
+import torch.nn.functional as F
+
+
+def _rotation(angles):
+    ''' Rotation matrices (B x 3 x 3) for rotations by angles (B x 3)
+    about each of the three axes in turn.
+    '''
+    c, s = torch.cos(angles), torch.sin(angles)
+    one, zero = torch.ones_like(c[:, 0]), torch.zeros_like(c[:, 0])
+
+    def mat(rows):
+        return torch.stack([torch.stack(r, -1) for r in rows], -2)
+
+    rx = mat([[one, zero, zero], [zero, c[:, 0], -s[:, 0]], [zero, s[:, 0], c[:, 0]]])
+    ry = mat([[c[:, 1], zero, s[:, 1]], [zero, one, zero], [-s[:, 1], zero, c[:, 1]]])
+    rz = mat([[c[:, 2], -s[:, 2], zero], [s[:, 2], c[:, 2], zero], [zero, zero, one]])
+    return rz @ ry @ rx
+
+
+def _gaussian_blur(x, sigma):
+    ''' Blurs each channel of x (N x C x D x H x W) with its own sigma
+    (N x C) by separable grouped convolutions.
+    '''
+    n, c = x.shape[:2]
+    radius = max(int(math.ceil(3 * float(sigma.max()))), 1)
+    k = torch.arange(-radius, radius + 1, device=x.device, dtype=x.dtype)
+    kernel = torch.exp(-k**2 / (2 * sigma.reshape(-1, 1)**2))
+    kernel = (kernel / kernel.sum(1, keepdim=True)).reshape(n*c, 1, -1)
+
+    x = x.reshape(1, n*c, *x.shape[2:])
+    for axis in range(3):
+        shape = [n*c, 1, 1, 1, 1]
+        shape[2 + axis] = 2*radius + 1
+        padding = [0, 0, 0]
+        padding[axis] = radius
+        x = F.conv3d(x, kernel.reshape(shape), padding=padding, groups=n*c)
+    return x.reshape(n, c, *x.shape[2:])
+
+
+class BatchAugmenter(object):
+    ''' Augments a batch of images (B x C x H x W x D) and label maps
+    (B x H x W x D) on their device. p_* is the probability a transform
+    is applied to a sample, the tuples are the ranges its parameters are
+    drawn from. Angles are in degrees. elastic_alpha is the standard
+    deviation of the displacement of the elastic_grid^3 control points, in
+    units of half the patch size. The background stays zero.
+    '''
+    def __init__(self, p_mirror=0.5,
+            p_scale=0.2, scale=(0.9, 1.1),
+            p_rotate=0.2, angle=(-15., 15.),
+            p_elastic=0.1, elastic_alpha=0.03, elastic_grid=6,
+            p_shift_scale=1., shift=(-0.1, 0.1), intensity_scale=(0.9, 1.1),
+            p_gamma=0.15, gamma=(0.7, 1.5),
+            p_noise=0.15, noise_variance=(0., 0.1),
+            p_blur=0.1, blur_sigma=(0.5, 1.5)):
+        self.p_mirror = p_mirror
+        self.p_scale = p_scale
+        self.scale = scale
+        self.p_rotate = p_rotate
+        self.angle = angle
+        self.p_elastic = p_elastic
+        self.elastic_alpha = elastic_alpha
+        self.elastic_grid = elastic_grid
+        self.p_shift_scale = p_shift_scale
+        self.shift = shift
+        self.intensity_scale = intensity_scale
+        self.p_gamma = p_gamma
+        self.gamma = gamma
+        self.p_noise = p_noise
+        self.noise_variance = noise_variance
+        self.p_blur = p_blur
+        self.blur_sigma = blur_sigma
+
+    def __call__(self, img, seg=None):
+        img, seg = self.spatial(img, seg)
+        return self.intensity(img), seg
+
+    @staticmethod
+    def _draw(p, shape, device):
+        return torch.rand(shape, device=device) < p
+
+    @staticmethod
+    def _uniform(bounds, shape, device, dtype=torch.float):
+        return torch.empty(shape, device=device, dtype=dtype).uniform_(*bounds)
+
+    def spatial(self, img, seg=None):
+        b, dev = img.size(0), img.device
+        mirror = self._draw(self.p_mirror, (b, 3), dev)
+        scale = self._draw(self.p_scale, b, dev)
+        rotate = self._draw(self.p_rotate, b, dev)
+        elastic = self._draw(self.p_elastic, b, dev)
+
+        if not (scale | rotate | elastic).any():
+            # mirroring alone doesn't need resampling
+            for axis in range(3):
+                sel = mirror[:, axis]
+                if sel.any():
+                    img[sel] = img[sel].flip(2 + axis)
+                    if seg is not None:
+                        seg[sel] = seg[sel].flip(1 + axis)
+            return img, seg
+
+        # affine_grid's coordinates are ordered (W, H, D), the reverse of
+        # the tensor's axes, so mirror[:, 0] flips the last axis. which
+        # axis is which doesn't matter since each is flipped at random.
+        theta = torch.eye(3, device=dev).repeat(b, 1, 1)
+        s = torch.where(scale, self._uniform(self.scale, b, dev), torch.ones(b, device=dev))
+        theta = theta * s.view(-1, 1, 1)
+        angles = self._uniform(self.angle, (b, 3), dev) * math.pi / 180
+        theta = _rotation(angles * rotate.view(-1, 1)) @ theta
+        flips = torch.where(mirror, -torch.ones(b, 3, device=dev), torch.ones(b, 3, device=dev))
+        theta = theta * flips.view(b, 1, 3)
+
+        affine = torch.cat((theta, torch.zeros(b, 3, 1, device=dev)), 2)
+        grid = F.affine_grid(affine, img.shape, align_corners=False)
+        if elastic.any():
+            g = self.elastic_grid
+            coarse = torch.randn(b, 3, g, g, g, device=dev) * self.elastic_alpha
+            coarse = coarse * elastic.view(-1, 1, 1, 1, 1)
+            disp = F.interpolate(coarse, size=img.shape[2:], mode='trilinear', align_corners=False)
+            grid = grid + disp.permute(0, 2, 3, 4, 1)
+
+        grid = grid.to(img.dtype)
+        img = F.grid_sample(img, grid, mode='bilinear', padding_mode='zeros', align_corners=False)
+        if seg is not None:
+            seg = F.grid_sample(seg[:, None].to(img.dtype), grid, mode='nearest',
+                    padding_mode='zeros', align_corners=False)[:, 0].to(seg.dtype)
+        return img, seg
+
+    def intensity(self, img):
+        b, dev = img.size(0), img.device
+        brain = img != 0
+        field = (b, 1, *img.shape[2:])
+
+        sel = self._draw(self.p_shift_scale, b, dev).view(-1, 1, 1, 1, 1)
+        if sel.any():
+            # one field per sample, shared by the channels, as in
+            # BraTSDataset.standardize
+            shft = self._uniform(self.shift, field, dev, img.dtype)
+            scal = self._uniform(self.intensity_scale, field, dev, img.dtype)
+            img = torch.where(sel, (img + shft)*scal, img)
+
+        sel = self._draw(self.p_gamma, b, dev).view(-1, 1, 1, 1, 1)
+        if sel.any():
+            # on each channel rescaled to [0, 1] and back
+            lo = img.amin(dim=(2, 3, 4), keepdim=True)
+            span = (img.amax(dim=(2, 3, 4), keepdim=True) - lo).clamp_min(1e-8)
+            g = self._uniform(self.gamma, (b, img.size(1), 1, 1, 1), dev, img.dtype)
+            img = torch.where(sel, ((img - lo) / span).pow(g)*span + lo, img)
+
+        sel = self._draw(self.p_noise, b, dev).view(-1, 1, 1, 1, 1)
+        if sel.any():
+            std = self._uniform(self.noise_variance, (b, 1, 1, 1, 1), dev, img.dtype).sqrt()
+            img = torch.where(sel, img + torch.randn_like(img)*std, img)
+
+        sel = self._draw(self.p_blur, b, dev)
+        if sel.any():
+            idx = sel.nonzero()[:, 0]
+            sigma = self._uniform(self.blur_sigma, (len(idx), img.size(1)), dev, img.dtype)
+            img = img.clone()
+            img[idx] = _gaussian_blur(img[idx], sigma)
+
+        return img * brain
@@ -1,41 +1,72 @@
+import os
 from time import time
 import SimpleITK as sitk
 import numpy as np
 
-from batchgenerators.augmentations.crop_and_pad_augmentations import crop
 from batchgenerators.dataloading import MultiThreadedAugmenter, SingleThreadedAugmenter
 #from batchgenerators.examples.brats2018.config import brats_preprocessed_folder, num_threads_for_brats_example
 from batchgenerators.transforms import Compose
 from batchgenerators.utilities.data_splitting import get_split_deterministic
 from batchgenerators.utilities.file_and_folder_operations import *
 from batchgenerators.dataloading.data_loader import DataLoader
-from batchgenerators.augmentations.utils import pad_nd_image
 from batchgenerators.transforms.spatial_transforms import SpatialTransform_2, MirrorTransform
 from batchgenerators.transforms.color_transforms import BrightnessMultiplicativeTransform, GammaTransform
 from batchgenerators.transforms.noise_transforms import GaussianNoiseTransform, GaussianBlurTransform
 
+from volume_cache import CroppedVolume, nonzero_bbox
+from shm_store import SharedVolumeStore
+from patch_sampler import PatchSampler
+from patient_table import load_patient_table
+
 
 def get_list_of_patients(preprocessed_data_folder):
     npy_files = subfiles(preprocessed_data_folder, suffix=".npy", join=True)
-    # remove npy file extension
-    patients = [i[:-4] for i in npy_files]
+    # remove npy file extension. the segmentations of format 2 are stored next to the images
+    patients = [i[:-4] for i in npy_files if not i.endswith("_seg.npy")]
     return patients
 
 
 class BraTS2018DataLoader3D(DataLoader):
     def __init__(self, data, batch_size, patch_size, num_threads_in_multithreaded, seed_for_shuffle=1234,
-                 return_incomplete=False, shuffle=True, infinite=True):
+                 return_incomplete=False, shuffle=True, infinite=True, crop_type="random", shm_store=None,
+                 patches_per_case=1, shuffle_buffer=0, table=None):
         """
         data must be a list of patients as returned by get_list_of_patients (and split by get_split_deterministic)
 
         patch_size is the spatial size the retured batch will have
 
+        crop_type is one of patch_sampler.CROP_TYPES. The preprocessed volumes are already cropped to the
+        brain, so "bbox" constrains the patches by the bounding box of the tumor instead.
+
+        shm_store is the name of a shm_store.SharedVolumeStore holding the preprocessed .npy files. The
+        patients are then read from shared memory instead of from their memmaps.
+
+        table is the patient_table.PatientTable of the patients' folder, loaded here if not given. The metadata
+        and tumor bounding boxes come from it so no .pkl is read while batches are made.
+
+        Both preprocessed formats are read, see preprocessing.FORMAT_VERSION. Format 2 patients have float16
+        images and a separate uint8 segmentation, which is only read when there is one.
+
+        patches_per_case patches are cut from each patient that is loaded. They go into a buffer of at least
+        shuffle_buffer patches and the batches are drawn from it at random, so the patches of a patient are
+        spread over several batches.
+
         """
         super().__init__(data, batch_size, num_threads_in_multithreaded, seed_for_shuffle, 
                 return_incomplete, shuffle, infinite)
         self.patch_size = patch_size
+        # np.random like batchgenerators' crop, which MultiThreadedAugmenter seeds per worker
+        self.sampler = PatchSampler(patch_size, crop_type)
+        # loaded once and only read, so the workers MultiThreadedAugmenter forks share it
+        if table is None and len(data) > 0:
+            table = load_patient_table(os.path.dirname(data[0]))
+        self.table = table
+        self.store = SharedVolumeStore(shm_store) if shm_store else None
         self.num_modalities = 4
         self.indices = list(range(len(data)))
+        self.patches_per_case = patches_per_case
+        self.shuffle_buffer = shuffle_buffer
+        self._buffer = []
     
     @staticmethod
     def save_segmentation_as_nifti(segmentation, metadata, output_file):
@@ -57,12 +88,79 @@ class BraTS2018DataLoader3D(DataLoader):
 
     @staticmethod
     def load_patient(patient):
+        """
+        Returns the memmapped images of patient, with the segmentation stacked on for format 1, and its metadata.
+        """
         #data = np.load(patient + ".npy", mmap_mode="r+")
-        data = np.load(patient + ".npy", mmap_mode="r+")
+        data = np.load(patient + ".npy", mmap_mode="r")
         metadata = load_pickle(patient + ".pkl")
         return data, metadata
 
+    def _array(self, path):
+        if self.store is None:
+            return np.load(path, mmap_mode="r")
+        return self.store.load(path).data
+
+    def _load(self, j):
+        """
+        Returns the images of patient j and its segmentation, each as a 4d CroppedVolume, and its metadata. The
+        segmentation is None if the patient has none.
+        """
+        if self.table is not None and self.table.record(j) is not None:
+            patient_metadata = self.table.metadata(j)
+        else:
+            patient_metadata = load_pickle(j + ".pkl")
+        data = self._array(j + ".npy")
+        if patient_metadata.get("format_version", 1) < 2:
+            # the segmentation is the last channel of the float32 array
+            return CroppedVolume.from_array(data[:-1]), CroppedVolume.from_array(data[-1:]), patient_metadata
+        seg = None
+        if isfile(j + "_seg.npy"):
+            seg = CroppedVolume.from_array(self._array(j + "_seg.npy")[None])
+        return CroppedVolume.from_array(data), seg, patient_metadata
+
+    def _read_patches(self, j, outs):
+        """
+        Loads patient j once and reads a window into each (data, seg) pair of outs.
+        """
+        images, seg, patient_metadata = self._load(j)
+        # pick the window from the shape alone and read only that region of the memmap. anything
+        # past the edges of the volume is zero, so padding only happens where the window sticks out.
+        bbox = None
+        if self.sampler.crop_type == "bbox" and seg is not None:
+            if self.table is not None and self.table.record(j) is not None:
+                bbox = self.table.tumor_bbox(j)
+            else:
+                bbox = nonzero_bbox([seg.data[0]])
+        channels = images.shape[0]
+        for data, seg_out in outs:
+            start, stop = self.sampler.window(images.shape[1:], bbox)
+            # float16 images are upcast by the copy into the float32 batch
+            images.read([0, *start], [channels, *stop], out=data)
+            if seg is None:
+                seg_out[...] = 0
+            else:
+                seg.read([0, *start], [1, *stop], out=seg_out)
+        return patient_metadata
+
+    def _fill_buffer(self):
+        while len(self._buffer) < max(self.shuffle_buffer, self.batch_size):
+            try:
+                idx = self.get_indices()
+            except StopIteration:
+                return
+            for i in idx:
+                j = self._data[i]
+                outs = [(np.zeros((self.num_modalities, *self.patch_size), dtype=np.float32),
+                         np.zeros((1, *self.patch_size), dtype=np.float32))
+                        for _ in range(self.patches_per_case)]
+                patient_metadata = self._read_patches(j, outs)
+                self._buffer += [(d, s, patient_metadata, j) for d, s in outs]
+
     def generate_train_batch(self):
+        if self.patches_per_case > 1 or self.shuffle_buffer > 0:
+            return self._generate_buffered_batch()
+
         # DataLoader has its own methods for selecting what patients to use next, see its Documentation
         idx = self.get_indices()
         patients_for_batch = [self._data[i] for i in idx]
@@ -76,26 +174,26 @@ class BraTS2018DataLoader3D(DataLoader):
 
         # iterate over patients_for_batch and include them in the batch
         for i, j in enumerate(patients_for_batch):
-            patient_data, patient_metadata = self.load_patient(j)
-            # this will only pad patient_data if its shape is smaller than self.patch_size
-            patient_data = pad_nd_image(patient_data, self.patch_size)
-
-            # now random crop to self.patch_size
-            # crop expects the data to be (b, c, x, y, z) but patient_data is (c, x, y, z) so we need to add one
-            # dummy dimension in order for it to work (@Todo, could be improved)
-            patient_data, patient_seg = crop(patient_data[:-1][None], 
-                patient_data[-1:][None], 
-                self.patch_size, 
-                crop_type="random")
-            
-            seg[i] = patient_seg[0]
-            data[i] = patient_data[0]
-
-            metadata.append(patient_metadata)
+            metadata.append(self._read_patches(j, [(data[i], seg[i])]))
             patient_names.append(j)
 
         return {'data': data, 'seg':seg, 'metadata':metadata, 'names':patient_names}
 
+    def _generate_buffered_batch(self):
+        self._fill_buffer()
+        if not self._buffer:
+            raise StopIteration
+        # np.random, seeded per worker by MultiThreadedAugmenter
+        n = min(self.batch_size, len(self._buffer))
+        picked = []
+        for _ in range(n):
+            k = np.random.randint(len(self._buffer))
+            self._buffer[k], self._buffer[-1] = self._buffer[-1], self._buffer[k]
+            picked.append(self._buffer.pop())
+        data, seg, metadata, patient_names = zip(*picked)
+        return {'data': np.stack(data), 'seg': np.stack(seg),
+                'metadata': list(metadata), 'names': list(patient_names)}
+
 
 def get_train_transform(patch_size):
     # we now create a list of transforms. These are not necessarily the best transforms to use for BraTS, 
@@ -200,7 +298,8 @@ if __name__ == "__main__":
     # now we have some DataLoader. Let's go an get some augmentations
 
     # first let's collect all shapes, you will see why later
-    shapes = [BraTS2018DataLoader3D.load_patient(i)[0].shape[1:] for i in patients]
+    table = load_patient_table(brats_preprocessed_folder)
+    shapes = [table.shape(i)[1:] for i in patients]
     max_shape = np.max(shapes, 0)
     max_shape = np.max((max_shape, patch_size), 0)
 
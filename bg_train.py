@@ -22,8 +22,10 @@ from utils import (
 from torch.utils.data import DataLoader
 from scheduler import PolynomialLR
 import losses
+from augment import BatchAugmenter
 from models.models import *
 from bg_dataloader import *
+from patient_table import load_patient_table
 
 import time
 parser = argparse.ArgumentParser(description='Train glioma segmentation model.')
@@ -36,6 +38,9 @@ parser.add_argument('--dir', type=str, required=True, metavar='PATH',
 parser.add_argument('--data_dir', type=str, required=True, metavar='PATH TO DATA',
     help='Path to where the data is located.')
 
+parser.add_argument('--shm_store', type=str, default=None, metavar='NAME',
+    help='read the preprocessed data from this shared memory store, see shm_store.py (default: None)')
+
 parser.add_argument('--model', type=str, default=None, required=True, metavar='MODEL',
                         help='model name (default: None)')
 
@@ -80,6 +85,16 @@ parser.add_argument('--lr', type=float, default=1e-4, metavar='LR',
 parser.add_argument('--eclr', action='store_true', 
     help='step clr per epoch(default: off)')
 
+parser.add_argument('--batch_augment', action='store_true', 
+    help='train on random patches augmented on the device by augment.BatchAugmenter '
+    'instead of the batchgenerators transforms (default: off)')
+
+parser.add_argument('--patches_per_case', type=int, default=1, metavar='K', 
+    help='cut K training patches from each patient that is loaded (default: 1)')
+
+parser.add_argument('--shuffle_buffer', type=int, default=0, metavar='N', 
+    help='draw the training batches at random from a buffer of at least N patches (default: 0)')
+
 parser.add_argument('--single_threaded', action='store_true', 
     help='use single_threaded dataloader for debug (default: off)')
 
@@ -108,29 +123,41 @@ train = patients
 patch_size = (128, 128, 128)
 #patch_size = (160, 192, 128)
 batch_size = args.batch_size
-dataloader = BraTS2018DataLoader3D(train, batch_size, patch_size, 1)
-
-batch = next(dataloader)
-shapes = [BraTS2018DataLoader3D.load_patient(i)[0].shape[1:] for i in patients]
+# the metadata and shapes of every patient, shared by the loaders
+table = load_patient_table(brats_preprocessed_folder, num_workers=args.num_workers)
+shapes = [table.shape(i)[1:] for i in patients]
 max_shape = np.max(shapes, 0)
 max_shape = np.max((max_shape, patch_size), 0)
 
+# the batch augmenter works on the patches, the transforms crop them out of
+# max_shape after augmenting
 dataloader_train = BraTS2018DataLoader3D(
         train, 
         batch_size, 
-        max_shape, 
-        num_threads_for_brats_example
+        patch_size if args.batch_augment else max_shape, 
+        num_threads_for_brats_example,
+        shm_store=args.shm_store,
+        patches_per_case=args.patches_per_case,
+        shuffle_buffer=args.shuffle_buffer,
+        table=table
         )
 
 dataloader_validation = BraTS2018DataLoader3D(
         train, 
         batch_size, 
         patch_size, 
-        max(1, num_threads_for_brats_example // 2)
+        max(1, num_threads_for_brats_example // 2),
+        shm_store=args.shm_store,
+        table=table
         )
 
 
-tr_transforms = get_train_transform(patch_size)
+if args.batch_augment:
+    tr_transforms = None
+    augmenter = BatchAugmenter()
+else:
+    tr_transforms = get_train_transform(patch_size)
+    augmenter = None
 if args.single_threaded:
     tr_gen = SingleThreadedAugmenter(dataloader_train, tr_transforms)
     val_gen = SingleThreadedAugmenter(dataloader_validation, None)
@@ -174,7 +201,7 @@ for epoch in range(start_epoch, args.epochs):
     time_ep = time.time()
     model.train()
 
-    train_epoch(model, loss, optimizer, tr_gen, args.batches_per_epoch, device)
+    train_epoch(model, loss, optimizer, tr_gen, args.batches_per_epoch, device, augmenter=augmenter)
     
     if (epoch + 1) % args.save_freq == 0:
         save_checkpoint(
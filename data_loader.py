@@ -1,16 +1,43 @@
 import os
+import threading
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Value
 
 import numpy as np
 import nibabel as nib
 import torch
 import torch.nn as nn
 import torchvision.transforms.functional as TF
-from torch.utils.data import Dataset
-from torch.utils.data import DataLoader
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
+from torch.utils.data import DataLoader, Sampler
+from torch.utils.data import BatchSampler, RandomSampler, SequentialSampler
+from torch.utils.data.dataloader import default_collate
 from abc import abstractmethod
 import random
 from tqdm import tqdm
 
+from volume_cache import VolumeCache, LRUVolumeCache, CroppedVolume, brain_moments, nonzero_bbox
+from shm_store import SharedVolumeStore
+from manifest import load_manifest, has_et
+from patch_sampler import PatchSampler
+from fg_index import load_fg_index
+import pseudo_labels
+
+# guards the lazy creation of BraTSDataset's decode pool. it's module
+# state, so it isn't pickled with the dataset, and a fork child gets a new
+# one in case another thread held it when the child was forked.
+_pool_lock = threading.Lock()
+
+
+def _new_pool_lock():
+    global _pool_lock
+    _pool_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_new_pool_lock)
+
+
 def shuffle_split_dataset(data_dir, split_idx):
     def _proc_split(split):
         modes = [[], [], [], []]
@@ -32,42 +59,262 @@ def shuffle_split_dataset(data_dir, split_idx):
 
         return modes, segs
 
-    filenames=[]
-    for (dirpath, dirnames, files) in os.walk(data_dir):
-        filenames += [os.path.join(dirpath, file) for file in files if '.nii.gz' in file ]
-    modes = [sorted([ f for f in filenames if "t1.nii.gz" in f ]),
-              sorted([ f for f in filenames if "t1ce.nii.gz" in f ]),
-              sorted([ f for f in filenames if "t2.nii.gz" in f ]),
-              sorted([ f for f in filenames if "flair.nii.gz" in f ]),
-                sorted([ f for f in filenames if "seg.nii.gz" in f ])
-
-        ]
-    modes = [mode for mode in modes if len(mode) > 0 ]
-    joined_files = list(zip(*modes))
+    index = load_manifest(data_dir)
+    # keep the segmentations if every case has one
+    joined_files = index.cases(seg=len(index.segs()) == len(index))
     # this could be an option...
     random.shuffle(joined_files)
     train_split, val_split = joined_files[:split_idx], joined_files[split_idx:]
     return _proc_split(train_split), _proc_split(val_split)
 
+# dtypes a sample's images can be stored in between the DataLoader workers
+# and the training loop. int16 sends the raw intensities together with a per
+# channel affine and leaves standardization to to_device.
+TRANSPORT_DTYPES = ['float32', 'float16', 'int16']
+
+
+def to_device(src, device, dtype=torch.float):
+    ''' Moves a batch of images in any of the TRANSPORT_DTYPES to device and
+    upcasts it there, so the compact dtype is used until the device boundary.
+    '''
+    if not isinstance(src, dict):
+        return src.to(device).to(dtype)
+
+    data = src['data'].to(device)
+    affine = src['affine'].to(device, dtype)[..., None, None, None]
+    # the raw background is zero and has to stay zero
+    mask = data != 0
+    img = torch.addcmul(affine[:, :, 1], data.to(dtype), affine[:, :, 0])
+    if src['shift_and_scale'].any():
+        # one field per sample, shared by the channels, as in standardize
+        field = (data.size(0), 1, *data.shape[2:])
+        shft = torch.empty(field, device=device, dtype=dtype).uniform_(-0.1, 0.1)
+        scal = torch.empty(field, device=device, dtype=dtype).uniform_(0.9, 1.1)
+        aug = src['shift_and_scale'].to(device).view(-1, 1, 1, 1, 1)
+        img = torch.where(aug, (img + shft)*scal, img)
+    return img*mask
+
+
+class AffinitySampler(Sampler):
+    ''' Shuffles a dataset so each index always goes to the same DataLoader
+    worker. The DataLoader hands batch k to worker k % num_workers, so
+    index i is put in the batches of worker i % num_workers. With
+    persistent workers and BraTSDataset's cache_mb, each worker then keeps
+    hitting the cases it holds. If the workers' shares don't divide into
+    whole batches the last few batches mix them.
+    '''
+    def __init__(self, n, batch_size, num_workers, shuffle=True):
+        self.n = n
+        self.batch_size = batch_size
+        self.num_workers = max(num_workers, 1)
+        self.shuffle = shuffle
+
+    def __len__(self):
+        return self.n
+
+    def __iter__(self):
+        groups = [list(range(w, self.n, self.num_workers)) for w in range(self.num_workers)]
+        if self.shuffle:
+            for g in groups:
+                random.shuffle(g)
+        order = []
+        k = 0
+        while any(groups):
+            batch = groups[k % self.num_workers][:self.batch_size]
+            del groups[k % self.num_workers][:self.batch_size]
+            # top up from the largest remaining share
+            while len(batch) < self.batch_size and any(groups):
+                g = max(groups, key=len)
+                batch.append(g.pop())
+            order += batch
+            k += 1
+        return iter(order)
+
+
+# the augmentation of one sample. it's made once per sample and never
+# changed, so samples can be made concurrently
+Augmentation = namedtuple('Augmentation', ['mirror', 'axis', 'shft', 'scal'])
+
+
+class BucketBatchSampler(Sampler):
+    ''' Batches samples of similar shape together so batches of brain
+    crops need little padding. Each epoch the samples are shuffled, cut
+    into pools of pool_batches batches, each pool is sorted by sample size
+    and batched, and the batches are shuffled. padding_efficiency is the
+    fraction of the padded batch tensors the last epoch's samples fill.
+    '''
+    def __init__(self, shapes, batch_size, shuffle=True, pool_batches=50, drop_last=False):
+        self.shapes = [tuple(s) for s in shapes]
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.pool_batches = pool_batches
+        self.drop_last = drop_last
+        self.padding_efficiency = None
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.shapes) // self.batch_size
+        return -(-len(self.shapes) // self.batch_size)
+
+    def __iter__(self):
+        idx = list(range(len(self.shapes)))
+        if self.shuffle:
+            random.shuffle(idx)
+        pool = self.batch_size * self.pool_batches
+        batches = []
+        for i in range(0, len(idx), pool):
+            p = sorted(idx[i:i + pool], key=lambda j: np.prod(self.shapes[j]))
+            batches += [p[j:j + self.batch_size] for j in range(0, len(p), self.batch_size)]
+        if self.drop_last:
+            batches = [b for b in batches if len(b) == self.batch_size]
+        if self.shuffle:
+            random.shuffle(batches)
+
+        used = padded = 0
+        for b in batches:
+            used += sum(np.prod(self.shapes[j]) for j in b)
+            padded += len(b) * np.prod(np.max([self.shapes[j] for j in b], 0))
+        self.padding_efficiency = used / max(padded, 1)
+        return iter(batches)
+
+
+def pad_collate(batch):
+    ''' Collates samples of different spatial shapes into one preallocated
+    tensor per field, zero padded at the end of each axis. Padded target
+    voxels are background.
+    '''
+    def pad(tensors):
+        shape = np.max([t.shape for t in tensors], 0)
+        out = tensors[0].new_zeros((len(tensors), *shape))
+        for i, t in enumerate(tensors):
+            out[(i, *[slice(0, n) for n in t.shape])] = t
+        return out
+
+    images, targets = zip(*batch)
+    if isinstance(images[0], dict):
+        # int16 transport, see BraTSDataset._pack
+        images = {'data': pad([d['data'] for d in images]),
+                'affine': torch.stack([d['affine'] for d in images]),
+                'shift_and_scale': torch.tensor([d['shift_and_scale'] for d in images])}
+    else:
+        images = pad(images)
+    if isinstance(targets[0], torch.Tensor):
+        targets = pad(targets)
+    return images, targets
+
+
+class ThreadDataLoader(object):
+    ''' A DataLoader whose workers are threads of this process. Decoding
+    and most of numpy release the GIL, so threads keep up without the
+    forking, pickling and copying between processes of DataLoader. The
+    dataset is shared by the threads and must not keep per-sample state,
+    see BraTSTrainDataset. Takes the batching arguments of DataLoader.
+    '''
+    def __init__(self, dataset, batch_size=1, shuffle=False, sampler=None,
+            batch_sampler=None, collate_fn=None, num_workers=0, prefetch_factor=2):
+        if batch_sampler is None:
+            if sampler is None:
+                sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+            batch_sampler = BatchSampler(sampler, batch_size, drop_last=False)
+        self.dataset = dataset
+        self.sampler = sampler
+        self.batch_sampler = batch_sampler
+        self.collate_fn = collate_fn or default_collate
+        self.num_workers = max(num_workers, 1)
+        self.prefetch_factor = prefetch_factor
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    def __iter__(self):
+        batches = iter(self.batch_sampler)
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.num_workers) as pool:
+            def submit():
+                for b in batches:
+                    pending.append([pool.submit(self.dataset.__getitem__, i) for i in b])
+                    return
+
+            for _ in range(self.num_workers * self.prefetch_factor):
+                submit()
+            while pending:
+                futures = pending.popleft()
+                submit()
+                yield self.collate_fn([f.result() for f in futures])
+
+
+class PatchShuffleBuffer(IterableDataset):
+    ''' Iterates over the patches of a BraTSTrainDataset, see its
+    patches_per_case, so each decode of a case gives several samples. The
+    patches of consecutive cases are mixed in a buffer of buffer_size
+    samples and drawn from it at random, which keeps the patches of a case
+    out of the same batch. Each DataLoader worker takes the same share of
+    the cases every epoch, which suits cache_mb and persistent workers.
+    Call the dataset's set_epoch to reshuffle.
+    '''
+    def __init__(self, dataset, buffer_size=16, shuffle=True):
+        self.dataset = dataset
+        self.buffer_size = max(buffer_size, 1)
+        self.shuffle = shuffle
+
+    def __len__(self):
+        return len(self.dataset) * self.dataset.patches_per_case
+
+    def __iter__(self):
+        info = get_worker_info()
+        worker, num_workers = (0, 1) if info is None else (info.id, info.num_workers)
+        rng = np.random.default_rng((self.dataset.seed, self.dataset.epoch.value, worker))
+        idx = list(range(worker, len(self.dataset), num_workers))
+        if self.shuffle:
+            rng.shuffle(idx)
+
+        buffer = []
+        for i in idx:
+            buffer += self.dataset.patches(i)
+            while len(buffer) >= self.buffer_size:
+                yield self._pop(buffer, rng)
+        while buffer:
+            yield self._pop(buffer, rng)
+
+    def _pop(self, buffer, rng):
+        if not self.shuffle:
+            return buffer.pop(0)
+        j = int(rng.integers(len(buffer)))
+        buffer[j], buffer[-1] = buffer[-1], buffer[j]
+        return buffer.pop()
+
+
 class BraTSDataset(Dataset):
-    def __init__(self, data_dir, dims=[240, 240, 155], modes=None, segs=None):
-        self.x_off = 0
-        self.y_off = 0
-        self.z_off = 0
+    def __init__(self, data_dir, dims=[240, 240, 155], modes=None, segs=None,
+            cache_dir=None, transport_dtype='float32', decode_threads=0, shm_store=None,
+            cache_mb=0):
+        if transport_dtype not in TRANSPORT_DTYPES:
+            raise ValueError(f'transport_dtype must be one of {TRANSPORT_DTYPES}, got {transport_dtype}')
+        self.transport_dtype = transport_dtype
+        # zlib releases the GIL so the volumes of a case can be decoded
+        # concurrently. the pool is made lazily by whichever process uses it.
+        self.decode_threads = decode_threads
+        self._pool = None
+        self._pool_pid = None
         self.dims=dims
+        self.data_dir = data_dir
+        # decoded volumes are read from here after the first epoch. a
+        # shared memory store, see shm_store.py, is shared by every worker
+        # and process on the node and takes precedence.
+        self.cache = None
+        if shm_store:
+            self.cache = SharedVolumeStore(shm_store)
+        elif cache_dir:
+            self.cache = VolumeCache(cache_dir)
+        # decoded volumes kept in each worker's memory. pair it with
+        # persistent workers and the AffinitySampler so a worker sees the
+        # same cases every epoch.
+        self.memory = LRUVolumeCache(cache_mb * 1024**2) if cache_mb else None
         
-        filenames = []
-        # should have a conditional here to skip this is modes and segs are not None
-        for (dirpath, dirnames, files) in os.walk(data_dir):
-            filenames += [os.path.join(dirpath, file) for file in files if '.nii.gz' in file ]
-
-        self.modes = [sorted([ f for f in filenames if "t1.nii.gz" in f ]),
-                      sorted([ f for f in filenames if "t1ce.nii.gz" in f ]),
-                      sorted([ f for f in filenames if "t2.nii.gz" in f ]),
-                      sorted([ f for f in filenames if "flair.nii.gz" in f ])
-            ]
-
-        self.segs = sorted([ f for f in filenames if "seg.nii.gz" in f ])
+        if modes is None or segs is None:
+            index = load_manifest(data_dir)
+            self.modes = index.modes()
+            self.segs = index.segs()
 
         if modes:
             self.modes = modes
@@ -80,41 +327,112 @@ class BraTSDataset(Dataset):
         # return size of dataset
         return max([len(self.modes[i]) for i in range(len(self.modes))])
 
-    def _load_images(self, idx):
-        images = []
-        for m in self.modes:
-            image = nib.load(m[idx])
-            images.append(image)
-            header = image.header
+    def __getstate__(self):
+        # DataLoader workers started with spawn get a pickled copy, the
+        # pool can't be pickled and is remade in the worker
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        return state
+
+    def _executor(self):
+        # a pool inherited through fork has no threads in the child so it's
+        # remade whenever the pid changes. the threads of a ThreadDataLoader
+        # get here together, the lock makes sure only one pool is made.
+        pid = os.getpid()
+        if self._pool is None or self._pool_pid != pid:
+            with _pool_lock:
+                if self._pool is None or self._pool_pid != pid:
+                    self._pool = ThreadPoolExecutor(max_workers=self.decode_threads)
+                    self._pool_pid = pid
+        return self._pool
+
+    def _load_volume(self, path, seg=False):
+        # without a cache the nifti is decoded lazily in _transform_data
+        if self.cache is None:
+            return nib.load(path)
+        return self.cache.load(path, seg=seg)
+
+    def _decode_volume(self, path, seg=False):
+        return self._as_volume(self._load_volume(path, seg=seg), seg=seg)
+
+    def _load_case(self, idx, seg=True):
+        ''' Returns the volumes of the modalities of case idx, the header of
+        its last modality and, if seg and there are segmentations, its
+        segmentation volume (otherwise None). With decode_threads they are
+        all decoded concurrently.
+        '''
+        paths = [m[idx] for m in self.modes]
+        is_seg = [False] * len(paths)
+        if seg and self.segs:
+            paths.append(self.segs[idx])
+            is_seg.append(True)
+
+        volumes = [None] * len(paths)
+        if self.memory is not None:
+            volumes = [self.memory.get(p) for p in paths]
+        todo = [i for i, v in enumerate(volumes) if v is None]
+
+        if self.decode_threads:
+            decoded = self._executor().map(self._decode_volume,
+                    [paths[i] for i in todo], [is_seg[i] for i in todo])
+        elif self.memory is not None:
+            decoded = [self._decode_volume(paths[i], seg=is_seg[i]) for i in todo]
+        else:
+            decoded = [self._load_volume(paths[i], seg=is_seg[i]) for i in todo]
+        for i, v in zip(todo, decoded):
+            volumes[i] = v if self.memory is None else self.memory.put(paths[i], v)
 
+        # reading the header doesn't decompress the image data
+        header = nib.load(self.modes[-1][idx]).header
+        seg_volume = volumes.pop() if is_seg[-1] else None
+        return volumes, header, seg_volume
+
+    def _load_images(self, idx):
+        images, header, _ = self._load_case(idx, seg=False)
         return images, header
 
-    def _transform_data(self, d, seg_mat=False, shift_and_scale=False):
-        img = d.get_fdata()
-        x, y, z = img.shape
-        add_x = x % 2 
-        add_y = y % 2 
-        add_z = z % 2 
-        npad = ((0, add_x),
-                (0, add_y),
-                (0, add_z))
-
-        img = np.pad(img, 
-                pad_width=npad, 
-                mode='constant', 
-                constant_values=0)
+    def cache_stats(self):
+        ''' Hits, misses and hit rate of the in-memory cache over all
+        workers, or None without one.
+        '''
+        return None if self.memory is None else self.memory.stats()
+
+    def _center_window(self, shape):
+        # odd dimensions are padded by one voxel and then the centered
+        # self.dims window is taken
+        padded = [n + n % 2 for n in shape]
+        start = [(p - d) // 2 for p, d in zip(padded, self.dims)]
+        stop = [p - o for p, o in zip(padded, start)]
+        return start, stop
+
+    def _as_volume(self, d, seg=False):
+        if isinstance(d, CroppedVolume):
+            return d
+        data = d.get_fdata(dtype=np.float32)
+        if seg:
+            data = np.rint(data).astype(np.uint8)
+        return CroppedVolume.from_array(data)
+
+    def _brain_bbox(self, volumes):
+        # cached volumes are stored cropped to their nonzero voxels so the
+        # union of the stored regions is the brain's bounding box
+        if self.cache is None:
+            return nonzero_bbox([v.data for v in volumes])
+        boxes = np.stack([v.bbox() for v in volumes])
+        return np.stack([boxes[:, :, 0].min(0), boxes[:, :, 1].max(0)], axis=1)
+
+    def _transform_data(self, d, seg_mat=False, aug=None, window=None):
+        d = self._as_volume(d, seg=seg_mat)
 
         #img = np.zeros(img.shape)
         #img[120, 120, 50] = 1
         #print(np.where(img > 0))
 
-        self.x_off = (img.shape[0] - self.dims[0]) // 2
-        self.y_off = (img.shape[1] - self.dims[1]) // 2
-        self.z_off = (img.shape[2] - self.dims[2]) // 2
-
-        img = img[self.x_off:img.shape[0]-self.x_off,
-              self.y_off:img.shape[1]-self.y_off,
-              self.z_off:img.shape[2]-self.z_off]
+        # reading the window zero fills the padding so the full
+        # volume is never copied. the window is a new array so
+        # everything after this works on it in place.
+        start, stop = window or self._center_window(d.shape)
+        img = d.read(start, stop, dtype=None if seg_mat else np.float32)
         #dims = self.dims
 
         #x_off = int((240 - dims[0]) / 2)
@@ -128,36 +446,62 @@ class BraTSDataset(Dataset):
         #wt = m(output[0, 1, :, :, :])
         #tc = m(output[0, 2, :, :, :])
 
-        # don't standardized the segmentations
-        if seg_mat:
+        # don't standardized the segmentations. int16 transport
+        # standardizes on the device.
+        if seg_mat or self.transport_dtype == 'int16':
             return img
 
         #img_trans = self.min_max_normalize(img)
-        return self.standardize(img, shift_and_scale=shift_and_scale)
+        if aug is None or aug.shft is None:
+            return self.standardize(img)
+        return self.standardize(img, aug.shft, aug.scal)
+
+    def _pack(self, images, shift_and_scale=False):
+        ''' Stacks the channels of a sample in self.transport_dtype. The
+        result is turned back into float32 by to_device.
+        '''
+        if self.transport_dtype == 'int16':
+            # the images are raw intensities. BraTS is distributed as
+            # integers so they fit in an int16 as they are unless the
+            # range is too large, in which case they are rescaled.
+            data = np.empty((len(images), *images[0].shape), dtype=np.int16)
+            affine = np.zeros((len(images), 2), dtype=np.float32)
+            for i, img in enumerate(images):
+                mean, std = brain_moments(img)
+                step = max(np.abs(img).max() / 32767, 1.)
+                data[i] = img if step == 1. else np.rint(img / step)
+                affine[i] = step / (std + 1e-8), -mean / (std + 1e-8)
+            return {'data': torch.from_numpy(data),
+                    'affine': torch.from_numpy(affine),
+                    'shift_and_scale': shift_and_scale}
+
+        data = np.empty((len(images), *images[0].shape), dtype=self.transport_dtype)
+        for i, img in enumerate(images):
+            data[i] = img
+        return torch.from_numpy(data)
 
     def min_max_normalize(self, d):
         d = (d - np.min(d)) / (np.max(d) - np.min(d))
         return d
 
-    def standardize(self, d, shift_and_scale=False):
-        # H length list of WxD arrays of booleans where
-        # the i, (j, k) is True if d[i, j, k] > 0
-        nonzero_masks = [i != 0 for i in d]
-        brain_mask = np.zeros(d.shape, dtype=bool)
-
-        for i in range(len(nonzero_masks)):
-            brain_mask[i, :, :] = brain_mask[i, :, :] | nonzero_masks[i]
-        
-        mean = d[brain_mask].mean()
-        std = d[brain_mask].std()
+    def standardize(self, d, shft=None, scal=None):
+        ''' Standardizes d in place with the mean and standard deviation of
+        the brain (its nonzero voxels), then shifts and scales it by the
+        fields shft and scal if given. The background stays zero. d should
+        be a float32 array owned by the caller, e.g. a window returned by
+        CroppedVolume.read.
+        '''
+        brain_mask = d != 0
+        mean, std = brain_moments(d)
         # now normalize each modality with its mean and standard deviation (computed within the brain mask)
-        stan = (d - mean) / (std + 1e-8)
-        if shift_and_scale:
-            stan = stan + self.shft
-            stan = stan*self.scal 
+        d -= mean
+        d *= 1 / (std + 1e-8)
+        if shft is not None:
+            d += shft
+            d *= scal
 
-        stan[brain_mask == False] = 0
-        return stan
+        d *= brain_mask
+        return d
 
     @abstractmethod
     def __getitem__(self, idx):
@@ -169,191 +513,239 @@ class BraTSTrainDataset(BraTSDataset):
         dims=[240, 240, 155], 
         augment_data = True, throw_no_et_sets=False,
         clinical_segs=True, enhance_feat=False, 
-        modes=None, segs=None):
-        BraTSDataset.__init__(self, data_dir, dims, modes=modes, segs=segs)
+        modes=None, segs=None, cache_dir=None, transport_dtype='float32',
+        filters=None, crop_type='center', fg_fraction=0., class_weights=None,
+        decode_threads=0, shm_store=None, cache_mb=0, seed=0, patches_per_case=1):
+        BraTSDataset.__init__(self, data_dir, dims, modes=modes, segs=segs,
+                cache_dir=cache_dir, transport_dtype=transport_dtype,
+                decode_threads=decode_threads, shm_store=shm_store, cache_mb=cache_mb)
+        if enhance_feat and transport_dtype == 'int16':
+            raise ValueError('enhance_feat needs standardized images, use float16 or float32 transport.')
+        # targets are returned as label maps, the expansion to clinical
+        # regions happens in utils.expand_labels
         self.clinical_segs = clinical_segs
         self.enhance_feat=enhance_feat
 
         self.augment_data = augment_data
-
-        # randomly mirror along axis
-        self.mirror = False
-        self.axis = np.random.choice([0, 1, 2], 1)[0]
-        
-        self.shft = None
-        self.scal = None
-
+        if patches_per_case > 1 and crop_type == 'center' and fg_fraction == 0:
+            # every patch of a decode would be the same centered window
+            raise ValueError('patches_per_case > 1 needs a random, bbox or brain crop_type, or fg_fraction > 0.')
+        # where the dims window is taken from, see patch_sampler. center
+        # keeps the centered window of _center_window.
+        self.sampler = PatchSampler(dims, crop_type,
+                fg_fraction=fg_fraction, class_weights=class_weights)
+        # with fg_fraction > 0 that fraction of the patches is centered on a
+        # labeled voxel, looked up in the precomputed fg_index
+        self.fg_index = load_fg_index(data_dir) if fg_fraction > 0 else None
+
+        # the randomness of sample idx comes from a generator seeded by
+        # (seed, epoch, idx) so samples don't depend on which worker or
+        # thread makes them. the epoch is shared with the workers.
+        self.seed = seed
+        self.epoch = Value('l', 0)
+        # samples made from each decode of a case by patches, see
+        # PatchShuffleBuffer
+        self.patches_per_case = patches_per_case
+
+        # filters are predicates over the label counts in the manifest,
+        # see manifest.has_et and manifest.min_region_volume
+        filters = list(filters or [])
         if throw_no_et_sets:
             print('Removing datasets with no enhancing tumor.')
-            segs_temp = []
-            mode_temp = [[],[],[],[]]
-            kicked = 0
-            for seg, m1, m2, m3, m4 in zip(self.segs, *self.modes):
-                img = nib.load(seg).get_fdata()
-                if len(np.where(img==4)[0]) != 0:
-                    segs_temp.append(seg)
-                    mode_temp[0].append(m1)
-                    mode_temp[1].append(m2)
-                    mode_temp[2].append(m3)
-                    mode_temp[3].append(m4)
-                else:
-                    kicked+=1
-                    
-            print(f'{kicked + 1} datasets removed.')
-            self.segs = segs_temp
-            self.modes = mode_temp
-
-    def _load_images(self, idx):
-        images = []
-        for m in self.modes:
-            image = nib.load(m[idx])
-            images.append(image)
-            header = image.header
-        return images, header
-
-    def _transform_data(self, image, seg_mat=False, shift_and_scale=False):
+            filters.append(has_et)
+
+        if filters:
+            index = load_manifest(data_dir, label_stats=True)
+            keep = index.filter(self.segs, filters)
+            print(f'{len(self.segs) - len(keep)} datasets removed.')
+            self.segs = [self.segs[i] for i in keep]
+            self.modes = [[m[i] for i in keep] for m in self.modes]
+
+    def window_shapes(self):
+        ''' The shape of each sample's window, from the brain bounding boxes
+        in the manifest. Computes the manifest's statistics if needed.
+        Cases outside the manifest are assumed to fill dims.
+        '''
+        if self.sampler.crop_type != 'brain':
+            return [list(self.dims)] * len(self)
+        index = load_manifest(self.data_dir, stats=True)
+        shapes = []
+        for path in self.modes[0]:
+            r = index.record(path)
+            bbox = r['stats']['bbox'] if r is not None else None
+            shapes.append(self.sampler.window_shape(bbox))
+        return shapes
+
+    def set_epoch(self, epoch):
+        self.epoch.value = epoch
+
+    def _rng(self, idx, patch=None):
+        key = (self.seed, self.epoch.value, idx)
+        return np.random.default_rng(key if patch is None else key + (patch,))
+
+    def _augmentation(self, rng, size):
+        ''' Draws the augmentation of a sample with window size size. '''
+        if not self.augment_data:
+            return Augmentation(False, 0, None, None)
+        # mirror sample? if so which dimension
+        mirror = rng.uniform() > 0.5
+        axis = int(rng.integers(3))
+        shft = scal = None
+        # for int16 transport the fields are drawn in to_device
+        if self.transport_dtype != 'int16':
+            shft = rng.uniform(-0.1, 0.1, size).astype(np.float32)
+            scal = rng.uniform(0.9, 1.1, size).astype(np.float32)
+        return Augmentation(mirror, axis, shft, scal)
+
+    def _transform_data(self, image, seg_mat=False, aug=None, window=None):
         img_trans = BraTSDataset._transform_data(self, image, 
-                seg_mat=seg_mat, shift_and_scale=shift_and_scale)
-        if self.mirror:
-            # not sure the copy is needed here
-            img_trans = np.flip(img_trans, self.axis).copy()
+                seg_mat=seg_mat, aug=aug, window=window)
+        if aug is not None and aug.mirror:
+            # a view. the images are copied when they are stacked and
+            # the segmentation is made contiguous in __getitem__
+            img_trans = np.flip(img_trans, aug.axis)
 
         return img_trans
 
     def __getitem__(self, idx):
-        # mirror sample? if so which dimension
-        shift_and_scale=False
-        if self.augment_data:
-            self.shft = np.random.uniform(-0.1, 0.1, self.dims)
-            self.scal = np.random.uniform(0.9, 1.1, self.dims)
-            shift_and_scale = True
-
-        if np.random.uniform() > 0.5: 
-            self.mirror = True
-            self.axis = np.random.choice([0, 1, 2], 1)[0]
-
+        return self._sample(idx, self._load_case(idx), self._rng(idx))
+
+    def patches(self, idx):
+        ''' Returns patches_per_case samples of case idx, each cropped and
+        augmented independently, from a single decode of the case.
+        '''
+        case = self._load_case(idx)
+        if self.patches_per_case == 1:
+            return [self._sample(idx, case, self._rng(idx))]
+        return [self._sample(idx, case, self._rng(idx, k))
+                for k in range(self.patches_per_case)]
+
+    def _sample(self, idx, case, rng):
         # header data should be handled in preprocessing, not here
-        images, header = self._load_images(idx) 
-        images = [self._transform_data(image, shift_and_scale=shift_and_scale) for image in images]  
-        images = torch.from_numpy(np.stack(images))
+        images, header, seg = case
+        window = None
+        if self.sampler.crop_type != 'center' or self.fg_index is not None:
+            images = [self._as_volume(image) for image in images]
+            bbox = None
+            if self.sampler.crop_type in ['bbox', 'brain']:
+                bbox = self._brain_bbox(images)
+            fg = None
+            if self.fg_index is not None and self.segs and self.segs[idx]:
+                fg = self.fg_index.lookup(self.segs[idx])
+            window = self.sampler.window(images[0].shape, bbox, fg, rng=rng)
+
+        # brain crops vary in size
+        size = self.dims if window is None else [b - a for a, b in zip(*window)]
+        aug = self._augmentation(rng, size)
+
+        images = [self._transform_data(image, aug=aug, window=window)
+                for image in images]  
         
         if self.enhance_feat:
             # t1 idx: 0 t1ce idx: 1
-            e = images[1] / (images[0] + 1e-8)
-            images = torch.cat([images, e.unsqueeze(0)])
+            images.append(images[1] / (images[0] + 1e-8))
+
+        images = self._pack(images, shift_and_scale=self.augment_data)
 
+        # the target is the uint8 label map. it is expanded to the
+        # ET/WT/TC (or NCR/ED/ET) channels on the device by
+        # utils.expand_labels, see clinical_segs in utils.train
         target = []
-        # get this out of here
-        if self.segs:
-            seg = nib.load(self.segs[idx])
-            seg = self._transform_data(seg, seg_mat=True)
-            segs = []
-
-            if self.clinical_segs:
-                # enhancing tumor
-                seg_et = np.zeros(seg.shape)
-                seg_et[np.where(seg==4)] = 1
-                segs.append(seg_et)
-
-                # whole tumor
-                seg_wt = np.zeros(seg.shape)
-                seg_wt[np.where(seg > 0)] = 1
-                segs.append(seg_wt)
-               
-                # tumor core
-                seg_tc = np.zeros(seg.shape)
-                seg_tc[np.where(seg==1) or np.where(seg==4)] = 1
-                segs.append(seg_tc)
-
-                target = torch.from_numpy(np.stack(segs))
-            else:
-                # necrotic/non-enhancing tumor
-                seg_ncr_net = np.zeros(seg.shape)
-                seg_ncr_net[np.where(seg==1)] = 1
-                segs.append(seg_ncr_net)
-                
-                # edema
-                seg_ed = np.zeros(seg.shape)
-                seg_ed[np.where(seg==2)] = 1
-                segs.append(seg_ed)
-                
-                # enhancing tumor
-                seg_et = np.zeros(seg.shape)
-                seg_et[np.where(seg==4)] = 1
-                segs.append(seg_et)
-                target = torch.from_numpy(np.stack(segs))
+        if seg is not None:
+            seg = self._transform_data(seg, seg_mat=True, aug=aug, window=window)
+            if seg.dtype != np.uint8:
+                seg = np.rint(seg).astype(np.uint8)
+            target = torch.from_numpy(np.ascontiguousarray(seg))
 
         return images, target
 
 
 class BraTSSelfTrainDataset(BraTSTrainDataset):
-    ''' Dataset class for self training.  '''
-    def __init__(self, data_dir,  model, device,
+    ''' Dataset class for self training. n unlabeled cases are added to
+    the labeled ones with pseudo-labels read from a PseudoLabelStore, see
+    pseudo_labels.py. The dataset doesn't hold the model: call annotate
+    with it to make a generation of labels.
+    '''
+    def __init__(self, data_dir, device,
             unsupervised_data_dir='/shared/mrfil-data/cddunca2/Task01_BrainTumour/partitioned-by-mode/',  
             n=50, dims=[240, 240, 155],
-            augment_data = True, modes=None, segs=None):
+            augment_data = True, modes=None, segs=None, cache_dir=None,
+            transport_dtype='float32', decode_threads=0, shm_store=None, cache_mb=0,
+            seed=0, patches_per_case=1, crop_type='center', run_id='selftrain',
+            labels_root=pseudo_labels.ROOT, teacher_batch_size=4):
         BraTSTrainDataset.__init__(self, data_dir, dims, 
                 augment_data = augment_data, enhance_feat=False,
-                modes=modes, segs=segs)
+                modes=modes, segs=segs, cache_dir=cache_dir,
+                transport_dtype=transport_dtype, decode_threads=decode_threads,
+                shm_store=shm_store, cache_mb=cache_mb, seed=seed,
+                crop_type=crop_type, patches_per_case=patches_per_case)
         self.orig_segs = self.segs.copy()
         self.unsupervised_data_dir = unsupervised_data_dir
-        self.model = model
         self.device = device
         
         (st_modes, _), (_, _) = shuffle_split_dataset(unsupervised_data_dir, n)
         # shuffle data and select first n 
-        unsupervised_data = BraTSAnnotationDataset(unsupervised_data_dir, 
+        self.unsupervised_data = BraTSAnnotationDataset(unsupervised_data_dir, 
                 modes = st_modes, 
                 dims=dims, 
-                enhance_feat=False)
-        # batch size > 1 breaks something 
-        #self.dataloader = DataLoader(unsupervised_data, batch_size=5)
-        self.dataloader = DataLoader(unsupervised_data, batch_size=1)
-        # this will cause problems for multiple processes
-        self.annotations_dir = '/dev/shm/tmp/selftrain/'
-        os.makedirs(self.annotations_dir, exist_ok=True)
+                enhance_feat=False,
+                cache_dir=cache_dir,
+                transport_dtype=transport_dtype,
+                # the teacher runs in a daemon process, which can't have
+                # DataLoader workers
+                decode_threads=max(decode_threads, 4),
+                shm_store=shm_store)
+        # keyed by run so concurrent jobs don't share labels
+        self.labels = pseudo_labels.PseudoLabelStore(run_id, len(st_modes[0]), root=labels_root)
+        self.teacher = pseudo_labels.Annotator(self.unsupervised_data, self.labels,
+                device, batch_size=teacher_batch_size)
          
-        self.modes = sorted([self.modes[i] + st_modes[i] for i in range(len(self.modes))])
-        self.segs = sorted(self.segs+ self.annotate())
-
-    def annotate(self):
-        segs = []
-        with torch.no_grad():
-            self.model.eval()
-            for d in tqdm(self.dataloader):
-                src = d['data'].to(self.device, dtype=torch.float)
-                output = self.model(src)
-
-                x_off = int((240 - self.dims[0]) / 2)
-                y_off = int((240 - self.dims[1]) / 2)
-                z_off = int((155 - self.dims[2]) / 2)
-
-                m = nn.ConstantPad3d((z_off, z_off, y_off, y_off, x_off, x_off), 0)
-
-                et = m(output[0, 0, :, :, :])
-                wt = m(output[0, 1, :, :, :])
-                tc = m(output[0, 2, :, :, :])
-                
-                label = torch.zeros((240, 240, 155))
-                label[torch.where(wt > 0.50)] = 2
-                label[torch.where(tc > 0.50)] = 1
-                label[torch.where(et > 0.50)] = 4
-                
-                orig_header = nib.load(d['file'][0][0]).header
-                aff = orig_header.get_qform()
-                img = nib.Nifti1Image(label.numpy(), aff, header=orig_header)
-                seg_path = os.path.join(self.annotations_dir, f'{d["patient"][0]}_seg.nii.gz')
-                img.to_filename(seg_path)
-                segs.append(seg_path)
-        return segs
+        # the unlabeled cases come after the labeled ones and have no
+        # segmentation path, their labels are read from the store
+        self.n_labeled = len(self.segs)
+        self.modes = [self.modes[i] + st_modes[i] for i in range(len(self.modes))]
+        self.segs = self.segs + [None] * len(st_modes[0])
+
+    def __getstate__(self):
+        state = BraTSTrainDataset.__getstate__(self)
+        # only the main process starts the teacher
+        state['teacher'] = None
+        return state
+
+    def annotate(self, model, wait=False):
+        ''' Makes a new generation of pseudo-labels with the weights model
+        has now. With wait the labels are made here and now, otherwise in
+        the background if the last generation is done. Returns whether a
+        new generation was started.
+        '''
+        if wait:
+            self.teacher.join()
+            pseudo_labels.annotate(model, self.unsupervised_data, self.labels,
+                    self.device, batch_size=self.teacher.batch_size, progress=True)
+            return True
+        return self.teacher.start(model)
+
+    def _load_case(self, idx, seg=True):
+        if idx < self.n_labeled:
+            return BraTSTrainDataset._load_case(self, idx, seg=seg)
+        images, header, _ = BraTSTrainDataset._load_case(self, idx, seg=False)
+        seg_volume = None
+        if seg:
+            seg_volume = CroppedVolume.from_array(self.labels.labels()[idx - self.n_labeled])
+        return images, header, seg_volume
 
 ###### BraTSSelfTrainDataset
 
 class BraTSAnnotationDataset(BraTSDataset):
     def __init__(self, data_dir,  
         dims=[240, 240, 155], augment_data = True, clinical_segs=True,
-        enhance_feat=False, modes=None):
-        BraTSDataset.__init__(self, data_dir, modes=modes, dims=dims)
+        enhance_feat=False, modes=None, cache_dir=None, transport_dtype='float32',
+        decode_threads=0, shm_store=None, cache_mb=0):
+        BraTSDataset.__init__(self, data_dir, modes=modes, dims=dims,
+                cache_dir=cache_dir, transport_dtype=transport_dtype,
+                decode_threads=decode_threads, shm_store=shm_store, cache_mb=cache_mb)
+        if enhance_feat and transport_dtype == 'int16':
+            raise ValueError('enhance_feat needs standardized images, use float16 or float32 transport.')
         self.enhance_feat=enhance_feat
 
     def _patient(self, f):
@@ -362,7 +754,7 @@ class BraTSAnnotationDataset(BraTSDataset):
     def __getitem__(self, idx):
         # header data should be handled in preprocessing, not here
         images, header = self._load_images(idx) 
-        data = [torch.from_numpy(self._transform_data(img)) for img in images]
+        data = [self._transform_data(img) for img in images]
         if self.enhance_feat:
             # t1 idx: 0 t1ce idx: 1
             e = data[1] / (data[0] + 1e-32)
@@ -370,7 +762,7 @@ class BraTSAnnotationDataset(BraTSDataset):
             e[e>0] = 1
             data.append(e) 
 
-        src = torch.stack(data)
+        src = self._pack(data)
 
         ## this has to be on for outputing segmentations
         #  otherwise the metadata won't be correct
@@ -0,0 +1,172 @@
+'''
+Precomputed coordinates of labeled voxels.
+
+Centered or random patches often hold little or no tumor, enhancing tumor
+in particular. Placing a patch around a labeled voxel needs to know where
+the labeled voxels are. Finding them means decoding the segmentation, which
+is too slow to do for every sample. The index stores, for every case and
+each of labels 1, 2 and 4, up to max_per_label randomly chosen voxel
+coordinates as int16. Picking a labeled voxel is then a lookup and a random
+row, see patch_sampler.PatchSampler.
+
+The index is a single .npz next to the data directory's manifest. The
+coordinates of each label are concatenated over cases with an offsets
+array, so the whole index is a handful of arrays. Cases whose segmentation
+changed since the index was built are recomputed on load.
+
+To build the index for a data directory:
+
+    python fg_index.py --data_dir /dev/shm/MICCAI_BraTS2020_TrainingData
+'''
+import os
+import json
+import zlib
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+
+from volume_cache import decode
+from manifest import load_manifest
+
+LABELS = [1, 2, 4]
+VERSION = 1
+
+
+def label_coords(seg_path, max_per_label=4096):
+    ''' Returns {label: (n, 3) int16 coordinates} of at most max_per_label
+    voxels of each label of the segmentation, chosen at random.
+    '''
+    seg = decode(seg_path, seg=True)
+    # seeded by the path so rebuilding an unchanged case gives the same index
+    rs = np.random.RandomState(zlib.crc32(seg_path.encode()))
+    coords = {}
+    for l in LABELS:
+        idx = np.flatnonzero(seg == l)
+        if len(idx) > max_per_label:
+            idx = rs.choice(idx, max_per_label, replace=False)
+        coords[l] = np.stack(np.unravel_index(idx, seg.shape), axis=1).astype(np.int16)
+    return coords
+
+
+def _label_coords(args):
+    return label_coords(*args)
+
+
+class ForegroundIndex(object):
+    ''' Labeled voxel coordinates of the cases in segs. coords[l] holds the
+    rows of every case for label l, case i's being
+    coords[l][offsets[l][i]:offsets[l][i + 1]].
+    '''
+    def __init__(self, segs, sources, coords, offsets, max_per_label):
+        self.segs = segs
+        self.sources = sources
+        self.coords = coords
+        self.offsets = offsets
+        self.max_per_label = max_per_label
+        self._pos = {s: i for i, s in enumerate(segs)}
+
+    def __len__(self):
+        return len(self.segs)
+
+    def lookup(self, seg_path):
+        ''' Returns {label: coordinates} of seg_path, or None if the case
+        isn't indexed. The arrays are views into the index.
+        '''
+        i = self._pos.get(os.path.abspath(seg_path))
+        if i is None:
+            return None
+        return {l: self.coords[l][self.offsets[l][i]:self.offsets[l][i + 1]]
+                for l in LABELS}
+
+    def save(self, path):
+        arrays = {'segs': np.array(self.segs),
+                'meta': np.array(json.dumps({'version': VERSION,
+                    'max_per_label': self.max_per_label,
+                    'sources': self.sources}))}
+        for l in LABELS:
+            arrays[f'coords_{l}'] = self.coords[l]
+            arrays[f'offsets_{l}'] = self.offsets[l]
+        tmp = f'{path}.{os.getpid()}.tmp.npz'
+        try:
+            np.savez(tmp, **arrays)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f'Could not write foreground index to {path}: {e}')
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            meta = json.loads(str(f['meta']))
+            if meta['version'] != VERSION:
+                raise ValueError(f'{path} has version {meta["version"]}, expected {VERSION}')
+            return cls([str(s) for s in f['segs']], meta['sources'],
+                    {l: f[f'coords_{l}'] for l in LABELS},
+                    {l: f[f'offsets_{l}'] for l in LABELS},
+                    meta['max_per_label'])
+
+
+def _default_path(manifest):
+    return os.path.splitext(manifest.path)[0] + '-fg.npz'
+
+
+def load_fg_index(data_dir, path=None, max_per_label=4096, num_workers=8):
+    ''' Loads the foreground index of every segmentation in data_dir's
+    manifest, computing the cases which are missing or stale.
+    '''
+    manifest = load_manifest(data_dir)
+    path = path or _default_path(manifest)
+    records = [r for r in manifest.records if r.get('seg')]
+
+    old = None
+    try:
+        old = ForegroundIndex.load(path)
+    except (OSError, ValueError, KeyError):
+        pass
+    if old is not None and old.max_per_label != max_per_label:
+        old = None
+
+    sources = {r['seg']: r['sources'][r['seg']] for r in records}
+    coords = {}
+    missing = []
+    for r in records:
+        seg = r['seg']
+        if old is not None and old.sources.get(seg) == sources[seg]:
+            coords[seg] = old.lookup(seg)
+        else:
+            missing.append(seg)
+
+    if missing:
+        print(f'Indexing foreground of {len(missing)} cases.')
+        p = Pool(processes=num_workers)
+        for seg, c in zip(missing, p.imap(_label_coords,
+                [(s, max_per_label) for s in missing])):
+            coords[seg] = c
+        p.close()
+        p.join()
+
+    segs = [r['seg'] for r in records]
+    offsets = {l: np.cumsum([0] + [len(coords[s][l]) for s in segs]) for l in LABELS}
+    stacked = {l: np.concatenate([coords[s][l] for s in segs] or
+        [np.zeros((0, 3), dtype=np.int16)]) for l in LABELS}
+    index = ForegroundIndex(segs, sources, stacked, offsets, max_per_label)
+    if missing or old is None or old.segs != segs:
+        index.save(path)
+    return index
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the foreground index of a data directory.')
+    parser.add_argument('--data_dir', type=str, required=True, metavar='PATH',
+        help='Path to where the data is located.')
+    parser.add_argument('--path', type=str, default=None, metavar='PATH',
+        help='Where to write the index (default: next to the manifest)')
+    parser.add_argument('--max_per_label', type=int, default=4096, metavar='N',
+        help='number of voxels kept per label and case (default: 4096)')
+    parser.add_argument('--num_workers', type=int, default=8, metavar='N',
+        help='number of processes to decode with (default: 8)')
+    args = parser.parse_args()
+
+    index = load_fg_index(args.data_dir, path=args.path,
+            max_per_label=args.max_per_label, num_workers=args.num_workers)
+    print(f'{len(index)} cases indexed.')
@@ -1,12 +1,30 @@
 """
 Dice loss 3D
 """
+import functools
 
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
 
 
+def full_precision(fn):
+    ''' Runs fn outside of autocast with its floating point tensor arguments
+    in float32. The einsum reductions sum over every voxel of the batch,
+    which overflows float16 and rounds away in bfloat16.
+    '''
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        tensors = [a for a in args if torch.is_tensor(a)]
+        if not tensors:
+            return fn(*args, **kwargs)
+        args = [a.float() if torch.is_tensor(a) and a.is_floating_point() else a for a in args]
+        with torch.autocast(tensors[0].device.type, enabled=False):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+@full_precision
 def dice_score(preds, targets):
     num = 2*torch.einsum('bcijk, bcijk ->bc', [preds, targets])
     denom = torch.einsum('bcijk, bcijk -> bc', [preds, preds]) +\
@@ -19,6 +37,7 @@ class KLLoss(nn.Module):
     def __init__(self):
         super(KLLoss, self).__init__()
     
+    @full_precision
     def forward(self, mu, logvar, device):
         return -0.5*torch.mean(torch.ones(mu.size()).to(device)+logvar-torch.exp(logvar)-torch.square(mu))
     #def forward(self, mu, logvar, N):
@@ -125,6 +144,7 @@ class AvgDiceEnhanceLoss(nn.Module):
         self.device = device
         self.avgdice = AvgDiceLoss()
     
+    @full_precision
     def _enhancing_loss(self, et_prob, ce_ratio):
         ''' penalizes et predicted for voxels which are not enhancing 
         by computing the false positive rate of enhancing tumor predictions
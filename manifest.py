@@ -0,0 +1,297 @@
+'''
+Persistent index of a BraTS data directory.
+
+Every entry point used to walk the data directory and pick the modalities
+out of the filenames by substring. The manifest does that once per data
+root and stores the result in manifest.json at the root. It holds one record
+per patient with the path of each modality and segmentation. With stats=True
+(or the CLI below) each record also holds the volume shape, affine, brain
+bounding box and intensity statistics of each modality. With label_stats=True
+it holds the voxel counts of each label, which only needs the segmentations
+decoded. Dataset filters are predicates over these, see has_et and
+min_region_volume.
+
+Reloading is incremental. Each directory's mtime is recorded and only
+directories whose mtime changed are listed again. Unchanged directories
+cost one stat each, so startup doesn't rescan the tree. A file rewritten in
+place, without adding, removing or renaming anything, doesn't change its
+directory's mtime. Pass rebuild=True after doing that.
+
+To build a manifest with statistics for a data directory:
+
+    python manifest.py --data_dir /dev/shm/MICCAI_BraTS2020_TrainingData
+'''
+import os
+import json
+import hashlib
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+import nibabel as nib
+
+from volume_cache import decode, nonzero_bbox, brain_moments
+
+MODES = ['t1', 't1ce', 't2', 'flair']
+MANIFEST_NAME = 'manifest.json'
+VERSION = 2
+
+# which labels make up each clinical region
+REGIONS = {'et': [4], 'tc': [1, 4], 'wt': [1, 2, 4]}
+
+
+def region_volume(record, region):
+    return sum(record['label_counts'][str(l)] for l in REGIONS[region])
+
+
+def has_et(record):
+    return region_volume(record, 'et') > 0
+
+
+def min_region_volume(region, n):
+    ''' Predicate keeping cases whose region has at least n voxels. '''
+    def predicate(record):
+        return region_volume(record, region) >= n
+    return predicate
+
+
+def _kind(filename):
+    # returns the case prefix and which modality (or seg) filename is
+    for kind in MODES + ['seg']:
+        suffix = kind + '.nii.gz'
+        if filename.endswith(suffix):
+            return filename[:-len(suffix)].rstrip('_'), kind
+    return None, None
+
+
+def _sources(record):
+    sources = {}
+    for kind in MODES + ['seg']:
+        if record.get(kind):
+            st = os.stat(record[kind])
+            sources[record[kind]] = [st.st_mtime_ns, st.st_size]
+    return sources
+
+
+def _scan(data_dir, dirs):
+    ''' Lists every directory under data_dir, reusing the entries of dirs
+    whose mtime hasn't changed. Returns the new entries and the set of
+    directories which had to be listed.
+    '''
+    scanned = {}
+    changed = set()
+    stack = [data_dir]
+    while stack:
+        d = stack.pop()
+        mtime = os.stat(d).st_mtime_ns
+        entry = dirs.get(d)
+        if entry is None or entry['mtime'] != mtime:
+            files, subdirs = [], []
+            for e in os.scandir(d):
+                if e.is_dir():
+                    subdirs.append(e.name)
+                elif '.nii.gz' in e.name:
+                    files.append(e.name)
+            listing = {'files': sorted(files), 'subdirs': sorted(subdirs)}
+            # writing the manifest itself touches the root's mtime, only
+            # count a directory as changed if its listing did
+            if entry is None or any(entry[k] != listing[k] for k in listing):
+                entry = dict(listing, mtime=mtime)
+                changed.add(d)
+        scanned[d] = entry
+        stack += [os.path.join(d, s) for s in entry['subdirs']]
+    return scanned, changed
+
+
+def case_stats(record):
+    ''' Decodes a case and computes the statistics stored in a record. '''
+    header = nib.load(record['t1'])
+    imgs = [decode(record[m]) for m in MODES]
+    bbox = nonzero_bbox(imgs)
+    intensity = {}
+    for m, img in zip(MODES, imgs):
+        mean, std = brain_moments(img)
+        intensity[m] = {'mean': float(mean), 'std': float(std),
+                'min': float(img.min()), 'max': float(img.max())}
+    stats = {'shape': list(imgs[0].shape),
+             'affine': header.affine.tolist(),
+             'bbox': None if bbox is None else bbox.tolist(),
+             'intensity': intensity}
+    return stats
+
+
+def label_stats(record):
+    ''' Voxel counts of labels 1, 2 and 4 in a case's segmentation. '''
+    counts = np.bincount(decode(record['seg'], seg=True).ravel(), minlength=5)
+    return {str(l): int(counts[l]) for l in [1, 2, 4]}
+
+
+def _default_path(data_dir):
+    # next to the data if possible. shared read-only data gets a per-user
+    # manifest keyed by the data directory instead.
+    if os.access(data_dir, os.W_OK):
+        return os.path.join(data_dir, MANIFEST_NAME)
+    cache = os.path.join(os.path.expanduser('~'), '.cache', 'gliomaseg')
+    os.makedirs(cache, exist_ok=True)
+    key = hashlib.sha1(data_dir.encode()).hexdigest()[:16]
+    return os.path.join(cache, f'manifest-{key}.json')
+
+
+class Manifest(object):
+    def __init__(self, data_dir, records, dirs, path):
+        self.data_dir = data_dir
+        self.records = records
+        self.dirs = dirs
+        self.path = path
+
+    def __len__(self):
+        return len(self.records)
+
+    def cases(self, seg=False):
+        ''' Returns a (t1, t1ce, t2, flair[, seg]) tuple for every record,
+        in the order the old sorted-and-zipped file lists produced. With
+        seg=True records without a segmentation are left out.
+        '''
+        kinds = MODES + ['seg'] if seg else MODES
+        return [tuple(r[k] for k in kinds) for r in self.records
+                if not seg or r.get('seg')]
+
+    def modes(self):
+        return [[r[m] for r in self.records] for m in MODES]
+
+    def segs(self):
+        return [r['seg'] for r in self.records if r.get('seg')]
+
+    def record(self, path):
+        ''' Returns the record holding path, or None. '''
+        if not hasattr(self, '_by_path'):
+            self._by_path = {r[k]: r for r in self.records
+                    for k in MODES + ['seg'] if r.get(k)}
+        return self._by_path.get(os.path.abspath(path))
+
+    def filter(self, paths, predicates):
+        ''' Returns the indices of paths whose records satisfy every
+        predicate. Paths without a record, e.g. from outside the data
+        directory, are kept.
+        '''
+        keep = []
+        for i, path in enumerate(paths):
+            r = self.record(path)
+            if r is None or all(p(r) for p in predicates):
+                keep.append(i)
+        return keep
+
+    def _compute(self, key, fn, records, num_workers):
+        missing = [r for r in records if key not in r]
+        if not missing:
+            return False
+        print(f'Computing {key} for {len(missing)} cases.')
+        p = Pool(processes=num_workers)
+        for r, value in zip(missing, p.imap(fn, missing)):
+            r[key] = value
+        p.close()
+        p.join()
+        return True
+
+    def compute_stats(self, num_workers=8):
+        ''' Fills in the image statistics of records which don't have them. '''
+        return self._compute('stats', case_stats, self.records, num_workers)
+
+    def compute_label_stats(self, num_workers=8):
+        ''' Fills in the label counts of records which don't have them.
+        Only the segmentations are decoded.
+        '''
+        records = [r for r in self.records if r.get('seg')]
+        return self._compute('label_counts', label_stats, records, num_workers)
+
+    def save(self):
+        state = {'version': VERSION, 'data_dir': self.data_dir,
+                'dirs': self.dirs, 'records': self.records}
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f'Could not write manifest to {self.path}: {e}')
+
+
+def load_manifest(data_dir, path=None, stats=False, label_stats=False,
+        rebuild=False, num_workers=8):
+    ''' Loads the manifest of data_dir and brings it up to date. path
+    defaults to manifest.json in data_dir, or a per-user cache if data_dir
+    isn't writable. With stats=True image statistics and label counts are
+    computed for every record that lacks them, with label_stats=True only
+    the label counts are.
+    '''
+    data_dir = os.path.abspath(data_dir)
+    path = path or _default_path(data_dir)
+
+    old = {'dirs': {}, 'records': []}
+    if not rebuild:
+        try:
+            with open(path) as f:
+                state = json.load(f)
+            if state.get('version') == VERSION and state.get('data_dir') == data_dir:
+                old = state
+        except (OSError, ValueError):
+            pass
+
+    dirs, changed = _scan(data_dir, old['dirs'])
+    dirty = bool(changed) or set(dirs) != set(old['dirs'])
+
+    if dirty:
+        old_records = {r['id']: r for r in old['records']}
+        grouped = {}
+        for d, entry in dirs.items():
+            for f in entry['files']:
+                prefix, kind = _kind(f)
+                if kind is None:
+                    continue
+                case = os.path.join(d, prefix)
+                grouped.setdefault(case, {'id': case})[kind] = os.path.join(d, f)
+
+        records = []
+        for case, record in grouped.items():
+            if not all(m in record for m in MODES):
+                continue
+            record['patient'] = os.path.basename(case) or os.path.basename(os.path.dirname(case))
+            prev = old_records.get(case)
+            if os.path.dirname(case) not in changed and prev is not None:
+                record = prev
+            else:
+                record['sources'] = _sources(record)
+                if prev is not None and prev.get('sources') == record['sources']:
+                    for key in ['stats', 'label_counts']:
+                        if key in prev:
+                            record[key] = prev[key]
+            records.append(record)
+        records.sort(key=lambda r: r['t1'])
+    else:
+        records = old['records']
+
+    manifest = Manifest(data_dir, records, dirs, path)
+    if stats or label_stats:
+        dirty = manifest.compute_label_stats(num_workers) or dirty
+    if stats:
+        dirty = manifest.compute_stats(num_workers) or dirty
+    if dirty:
+        manifest.save()
+    return manifest
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the manifest of a data directory.')
+    parser.add_argument('--data_dir', type=str, required=True, metavar='PATH',
+        help='Path to where the data is located.')
+    parser.add_argument('--path', type=str, default=None, metavar='PATH',
+        help='Where to write the manifest (default: DATA_DIR/manifest.json if writable)')
+    parser.add_argument('--rebuild', action='store_true',
+        help='ignore any existing manifest (default: off)')
+    parser.add_argument('--num_workers', type=int, default=8, metavar='N',
+        help='number of processes to compute statistics with (default: 8)')
+    args = parser.parse_args()
+
+    manifest = load_manifest(args.data_dir, path=args.path, stats=True,
+            rebuild=args.rebuild, num_workers=args.num_workers)
+    print(f'{len(manifest)} cases in {manifest.path}')
@@ -4,7 +4,7 @@ import torch.nn as nn
 from models.model_utils import *
 
 
-class CoarseEncoder(nn.Module):
+class CoarseEncoder(CheckpointedModule):
     def __init__(self, input_channels=4):
         super(CoarseEncoder, self).__init__()
         self.initLayer = nn.Conv3d(input_channels, 16,
@@ -24,22 +24,34 @@ class CoarseEncoder(nn.Module):
         self.block8 = ResNetBlock(128)
         self.block9 = ResNetBlock(128)
 
-    def forward(self, x):
-        # sp* is the state of the output at each spatial level
+    def _level1(self, x):
         sp0 = self.dropout(self.initLayer(x))
-        sp1 = self.block0(sp0)
-        sp1 = self.block1(sp0)
+        sp1 = self.block(self.block0, sp0)
+        return self.block(self.block1, sp0)
+
+    def _level2(self, sp1):
         sp2 = self.ds1(sp1)
-        sp2 = self.block2(sp2)
-        sp2 = self.block3(sp2)
+        sp2 = self.block(self.block2, sp2)
+        return self.block(self.block3, sp2)
+
+    def _level3(self, sp2):
         sp3 = self.ds2(sp2)
-        sp3 = self.block4(sp3)
-        sp3 = self.block5(sp3)
+        sp3 = self.block(self.block4, sp3)
+        return self.block(self.block5, sp3)
+
+    def _level4(self, sp3):
         sp4 = self.ds3(sp3)
-        sp4 = self.block6(sp4)
-        sp4 = self.block7(sp4)
-        sp4 = self.block8(sp4)
-        sp4 = self.block9(sp4)
+        sp4 = self.block(self.block6, sp4)
+        sp4 = self.block(self.block7, sp4)
+        sp4 = self.block(self.block8, sp4)
+        return self.block(self.block9, sp4)
+
+    def forward(self, x):
+        # sp* is the state of the output at each spatial level
+        sp1 = self.level(self._level1, x)
+        sp2 = self.level(self._level2, sp1)
+        sp3 = self.level(self._level3, sp2)
+        sp4 = self.level(self._level4, sp3)
 
         return {
             'spatial_level_4': sp4, 'spatial_level_3': sp3,
@@ -47,7 +59,7 @@ class CoarseEncoder(nn.Module):
         }
 
 
-class CoarseDecoder(nn.Module):
+class CoarseDecoder(CheckpointedModule):
     def __init__(self, output_channels=3):
         super(CoarseDecoder, self).__init__()
         self.block9 = ResNetBlock(64)
@@ -61,18 +73,24 @@ class CoarseDecoder(nn.Module):
         self.cf_final = CompressFeatures(16, output_channels)
         self.sig = nn.Sigmoid()
 
+    def _level3(self, skip, sp4):
+        return self.block(self.block9, skip + self.up1(sp4))
+
+    def _level2(self, skip, sp3):
+        return self.block(self.block11, skip + self.up2(sp3))
+
+    def _level1(self, skip, sp2):
+        sp1 = self.block(self.block13, skip + self.up3(sp2))
+        return self.cf_final(sp1)
+
     def forward(self, x):
-        sp3 = x['spatial_level_3'] + self.up1(x['spatial_level_4'])
-        sp3 = self.block9(sp3)
-        sp2 = x['spatial_level_2'] + self.up2(sp3)
-        sp2 = self.block11(sp2)
-        sp1 = x['spatial_level_1'] + self.up3(sp2)
-        sp1 = self.block13(sp1)
-        output = self.sig(self.cf_final(sp1))
+        sp3 = self.level(self._level3, x['spatial_level_3'], x['spatial_level_4'])
+        sp2 = self.level(self._level2, x['spatial_level_2'], sp3)
+        output = self.sig(self.level(self._level1, x['spatial_level_1'], sp2))
         return output
 
 
-class Encoder(nn.Module):
+class Encoder(CheckpointedModule):
     def __init__(self, input_channels=4):
         super(Encoder, self).__init__()
         self.initLayer = nn.Conv3d(input_channels, 32,
@@ -93,22 +111,34 @@ class Encoder(nn.Module):
         self.block8 = ResNetBlock(256)
         self.block9 = ResNetBlock(256)
 
-    def forward(self, x):
-        # sp* is the state of the output at each spatial level
+    def _level1(self, x):
         sp0 = self.dropout(self.initLayer(x))
-        sp1 = self.block0(sp0)
-        sp1 = self.block1(sp0)
+        sp1 = self.block(self.block0, sp0)
+        return self.block(self.block1, sp0)
+
+    def _level2(self, sp1):
         sp2 = self.ds1(sp1)
-        sp2 = self.block2(sp2)
-        sp2 = self.block3(sp2)
+        sp2 = self.block(self.block2, sp2)
+        return self.block(self.block3, sp2)
+
+    def _level3(self, sp2):
         sp3 = self.ds2(sp2)
-        sp3 = self.block4(sp3)
-        sp3 = self.block5(sp3)
+        sp3 = self.block(self.block4, sp3)
+        return self.block(self.block5, sp3)
+
+    def _level4(self, sp3):
         sp4 = self.ds3(sp3)
-        sp4 = self.block6(sp4)
-        sp4 = self.block7(sp4)
-        sp4 = self.block8(sp4)
-        sp4 = self.block9(sp4)
+        sp4 = self.block(self.block6, sp4)
+        sp4 = self.block(self.block7, sp4)
+        sp4 = self.block(self.block8, sp4)
+        return self.block(self.block9, sp4)
+
+    def forward(self, x):
+        # sp* is the state of the output at each spatial level
+        sp1 = self.level(self._level1, x)
+        sp2 = self.level(self._level2, sp1)
+        sp3 = self.level(self._level3, sp2)
+        sp4 = self.level(self._level4, sp3)
 
         return {
             'spatial_level_4': sp4, 'spatial_level_3': sp3,
@@ -116,7 +146,7 @@ class Encoder(nn.Module):
         }
 
 
-class BilineDecoder(nn.Module):
+class BilineDecoder(CheckpointedModule):
     def __init__(self, output_channels=3):
         super(BilineDecoder, self).__init__()
         self.cf1 = CompressFeatures(256, 128)
@@ -130,19 +160,25 @@ class BilineDecoder(nn.Module):
         self.up = nn.Upsample(scale_factor=2, mode='nearest')
         self.sig = nn.Sigmoid()
 
+    def _level3(self, skip, sp4):
+        return self.block(self.block9, skip + self.up(self.cf1(sp4)))
+
+    def _level2(self, skip, sp3):
+        return self.block(self.block11, skip + self.up(self.cf2(sp3)))
+
+    def _level1(self, skip, sp2):
+        sp1 = self.block(self.block13, skip + self.up(self.cf3(sp2)))
+        return self.cf_final(sp1)
+
     def forward(self, x):
-        sp3 = x['spatial_level_3'] + self.up(self.cf1(x['spatial_level_4']))
-        sp3 = self.block9(sp3)
-        sp2 = x['spatial_level_2'] + self.up(self.cf2(sp3))
-        sp2 = self.block11(sp2)
-        sp1 = x['spatial_level_1'] + self.up(self.cf3(sp2))
-        sp1 = self.block13(sp1)
-        output = self.sig(self.cf_final(sp1))
+        sp3 = self.level(self._level3, x['spatial_level_3'], x['spatial_level_4'])
+        sp2 = self.level(self._level2, x['spatial_level_2'], sp3)
+        output = self.sig(self.level(self._level1, x['spatial_level_1'], sp2))
 
         return output
 
 
-class DeconvDecoder(nn.Module):
+class DeconvDecoder(CheckpointedModule):
     def __init__(self, output_channels=3):
         super(DeconvDecoder, self).__init__()
         self.block9 = ResNetBlock(128)
@@ -156,14 +192,20 @@ class DeconvDecoder(nn.Module):
 
         self.sig = nn.Sigmoid()
 
+    def _level3(self, skip, sp4):
+        return self.block(self.block9, skip + self.up43(sp4))
+
+    def _level2(self, skip, sp3):
+        return self.block(self.block11, skip + self.up32(sp3))
+
+    def _level1(self, skip, sp2):
+        sp1 = self.block(self.block13, skip + self.up21(sp2))
+        return self.cf_final(sp1)
+
     def forward(self, x):
-        sp3 = x['spatial_level_3'] + self.up43(x['spatial_level_4'])
-        sp3 = self.block9(sp3)
-        sp2 = x['spatial_level_2'] + self.up32(sp3)
-        sp2 = self.block11(sp2)
-        sp1 = x['spatial_level_1'] + self.up21(sp2)
-        sp1 = self.block13(sp1)
-        logits = self.cf_final(sp1)
+        sp3 = self.level(self._level3, x['spatial_level_3'], x['spatial_level_4'])
+        sp2 = self.level(self._level2, x['spatial_level_2'], sp3)
+        logits = self.level(self._level1, x['spatial_level_1'], sp2)
         output = self.sig(logits)
 
         return output, logits
@@ -68,10 +68,11 @@ class Decoder(nn.Module):
      
 
 class LeaNet(nn.Module):
-    def __init__(self):
+    def __init__(self, fused=False):
         super(LeaNet, self).__init__()
         self.encoder = Encoder()
         self.decoder = Decoder()
+        set_fused_norm(self, fused)
 
     def forward(self, x):
         x = self.encoder(x)
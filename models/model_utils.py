@@ -2,6 +2,8 @@ import os
 import random
 import torch
 import torch.nn as nn
+import torch.utils.checkpoint
+import torch.nn.functional as F
 
 
 def model_average(model_dir, model, device, sample_proportion=0.33, sample_rate=0.5):
@@ -178,6 +180,51 @@ def _set_momenta(module, momenta):
 # ebn bn_updata
 
 
+# Activation checkpointing. 'block' recomputes each ResNetBlock in the
+# backward pass, keeping only its input. 'level' does the same for each
+# spatial level of an encoder or decoder, keeping only the level's inputs
+# and its output, which the skip connections need anyway.
+CHECKPOINT_MODES = ['none', 'block', 'level']
+
+
+def checkpointed(fn, *inputs):
+    ''' fn(*inputs) without keeping fn's activations for backward. '''
+    if not torch.is_grad_enabled():
+        return fn(*inputs)
+    # the reentrant variant drops the gradients of fn's parameters when
+    # no input requires grad, as the images going into an encoder don't
+    return torch.utils.checkpoint.checkpoint(fn, *inputs, use_reentrant=False)
+
+
+class CheckpointedModule(nn.Module):
+    ''' An encoder or decoder which runs its spatial levels through level
+    and its ResNetBlocks through block so they can be checkpointed.
+    '''
+    checkpoint_mode = 'none'
+
+    def level(self, fn, *inputs):
+        if self.checkpoint_mode == 'level':
+            return checkpointed(fn, *inputs)
+        return fn(*inputs)
+
+    def block(self, block, x):
+        if self.checkpoint_mode == 'block':
+            return checkpointed(block, x)
+        return block(x)
+
+
+def set_checkpoint(model, mode):
+    ''' Sets the checkpointing of every encoder and decoder of model to
+    mode, one of CHECKPOINT_MODES.
+    '''
+    if mode not in CHECKPOINT_MODES:
+        raise ValueError(f'checkpoint mode must be one of {CHECKPOINT_MODES}, got {mode}')
+    for module in model.modules():
+        if isinstance(module, CheckpointedModule):
+            module.checkpoint_mode = mode
+    return model
+
+
 # I don't love the next two classes. They're just thin wrappers over nn.Con3d.
 class Downsample(nn.Module):
     # downsample by 2; simultaneously increase feature size by 2
@@ -222,9 +269,176 @@ class UpsamplingDeconv3d(nn.Module):
         return self.deconv(x)
 
 
-class ResNetBlockWithDropout(nn.Module):
-    def __init__(self, channels, num_groups=8):
+def _autocast_state(device_type):
+    if device_type == 'cuda':
+        return torch.is_autocast_enabled(), torch.get_autocast_gpu_dtype()
+    return torch.is_autocast_cpu_enabled(), torch.get_autocast_cpu_dtype()
+
+
+# Fused norm, ReLU and convolution. Unfused, autograd keeps both the input
+# of the norm and the activated input of the convolution. norm_relu_conv
+# keeps only the norm's input and its per group statistics and recomputes
+# the activation in backward, which is elementwise and cheap next to the
+# convolution. The norm, its affine transform and the ReLU are one
+# addcmul and an in-place clamp.
+def _acc_dtype(x):
+    ''' float32, or float64 for float64 x. '''
+    return torch.promote_types(x.dtype, torch.float32)
+
+
+def _group_stats(x, num_groups, eps):
+    xg = x.reshape(x.shape[0], num_groups, -1).to(_acc_dtype(x))
+    var, mean = torch.var_mean(xg, dim=2, unbiased=False)
+    return mean, torch.rsqrt(var + eps)
+
+
+def _scale_shift(mean, rstd, weight, bias, channels):
+    ''' The per channel scale and shift the norm and affine transform
+    amount to, shaped to broadcast over N x C x H x W x D.
+    '''
+    repeats = channels // mean.shape[1]
+    mean = mean.repeat_interleave(repeats, 1)
+    scale = rstd.repeat_interleave(repeats, 1)
+    if weight is not None:
+        scale = scale * weight.to(scale.dtype)
+    shift = -mean * scale
+    if bias is not None:
+        shift = shift + bias.to(shift.dtype)
+    shape = (*scale.shape, 1, 1, 1)
+    return scale.view(shape), shift.view(shape)
+
+
+class _NormReLUConv(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, x, weight, bias, conv_weight, conv_bias, mask, num_groups, eps, conv):
+        device_type = x.device.type
+        enabled, dtype = _autocast_state(device_type)
+        # the convolution runs in the autocast dtype, the norm in float32
+        # as autocast would run it
+        dtype = dtype if enabled else x.dtype
+        with torch.autocast(device_type, enabled=False):
+            mean, rstd = _group_stats(x, num_groups, eps)
+            scale, shift = _scale_shift(mean, rstd, weight, bias, x.shape[1])
+            a = torch.addcmul(shift, x.to(shift.dtype), scale).clamp_(min=0)
+            if mask is not None:
+                a.mul_(mask)
+            a = a.to(dtype)
+            out = F.conv3d(a, conv_weight.to(dtype),
+                    None if conv_bias is None else conv_bias.to(dtype),
+                    conv.stride, conv.padding, conv.dilation, conv.groups)
+        ctx.save_for_backward(x, mean, rstd, weight, bias, conv_weight, mask)
+        ctx.num_groups, ctx.conv, ctx.dtype = num_groups, conv, dtype
+        ctx.has_conv_bias = conv_bias is not None
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        x, mean, rstd, weight, bias, conv_weight, mask = ctx.saved_tensors
+        conv = ctx.conv
+        needs = ctx.needs_input_grad
+        n, c = x.shape[:2]
+        with torch.autocast(x.device.type, enabled=False):
+            scale, shift = _scale_shift(mean, rstd, weight, bias, c)
+            y = torch.addcmul(shift, x.to(shift.dtype), scale)
+            a = y.clamp(min=0)
+            if mask is not None:
+                a.mul_(mask)
+            grad_a, grad_cw, grad_cb = torch.ops.aten.convolution_backward(
+                    grad_out.to(ctx.dtype), a.to(ctx.dtype), conv_weight.to(ctx.dtype),
+                    [conv_weight.shape[0]] if ctx.has_conv_bias else None,
+                    conv.stride, conv.padding, conv.dilation, False, [0, 0, 0], conv.groups,
+                    [True, needs[3], ctx.has_conv_bias and needs[4]])
+            del a
+            if grad_cw is not None:
+                grad_cw = grad_cw.to(conv_weight.dtype)
+            if grad_cb is not None:
+                grad_cb = grad_cb.to(conv_weight.dtype)
+
+            # back through the dropout, the ReLU and the affine transform
+            grad_y = grad_a.to(y.dtype)
+            del grad_a
+            if mask is not None:
+                grad_y.mul_(mask)
+            grad_y.masked_fill_(y <= 0, 0)
+            del y
+            xhat = (x.reshape(n, ctx.num_groups, -1).to(mean.dtype) - mean.unsqueeze(2)) * rstd.unsqueeze(2)
+            xhat = xhat.view(x.shape)
+            grad_w = grad_b = None
+            if weight is not None and needs[1]:
+                grad_w = (grad_y * xhat).sum((0, 2, 3, 4)).to(weight.dtype)
+            if bias is not None and needs[2]:
+                grad_b = grad_y.sum((0, 2, 3, 4)).to(bias.dtype)
+            if weight is not None:
+                grad_y.mul_(weight.to(mean.dtype).view(1, c, 1, 1, 1))
+
+            # and through (x - mean) * rstd within each group
+            g = grad_y.view(n, ctx.num_groups, -1)
+            xhat = xhat.view(n, ctx.num_groups, -1)
+            grad_x = g - g.mean(2, keepdim=True) - xhat * (g * xhat).mean(2, keepdim=True)
+            grad_x = (grad_x * rstd.unsqueeze(2)).view(x.shape).to(x.dtype)
+        return grad_x, grad_w, grad_b, grad_cw, grad_cb, None, None, None, None
+
+
+def norm_relu_conv(x, norm, conv, p=0.):
+    ''' conv(dropout(relu(norm(x)))) for a GroupNorm or InstanceNorm3d norm
+    and Dropout3d of probability p, see _NormReLUConv.
+    '''
+    if isinstance(norm, nn.GroupNorm):
+        num_groups = norm.num_groups
+    else:
+        # InstanceNorm3d without running stats is a GroupNorm of a group
+        # per channel
+        assert not norm.track_running_stats, 'instance norm with running stats cannot be fused'
+        num_groups = norm.num_features
+    mask = None
+    if p > 0:
+        # Dropout3d drops whole channels, the mask is N x C
+        mask = x.new_empty((*x.shape[:2], 1, 1, 1), dtype=_acc_dtype(x)).bernoulli_(1 - p).div_(1 - p)
+    return _NormReLUConv.apply(x, norm.weight, norm.bias, conv.weight, conv.bias, mask,
+            num_groups, norm.eps, conv)
+
+
+def fused_feats(feats, x):
+    ''' Runs feats, a Sequential of norm, ReLU, optional Dropout3d and
+    Conv3d units, with each unit through norm_relu_conv.
+    '''
+    layers = list(feats)
+    i = 0
+    while i < len(layers):
+        norm, j = layers[i], i + 2
+        p = 0.
+        if isinstance(layers[j], nn.Dropout3d):
+            p = layers[j].p if layers[j].training else 0.
+            j += 1
+        x = norm_relu_conv(x, norm, layers[j], p)
+        i = j + 1
+    return x
+
+
+class FusableBlock(nn.Module):
+    ''' A residual block whose feats can run through fused_feats. '''
+    fused = False
+
+    def features(self, x):
+        if self.fused:
+            return fused_feats(self.feats, x)
+        return self.feats(x)
+
+
+def set_fused_norm(model, fused=True):
+    ''' Switches the norm, ReLU and convolution units of every residual
+    block of model to norm_relu_conv, or back. The parameters are the same.
+    '''
+    for module in model.modules():
+        if isinstance(module, FusableBlock):
+            module.fused = fused
+    return model
+
+
+class ResNetBlockWithDropout(FusableBlock):
+    def __init__(self, channels, num_groups=8, fused=False):
         super(ResNetBlockWithDropout, self).__init__()
+        self.fused = fused
         self.feats = nn.Sequential(nn.GroupNorm(num_groups, channels),
             nn.ReLU(inplace=True),
             nn.Dropout3d(),
@@ -238,40 +452,140 @@ class ResNetBlockWithDropout(nn.Module):
 
     def forward(self, x):
         residual = x
-        out = self.feats(x)
+        out = self.features(x)
         out += residual
         return out
 
 
-class ResNetBlock(nn.Module):
-    def __init__(self, channels, num_groups=8, instance_norm=False):
+def residual_feats(channels, num_groups=8, instance_norm=False):
+    ''' The norm, relu, conv, norm, relu, conv branch of a ResNetBlock. '''
+    if instance_norm:
+        return nn.Sequential(nn.InstanceNorm3d(channels),
+            nn.ReLU(inplace=True),
+            nn.Conv3d(channels, channels, 
+                kernel_size=3, stride=1, padding=1),
+            nn.InstanceNorm3d(channels),
+            nn.ReLU(inplace=True),
+            nn.Conv3d(channels, channels, 
+                kernel_size=3, stride=1, padding=1))
+    return nn.Sequential(nn.GroupNorm(num_groups, channels),
+        nn.ReLU(inplace=True),
+        nn.Conv3d(channels, channels, 
+            kernel_size=3, stride=1, padding=1),
+        nn.GroupNorm(num_groups, channels),
+        nn.ReLU(inplace=True),
+        nn.Conv3d(channels, channels, 
+            kernel_size=3, stride=1, padding=1))
+
+
+class ResNetBlock(FusableBlock):
+    def __init__(self, channels, num_groups=8, instance_norm=False, fused=False):
         super(ResNetBlock, self).__init__()
-        if instance_norm:
-            self.feats = nn.Sequential(nn.InstanceNorm3d(channels),
-                nn.ReLU(inplace=True),
-                nn.Conv3d(channels, channels, 
-                    kernel_size=3, stride=1, padding=1),
-                nn.InstanceNorm3d(channels),
-                nn.ReLU(inplace=True),
-                nn.Conv3d(channels, channels, 
-                    kernel_size=3, stride=1, padding=1))
-        else:
-            self.feats = nn.Sequential(nn.GroupNorm(num_groups, channels),
-                nn.ReLU(inplace=True),
-                nn.Conv3d(channels, channels, 
-                    kernel_size=3, stride=1, padding=1),
-                nn.GroupNorm(num_groups, channels),
-                nn.ReLU(inplace=True),
-                nn.Conv3d(channels, channels, 
-                    kernel_size=3, stride=1, padding=1))
+        self.fused = fused
+        self.feats = residual_feats(channels, num_groups, instance_norm)
 
     def forward(self, x):
         residual = x
-        out = self.feats(x)
+        out = self.features(x)
         out += residual
         return out
 
 
+class ReversibleBlock(nn.Module):
+    ''' A ResNetBlock with additive coupling over the two halves of the
+    channels, as in RevNet,
+
+        y1 = x1 + f(x2)
+        y2 = x2 + g(y1)
+
+    where f and g are the residual branches of a ResNetBlock of half the
+    channels. The input is recomputed from the output in backward_pass, so
+    in a ReversibleSequence no activations of the block are kept. f and g
+    must be deterministic, there's no dropout.
+    '''
+    def __init__(self, channels, num_groups=8, instance_norm=False):
+        super(ReversibleBlock, self).__init__()
+        self.f = residual_feats(channels // 2, num_groups, instance_norm)
+        self.g = residual_feats(channels // 2, num_groups, instance_norm)
+
+    def forward(self, x):
+        x1, x2 = torch.chunk(x, 2, dim=1)
+        y1 = x1 + self.f(x2)
+        y2 = x2 + self.g(y1)
+        return torch.cat((y1, y2), 1)
+
+    def inverse(self, y):
+        y1, y2 = torch.chunk(y, 2, dim=1)
+        x2 = y2 - self.g(y1)
+        x1 = y1 - self.f(x2)
+        return torch.cat((x1, x2), 1)
+
+    def backward_pass(self, y, dy):
+        ''' Returns the input of the block and its gradient given the output
+        and its gradient, accumulating the gradients of f and g.
+        '''
+        y1, y2 = torch.chunk(y, 2, dim=1)
+        dy1, dy2 = torch.chunk(dy, 2, dim=1)
+        with torch.enable_grad():
+            y1 = y1.detach().requires_grad_()
+            gy1 = self.g(y1)
+            gy1.backward(dy2.to(gy1.dtype))
+        with torch.no_grad():
+            x2 = y2 - gy1
+            dx1 = dy1 + y1.grad
+        with torch.enable_grad():
+            x2 = x2.detach().requires_grad_()
+            fx2 = self.f(x2)
+            fx2.backward(dx1.to(fx2.dtype))
+        with torch.no_grad():
+            x1 = y1 - fx2
+            dx2 = dy2 + x2.grad
+            return torch.cat((x1, x2), 1), torch.cat((dx1, dx2), 1)
+
+
+class _ReversibleFunction(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, x, blocks, *params):
+        ctx.blocks = blocks
+        ctx.device_type = x.device.type
+        ctx.autocast = _autocast_state(ctx.device_type)
+        for block in blocks:
+            x = block(x)
+        # only the output is kept, the blocks' inputs are recomputed from it
+        ctx.save_for_backward(x)
+        return x
+
+    @staticmethod
+    def backward(ctx, dy):
+        y, = ctx.saved_tensors
+        enabled, dtype = ctx.autocast
+        # f and g are recomputed with the precision of the forward pass
+        with torch.autocast(ctx.device_type, dtype=dtype, enabled=enabled):
+            for block in reversed(ctx.blocks):
+                y, dy = block.backward_pass(y, dy)
+        # the blocks' parameters got their gradients in backward_pass
+        return (dy, None) + (None,) * len(ctx.needs_input_grad[2:])
+
+
+class ReversibleSequence(nn.Module):
+    ''' ReversibleBlocks run one after the other, keeping only the output of
+    the last for backward. Activation memory doesn't grow with the number
+    of blocks.
+    '''
+    def __init__(self, blocks):
+        super(ReversibleSequence, self).__init__()
+        self.blocks = nn.ModuleList(blocks)
+
+    def forward(self, x):
+        if not torch.is_grad_enabled():
+            for block in self.blocks:
+                x = block(x)
+            return x
+        # the parameters are passed so the output requires grad, and
+        # backward runs, even when x doesn't
+        return _ReversibleFunction.apply(x, self.blocks, *self.parameters())
+
+
 # TODO
 #class MultiResNetBlock(nn.Module):
 #    def __init__(self, channels, num_groups=8):
@@ -5,41 +5,73 @@ from .model_utils import *
 from .cascade_net import DeconvDecoder
 
 
-class Encoder(nn.Module):
-    def __init__(self, input_channels=4, instance_norm=False):
+class Encoder(CheckpointedModule):
+    ''' With reversible, each spatial level's ResNetBlocks are replaced by a
+    ReversibleSequence of depths[level] ReversibleBlocks, whose activation
+    memory doesn't grow with depth. Its parameters don't load from a
+    checkpoint of the ResNetBlock encoder.
+    '''
+    def __init__(self, input_channels=4, instance_norm=False, reversible=False, depths=(1, 2, 2, 4)):
         super(Encoder, self).__init__()
+        self.reversible = reversible
         self.dropout = nn.Dropout3d(p=0.2)
         self.sig = nn.Sigmoid()
         self.initLayer = nn.Conv3d(input_channels, 32, 
                 kernel_size=3, stride=1, padding=1)
-        self.block0 = ResNetBlock(32, instance_norm=instance_norm)
         self.ds1 = Downsample(32)
+        self.ds2 = Downsample(64)
+        self.ds3 = Downsample(128)
+        if reversible:
+            self.rev1, self.rev2, self.rev3, self.rev4 = [
+                    ReversibleSequence([ReversibleBlock(c, instance_norm=instance_norm)
+                        for _ in range(depth)])
+                    for c, depth in zip([32, 64, 128, 256], depths)]
+            return
+        self.block0 = ResNetBlock(32, instance_norm=instance_norm)
         self.block1 = ResNetBlock(64, instance_norm=instance_norm)
         self.block2 = ResNetBlock(64, instance_norm=instance_norm) 
-        self.ds2 = Downsample(64)
         self.block3 = ResNetBlock(128, instance_norm=instance_norm) 
         self.block4 = ResNetBlock(128, instance_norm=instance_norm) 
-        self.ds3 = Downsample(128)
         self.block5 = ResNetBlock(256, instance_norm=instance_norm) 
         self.block6 = ResNetBlock(256, instance_norm=instance_norm) 
         self.block7 = ResNetBlock(256, instance_norm=instance_norm) 
         self.block8 = ResNetBlock(256, instance_norm=instance_norm)
 
-    def forward(self, x):
-        # sp* is the state of the output at each spatial level
+    def _level1(self, x):
         sp0 = self.dropout(self.initLayer(x))
-        sp1 = self.block0(sp0)
+        if self.reversible:
+            return self.rev1(sp0)
+        return self.block(self.block0, sp0)
+
+    def _level2(self, sp1):
         sp2 = self.ds1(sp1)
-        sp2 = self.block1(sp2)
-        sp2 = self.block2(sp2)
+        if self.reversible:
+            return self.rev2(sp2)
+        sp2 = self.block(self.block1, sp2)
+        return self.block(self.block2, sp2)
+
+    def _level3(self, sp2):
         sp3 = self.ds2(sp2)
-        sp3 = self.block3(sp3)
-        sp3 = self.block4(sp3)
+        if self.reversible:
+            return self.rev3(sp3)
+        sp3 = self.block(self.block3, sp3)
+        return self.block(self.block4, sp3)
+
+    def _level4(self, sp3):
         sp4 = self.ds3(sp3)
-        sp4 = self.block5(sp4)
-        sp4 = self.block6(sp4)
-        sp4 = self.block7(sp4)
-        sp4 = self.block8(sp4)
+        if self.reversible:
+            return self.rev4(sp4)
+        sp4 = self.block(self.block5, sp4)
+        sp4 = self.block(self.block6, sp4)
+        sp4 = self.block(self.block7, sp4)
+        return self.block(self.block8, sp4)
+
+    def forward(self, x):
+        # sp* is the state of the output at each spatial level
+        sp1 = self.level(self._level1, x)
+        sp2 = self.level(self._level2, sp1)
+        sp3 = self.level(self._level3, sp2)
+        sp4 = self.level(self._level4, sp3)
 
         return {
                 'spatial_level_4':sp4, 'spatial_level_3':sp3, 
@@ -48,7 +80,7 @@ class Encoder(nn.Module):
 
 # Decoder with extra blocks whioh aren't used. If the model doesn't match
 # the parameters probably this needs to be used.
-class Decoder(nn.Module):
+class Decoder(CheckpointedModule):
     def __init__(self, output_channels=3, instance_norm=False):
         super(Decoder, self).__init__()
         self.cf1 = CompressFeatures(256, 128)
@@ -65,21 +97,29 @@ class Decoder(nn.Module):
         #self.up = nn.Upsample(scale_factor=2, mode='nearest')
         self.sig = nn.Sigmoid()
 
-    def forward(self, x):
-        #print(x['spatial_level_4'].size(),x['spatial_level_3'].size())
-        sp3 = x['spatial_level_3'] + self.up(self.cf1(x['spatial_level_4']))
-
-        #print(x['spatial_level_3'].size(),x['spatial_level_2'].size())
-        sp3 = self.block9(sp3)
+    def _level3(self, skip, sp4):
+        sp3 = skip + self.up(self.cf1(sp4))
+        sp3 = self.block(self.block9, sp3)
         #sp3 = self.block10(sp3)
-        sp2 = x['spatial_level_2'] + self.up(self.cf2(sp3))
+        return sp3
 
-        sp2 = self.block11(sp2)
+    def _level2(self, skip, sp3):
+        sp2 = skip + self.up(self.cf2(sp3))
+        sp2 = self.block(self.block11, sp2)
         #sp2 = self.block12(sp2)
-        sp1 = x['spatial_level_1'] + self.up(self.cf3(sp2))
-        sp1 = self.block13(sp1)
+        return sp2
+
+    def _level1(self, skip, sp2):
+        sp1 = skip + self.up(self.cf3(sp2))
+        sp1 = self.block(self.block13, sp1)
         #sp1 = self.block14(sp1)
-        logits = self.cf_final(sp1)
+        return self.cf_final(sp1)
+
+    def forward(self, x):
+        #print(x['spatial_level_4'].size(),x['spatial_level_3'].size())
+        sp3 = self.level(self._level3, x['spatial_level_3'], x['spatial_level_4'])
+        sp2 = self.level(self._level2, x['spatial_level_2'], sp3)
+        logits = self.level(self._level1, x['spatial_level_1'], sp2)
         return self.sig(logits), logits
      
 #class Decoder(nn.Module):
@@ -108,9 +148,11 @@ class Decoder(nn.Module):
 
 
 class MonoUNet(nn.Module):
-    def __init__(self, input_channels=4, upsampling='bilinear', instance_norm=False):
+    def __init__(self, input_channels=4, upsampling='bilinear', instance_norm=False,
+            reversible=False, depths=(1, 2, 2, 4)):
         super(MonoUNet, self).__init__()
-        self.encoder = Encoder(input_channels=input_channels, instance_norm=instance_norm)
+        self.encoder = Encoder(input_channels=input_channels, instance_norm=instance_norm,
+                reversible=reversible, depths=depths)
         if upsampling == 'deconv':
             self.decoder = DeconvDecoder()
         else:
@@ -3,9 +3,10 @@ import torch.nn as nn
 
 from .model_utils import *
 
-class SimpleResNetBlock(nn.Module):
-    def __init__(self, channels, num_groups=32):
+class SimpleResNetBlock(FusableBlock):
+    def __init__(self, channels, num_groups=32, fused=False):
         super(SimpleResNetBlock, self).__init__()
+        self.fused = fused
         self.feats = nn.Sequential(nn.GroupNorm(num_groups, channels),
             nn.ReLU(inplace=True),
             nn.Dropout3d(),
@@ -19,14 +20,15 @@ class SimpleResNetBlock(nn.Module):
 
     def forward(self, x):
         residual = x
-        out = self.feats(x)
+        out = self.features(x)
         out += residual
         return out
 
 
-class ResNetBlock(nn.Module):
-    def __init__(self, in_channels, num_groups=8):
+class ResNetBlock(FusableBlock):
+    def __init__(self, in_channels, num_groups=8, fused=False):
         super(ResNetBlock, self).__init__()
+        self.fused = fused
         self.feats = nn.Sequential(nn.GroupNorm(num_groups, in_channels),
             nn.ReLU(inplace=True),
             nn.Conv3d(in_channels, in_channels, 
@@ -38,7 +40,7 @@ class ResNetBlock(nn.Module):
 
     def forward(self, x):
         residual = x
-        out = self.feats(x)
+        out = self.features(x)
         out += residual
         return out
 
@@ -117,10 +119,11 @@ class Decoder(nn.Module):
      
 # deprecated
 class UNet(nn.Module):
-    def __init__(self):
+    def __init__(self, fused=False):
         super(UNet, self).__init__()
         self.encoder = Encoder()
         self.decoder = Decoder()
+        set_fused_norm(self, fused)
 
     def forward(self, x):
         x = self.encoder(x)
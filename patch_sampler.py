@@ -0,0 +1,119 @@
+'''
+Choosing patch windows before reading any data.
+
+Cropping used to happen after the whole volume was decoded or, for the
+preprocessed .npy files, after pad_nd_image had copied the whole patient.
+A PatchSampler picks the window from the volume's shape alone. The window
+is then read with CroppedVolume.read, which touches only the voxels inside
+it and zero fills whatever lies past the edges. On a memmap that makes a
+sample cost a patch-sized read instead of a whole volume.
+'''
+import numpy as np
+
+CROP_TYPES = ['center', 'random', 'bbox', 'brain']
+
+
+def _integer(rng, lo, hi):
+    # uniform over [lo, hi], inclusive, from a Generator or a RandomState
+    if isinstance(rng, np.random.Generator):
+        return int(rng.integers(lo, hi + 1))
+    return int(rng.randint(lo, hi + 1))
+
+
+class PatchSampler(object):
+    ''' Picks patch_size windows over volumes.
+
+    crop_type is one of
+        center  the centered window
+        random  a uniformly random window inside the volume
+        bbox    a random window constrained by a bounding box. If the patch
+                is larger than the box along an axis the window covers the
+                box, otherwise it lies inside the box.
+        brain   a window just large enough for the bounding box, rounded up
+                to a multiple of multiple and at most patch_size. Sample
+                sizes vary, see BucketBatchSampler and pad_collate.
+    Along any axis where the volume is smaller than the patch the window is
+    centered, so the padding is split between both edges.
+
+    With fg_fraction > 0 that fraction of the windows is instead centered on
+    a labeled voxel, given to window as {label: coordinates} from
+    fg_index.ForegroundIndex. The label is drawn with probability
+    proportional to class_weights among the labels the case has.
+    '''
+    def __init__(self, patch_size, crop_type='random', rng=None,
+            fg_fraction=0., class_weights=None, multiple=16):
+        if crop_type not in CROP_TYPES:
+            raise ValueError(f'crop_type must be one of {CROP_TYPES}, got {crop_type}')
+        self.patch_size = [int(p) for p in patch_size]
+        self.crop_type = crop_type
+        self.rng = rng if rng is not None else np.random
+        self.fg_fraction = fg_fraction
+        self.class_weights = class_weights or {1: 1., 2: 1., 4: 1.}
+        self.multiple = multiple
+
+    def window_shape(self, bbox=None):
+        ''' Shape of the windows taken around bbox. Only the brain crop type
+        depends on bbox.
+        '''
+        if self.crop_type != 'brain' or bbox is None:
+            return list(self.patch_size)
+        m = self.multiple
+        return [min(p, -(-(int(b1) - int(b0) + 1) // m) * m)
+                for (b0, b1), p in zip(bbox, self.patch_size)]
+
+    def _fg_voxel(self, fg, rng):
+        labels = [l for l, w in self.class_weights.items() if w > 0 and len(fg.get(l, []))]
+        if not labels:
+            return None
+        w = np.array([self.class_weights[l] for l in labels], dtype=np.float64)
+        l = labels[rng.choice(len(labels), p=w / w.sum())]
+        return fg[l][_integer(rng, 0, len(fg[l]) - 1)]
+
+    def _fg_window(self, shape, voxel, size):
+        start = []
+        for n, p, c in zip(shape, size, voxel):
+            if n <= p:
+                start.append((n + n % 2 - p) // 2)
+            else:
+                start.append(min(max(int(c) - p // 2, 0), n - p))
+        return start, [s + p for s, p in zip(start, size)]
+
+    def window(self, shape, bbox=None, fg=None, rng=None):
+        ''' Returns the (start, stop) of a window over a volume of shape.
+        bbox is an inclusive (min, max) index per axis, as returned by
+        volume_cache.nonzero_bbox, and is only used by the bbox and brain
+        crop types.
+        fg are the case's labeled voxels, without them every window is
+        placed by crop_type. rng, a Generator or RandomState, overrides
+        the sampler's.
+        '''
+        rng = self.rng if rng is None else rng
+        size = self.window_shape(bbox)
+        if fg is not None and self.fg_fraction > 0 and rng.uniform() < self.fg_fraction:
+            voxel = self._fg_voxel(fg, rng)
+            if voxel is not None:
+                return self._fg_window(shape, voxel, size)
+
+        start = []
+        for axis, (n, p) in enumerate(zip(shape, size)):
+            if self.crop_type == 'brain' and bbox is not None:
+                b0, b1 = int(bbox[axis][0]), int(bbox[axis][1])
+                if b1 - b0 + 1 <= p:
+                    # centered on the box, past the volume's edges is zero
+                    start.append(b0 - (p - (b1 - b0 + 1)) // 2)
+                else:
+                    start.append(_integer(rng, b0, b1 - p + 1))
+            elif n <= p or self.crop_type == 'center':
+                # odd sizes are centered as if padded by one voxel at the
+                # end, like BraTSDataset._center_window
+                start.append((n + n % 2 - p) // 2)
+            elif self.crop_type == 'random' or bbox is None:
+                start.append(_integer(rng, 0, n - p))
+            else:
+                b0, b1 = int(bbox[axis][0]), int(bbox[axis][1])
+                if b1 - b0 + 1 <= p:
+                    lo, hi = b1 - p + 1, b0
+                else:
+                    lo, hi = b0, b1 - p + 1
+                start.append(_integer(rng, max(lo, 0), min(hi, n - p)))
+        return start, [s + p for s, p in zip(start, size)]
@@ -0,0 +1,172 @@
+'''
+Metadata table of a folder of preprocessed patients.
+
+BraTS2018DataLoader3D used to unpickle a patient's .pkl every time the
+patient went into a batch, and bg_train.py opened every patient's array at
+startup to find the largest shape. The table holds, for every patient of
+the folder, the metadata from its .pkl along with its image shape and
+dtype, the voxel counts of each label and the bounding box of the tumor.
+It's a single patients.json in the folder, loaded once by the main
+process. MultiThreadedAugmenter's workers are forked from it and read
+their copy without ever writing to it.
+
+Patients whose files changed since the table was written are redone on
+load. To build the table of a folder:
+
+    python patient_table.py --folder /dev/shm/brats2020-preprocessed
+'''
+import os
+import json
+import pickle
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+
+from volume_cache import nonzero_bbox
+
+TABLE_NAME = 'patients.json'
+VERSION = 1
+# labels after preprocessing moved 4 to 3
+LABELS = [1, 2, 3]
+
+
+def _sources(patient):
+    sources = {}
+    for suffix in ['.npy', '.pkl', '_seg.npy']:
+        if os.path.isfile(patient + suffix):
+            st = os.stat(patient + suffix)
+            sources[suffix] = [st.st_mtime_ns, st.st_size]
+    return sources
+
+
+def patient_record(patient):
+    ''' Reads the metadata and computes the statistics of a patient. '''
+    with open(patient + '.pkl', 'rb') as f:
+        metadata = pickle.load(f)
+    version = metadata.get('format_version', 1)
+    data = np.load(patient + '.npy', mmap_mode='r')
+    shape = list(data.shape)
+    seg = None
+    if version < 2:
+        # the segmentation is the last channel
+        shape[0] -= 1
+        seg = data[-1]
+    elif os.path.isfile(patient + '_seg.npy'):
+        seg = np.load(patient + '_seg.npy', mmap_mode='r')
+
+    record = {'sources': _sources(patient),
+            'format_version': version,
+            'shape': shape,
+            'dtype': str(data.dtype),
+            'spacing': np.asarray(metadata['spacing']).tolist(),
+            'direction': list(metadata['direction']),
+            'origin': list(metadata['origin']),
+            'original_shape': list(metadata['original_shape']),
+            'nonzero_region': np.asarray(metadata['nonzero_region']).tolist()}
+    if seg is not None:
+        seg = np.asarray(seg).astype(np.uint8)
+        counts = np.bincount(seg.ravel(), minlength=len(LABELS) + 1)
+        record['label_counts'] = {str(l): int(counts[l]) for l in LABELS}
+        bbox = nonzero_bbox([seg])
+        record['tumor_bbox'] = None if bbox is None else bbox.tolist()
+    return record
+
+
+class PatientTable(object):
+    ''' The records of the patients of folder, keyed by patient name. '''
+    def __init__(self, folder, records, path):
+        self.folder = folder
+        self.records = records
+        self.path = path
+
+    def __len__(self):
+        return len(self.records)
+
+    def record(self, patient):
+        ''' Returns the record of patient, a path without extension as
+        given by get_list_of_patients, or None.
+        '''
+        return self.records.get(os.path.basename(patient))
+
+    def shape(self, patient):
+        ''' The (channels, x, y, z) shape of patient's images. '''
+        return tuple(self.record(patient)['shape'])
+
+    def tumor_bbox(self, patient):
+        bbox = self.record(patient).get('tumor_bbox')
+        return None if bbox is None else np.array(bbox)
+
+    def metadata(self, patient):
+        ''' Returns patient's metadata as its .pkl holds it. '''
+        r = self.record(patient)
+        return {'spacing': np.array(r['spacing']),
+                'direction': tuple(r['direction']),
+                'origin': tuple(r['origin']),
+                'original_shape': tuple(r['original_shape']),
+                'nonzero_region': np.array(r['nonzero_region']),
+                'format_version': r['format_version']}
+
+    def save(self):
+        state = {'version': VERSION, 'folder': self.folder, 'records': self.records}
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f'Could not write patient table to {self.path}: {e}')
+
+
+def load_patient_table(folder, path=None, num_workers=8):
+    ''' Loads the table of the preprocessed patients in folder, computing
+    the records of patients which are new or changed.
+    '''
+    folder = os.path.abspath(folder)
+    path = path or os.path.join(folder, TABLE_NAME)
+
+    old = {}
+    try:
+        with open(path) as f:
+            state = json.load(f)
+        if state.get('version') == VERSION and state.get('folder') == folder:
+            old = state['records']
+    except (OSError, ValueError):
+        pass
+
+    # as bg_dataloader.get_list_of_patients lists them
+    patients = [os.path.join(folder, f[:-4]) for f in sorted(os.listdir(folder))
+            if f.endswith('.npy') and not f.endswith('_seg.npy')]
+    records = {}
+    missing = []
+    for p in patients:
+        name = os.path.basename(p)
+        if name in old and old[name]['sources'] == _sources(p):
+            records[name] = old[name]
+        else:
+            missing.append(p)
+
+    if missing:
+        print(f'Reading the metadata of {len(missing)} patients.')
+        pool = Pool(processes=num_workers)
+        for p, r in zip(missing, pool.imap(patient_record, missing)):
+            records[os.path.basename(p)] = r
+        pool.close()
+        pool.join()
+
+    table = PatientTable(folder, records, path)
+    if missing or set(old) != set(records):
+        table.save()
+    return table
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the metadata table of a folder of preprocessed patients.')
+    parser.add_argument('--folder', type=str, required=True, metavar='PATH',
+        help='Path to the preprocessed patients.')
+    parser.add_argument('--num_workers', type=int, default=8, metavar='N',
+        help='number of processes to read with (default: 8)')
+    args = parser.parse_args()
+
+    table = load_patient_table(args.folder, num_workers=args.num_workers)
+    print(f'{len(table)} patients in {table.path}')
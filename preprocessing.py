@@ -7,8 +7,34 @@ except ImportError:
     print("You need to have SimpleITK installed to run this example!")
     raise ImportError("SimpleITK not found")
 
+import os
+import time
+import json
+import hashlib
+import argparse
+from collections import deque
 from multiprocessing import Pool
 
+from manifest import load_manifest
+from volume_cache import nonzero_bbox, nonzero_mask
+
+# everything the output depends on besides the source files. bump version
+# when load_and_preprocess changes so existing outputs are redone.
+PARAMS = {
+    'version': 1,
+    'normalization': 'brain_zscore',
+    'eps': 1e-8,
+    'seg_remap': {'4': 3},
+    'format_version': 2,
+    'image_dtype': 'float16',
+}
+# format 1 stacked the images and the segmentation into one float32 array in patient.npy. format 2 stores the
+# images as float16 in patient.npy and the segmentation, if there is one, as uint8 in patient_seg.npy. The
+# version is in the metadata .pkl, which has none for format 1.
+FORMAT_VERSION = PARAMS['format_version']
+IMAGE_DTYPE = np.dtype(PARAMS['image_dtype'])
+MANIFEST_NAME = 'preprocessing.json'
+
 
 def get_list_of_files(base_dir):
     """
@@ -18,23 +44,11 @@ def get_list_of_files(base_dir):
     :param base_dir:
     :return:
     """
-    filenames = []
-    segs = [] 
-    modes = []
-    for (dirpath, dirnames, files) in os.walk(base_dir):
-        filenames += [os.path.join(dirpath, file) for file in files if '.nii.gz' in file ]
-
-        modes = [sorted([ f for f in filenames if "_t1.nii.gz" in f ]),
-                  sorted([ f for f in filenames if "_t1ce.nii.gz" in f ]),
-                  sorted([ f for f in filenames if "_t2.nii.gz" in f ]),
-                  sorted([ f for f in filenames if "_flair.nii.gz" in f ])
-        ]
-        segs = sorted([ f for f in filenames if "seg.nii.gz" in f ])
-
-    if segs:
-        list_of_lists = [list(i) for i in zip(modes[0], modes[1], modes[2], modes[3], segs)]
+    index = load_manifest(base_dir)
+    if index.segs():
+        list_of_lists = [list(i) for i in index.cases(seg=True)]
     else: # there are no segmentations for test/eval data
-        list_of_lists = [list(i) for i in zip(modes[0], modes[1], modes[2], modes[3])]
+        list_of_lists = [list(i) for i in index.cases()]
 
     #assert all((isfile(j) for i in list_of_lists for j in i), "some file is missing for patient %s; make sure the following " \
     #                                                    "files are there: %s" % (p, str(this_case))
@@ -49,8 +63,8 @@ def load_and_preprocess(case, patient_name, output_folder):
     1) load all images and stack them to a 4d array
     2) crop to nonzero region, this removes unnecessary zero-valued regions and reduces computation time
     3) normalize the nonzero region with its mean and standard deviation
-    4) save 4d tensor as numpy array. Also save metadata required to create niftis again (required for export
-    of predictions)
+    4) save the images as a float16 4d array and the segmentation as a uint8 3d array. Also save metadata required
+    to create niftis again (required for export of predictions)
 
     :param case:
     :param patient_name:
@@ -79,11 +93,49 @@ def load_and_preprocess(case, patient_name, output_folder):
 
     # now stack the images into one 4d array, cast to float because we will get rounding problems if we don't
     imgs_npy = np.concatenate([i[None] for i in imgs_npy]).astype(np.float32)
-    # now find the nonzero region and crop to that
-    nonzero = [np.array(np.where(i != 0)) for i in imgs_npy]
-    nonzero = [[np.min(i, 1), np.max(i, 1)] for i in nonzero]
-    nonzero = np.array([np.min([i[0] for i in nonzero], 0), np.max([i[1] for i in nonzero], 0)]).T
-    # nonzero now has shape 3, 2. It contains the (min, max) coordinate of nonzero voxels for each axis
+    imgs_npy, nonzero = crop_and_normalize(imgs_npy)
+
+    # now save as npy, the normalized images as float16 and the segmentation (there is none for test/eval data)
+    # as uint8 on its own so the loaders only read what they need
+    num_modes = 4
+    _save_npy(join(output_folder, patient_name + ".npy"), imgs_npy[:num_modes].astype(IMAGE_DTYPE))
+    if len(imgs_npy) > num_modes:
+        _save_npy(join(output_folder, patient_name + "_seg.npy"), imgs_npy[num_modes].astype(np.uint8))
+
+    metadata = {
+        'spacing': spacing,
+        'direction': direction,
+        'origin': origin,
+        'original_shape': original_shape,
+        'nonzero_region': nonzero,
+        'format_version': FORMAT_VERSION,
+    }
+
+    # written last, its presence marks the case as done
+    pkl_path = join(output_folder, patient_name + ".pkl")
+    tmp = ".%d.tmp" % os.getpid()
+    save_pickle(metadata, pkl_path + tmp)
+    os.replace(pkl_path + tmp, pkl_path)
+
+
+def _save_npy(path, array):
+    # write to a temporary file and rename it into place so an interrupted run never leaves a truncated
+    # output behind
+    tmp = path + ".%d.tmp" % os.getpid()
+    with open(tmp, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp, path)
+
+
+def crop_and_normalize(imgs_npy):
+    """
+    Crops the stacked images (and segmentation) to their nonzero region, normalizes the modalities and moves
+    label 4 to 3. Returns the cropped array and the (min, max) coordinate of the nonzero region per axis.
+    imgs_npy is modified.
+    """
+    # now find the nonzero region and crop to that. nonzero has shape 3, 2. It contains the (min, max)
+    # coordinate of nonzero voxels for each axis
+    nonzero = nonzero_bbox(imgs_npy)
 
     # now crop to nonzero
     imgs_npy = imgs_npy[:,
@@ -93,12 +145,9 @@ def load_and_preprocess(case, patient_name, output_folder):
                ]
 
     # now we create a brain mask that we use for normalization
-    nonzero_masks = [i != 0 for i in imgs_npy[-1]]
-    brain_mask = np.zeros(imgs_npy.shape[1:], dtype=bool)
-    for i in range(len(nonzero_masks)):
-        # WARNING THIS IS BROKEN
-        #brain_mask = brain_mask | nonzero_masks[i]
-        brain_mask[i, :, :] = brain_mask[i, :, :] | nonzero_masks[i]
+    # WARNING THIS IS BROKEN: the mask is the nonzero region of the last channel only, which is the
+    # segmentation if there is one. Kept as it was so outputs don't change.
+    brain_mask = nonzero_mask([imgs_npy[-1]])
 
     # This shouldn't be hardcoded but we know all the BraTS stuff has 4 modalities. This will be
     # a problem for a different data set with fewer (or more) modes.
@@ -106,27 +155,118 @@ def load_and_preprocess(case, patient_name, output_folder):
 
     # now normalize each modality with its mean and standard deviation (computed within the brain mask)
     for i in range(num_modes):
-        mean = imgs_npy[i][brain_mask].mean()
-        std = imgs_npy[i][brain_mask].std()
-        imgs_npy[i] = (imgs_npy[i] - mean) / (std + 1e-8)
-        imgs_npy[i][brain_mask == 0] = 0
+        brain = imgs_npy[i][brain_mask]
+        mean = brain.mean()
+        std = brain.std()
+        imgs_npy[i] -= mean
+        imgs_npy[i] /= std + 1e-8
+        imgs_npy[i][~brain_mask] = 0
 
     # the segmentation of brats has the values 0, 1, 2 and 4. This is pretty inconvenient to say the least.
     # We move everything that is 4 to 3
     imgs_npy[-1][imgs_npy[-1] == 4] = 3
+    return imgs_npy, nonzero
 
-    # now save as npz
-    np.save(join(output_folder, patient_name + ".npy"), imgs_npy)
 
-    metadata = {
-        'spacing': spacing,
-        'direction': direction,
-        'origin': origin,
-        'original_shape': original_shape,
-        'nonzero_region': nonzero,
-    }
+def file_sha1(path, chunk=1 << 20):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(chunk), b""):
+            h.update(block)
+    return h.hexdigest()
 
-    save_pickle(metadata, join(output_folder, patient_name + ".pkl"))
+
+def _stat(path):
+    st = os.stat(path)
+    return [st.st_mtime_ns, st.st_size]
+
+
+class PreprocessingManifest(object):
+    """
+    Records, in output_folder/preprocessing.json, the sources and parameters every case was preprocessed with
+    and how long it took. A case is up to date if its outputs exist, PARAMS haven't changed and each source
+    either has the recorded mtime and size or, if it was only touched, the recorded sha1. Each case is recorded
+    as soon as it's done so an interrupted run resumes where it stopped.
+    """
+    def __init__(self, output_folder, params=PARAMS):
+        self.path = join(output_folder, MANIFEST_NAME)
+        self.output_folder = output_folder
+        self.params = params
+        self.cases = {}
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+            if state.get("params") == params:
+                self.cases = state["cases"]
+        except (OSError, ValueError):
+            pass
+
+    def up_to_date(self, case, patient_name):
+        entry = self.cases.get(patient_name)
+        if entry is None or sorted(entry["sources"]) != sorted(os.path.abspath(i) for i in case):
+            return False
+        outputs = [".npy", ".pkl"] + (["_seg.npy"] if len(case) > 4 else [])
+        if not all(isfile(join(self.output_folder, patient_name + ext)) for ext in outputs):
+            return False
+        for path, source in entry["sources"].items():
+            if not isfile(path):
+                return False
+            if _stat(path) != source["stat"] and file_sha1(path) != source["sha1"]:
+                return False
+        return True
+
+    def record(self, patient_name, sources, seconds):
+        self.cases[patient_name] = {"sources": sources, "seconds": seconds, "finished": time.time()}
+        self.save()
+
+    def save(self):
+        tmp = "%s.%d.tmp" % (self.path, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump({"params": self.params, "cases": self.cases}, f)
+        os.replace(tmp, self.path)
+
+
+def _preprocess(case, patient_name, output_folder):
+    """
+    Runs load_and_preprocess on a case and returns what the manifest records of it. The sources are
+    stat'ed before they're read so a file changed while processing is redone next time.
+    """
+    sources = {os.path.abspath(i): {"stat": _stat(i), "sha1": file_sha1(i)} for i in case}
+    start = time.time()
+    load_and_preprocess(case, patient_name, output_folder)
+    return patient_name, sources, time.time() - start
+
+
+def preprocess(list_of_lists, output_folder, num_workers=8, max_in_flight=None, force=False):
+    """
+    Preprocesses every case of list_of_lists which isn't up to date in output_folder. At most max_in_flight
+    cases (default 2 * num_workers) are queued at once so memory doesn't grow with the size of the cohort.
+    """
+    maybe_mkdir_p(output_folder)
+    manifest = PreprocessingManifest(output_folder)
+    patient_names = [i[0].split("/")[-2] for i in list_of_lists]
+    todo = [(c, n) for c, n in zip(list_of_lists, patient_names)
+            if force or not manifest.up_to_date(c, n)]
+    print("%d of %d patients up to date, preprocessing %d" %
+          (len(list_of_lists) - len(todo), len(list_of_lists), len(todo)))
+
+    max_in_flight = max_in_flight or 2 * num_workers
+    p = Pool(processes=num_workers)
+    todo = deque(todo)
+    pending = deque()
+    done = 0
+    start = time.time()
+    while todo or pending:
+        while todo and len(pending) < max_in_flight:
+            case, patient_name = todo.popleft()
+            pending.append(p.apply_async(_preprocess, (case, patient_name, output_folder)))
+        patient_name, sources, seconds = pending.popleft().get()
+        manifest.record(patient_name, sources, seconds)
+        done += 1
+        print("%s: %.1f s (%d done, %.1f s elapsed)" % (patient_name, seconds, done, time.time() - start))
+    p.close()
+    p.join()
+    return manifest
 
 
 def save_segmentation_as_nifti(segmentation, metadata, output_file):
@@ -179,22 +319,23 @@ if __name__ == "__main__":
     #brats_preprocessed_folder = '/shared/mrfil-data/cddunca2/brats2018-validation-preprocessed/'
     #list_of_lists = get_list_of_files('/shared/mrfil-data/cddunca2/brats2018-biascorrect-validation/')
     #brats_preprocessed_folder = '/shared/mrfil-data/cddunca2/brats2018-biascorrect-validation-preprocessed/'
-    list_of_lists = get_list_of_files('/dev/shm/MICCAI_BraTS2020_TrainingData/')
-    brats_preprocessed_folder = '/shared/mrfil-data/cddunca2/brats2020/brats2020-preprocessed/'
-
-    num_threads_for_brats_example = 8
-    maybe_mkdir_p(brats_preprocessed_folder)
-    
-    patient_names = [i[0].split("/")[-2] for i in list_of_lists]
-    p = Pool(processes=num_threads_for_brats_example)
-    p.starmap(load_and_preprocess, 
-            zip(list_of_lists, 
-                patient_names, 
-                [brats_preprocessed_folder] * len(list_of_lists)
-                )
-            )
-    p.close()
-    p.join()
+    parser = argparse.ArgumentParser(description='Preprocess BraTS cases which changed since the last run.')
+    parser.add_argument('--data_dir', type=str, default='/dev/shm/MICCAI_BraTS2020_TrainingData/', metavar='PATH',
+        help='Path to where the data is located.')
+    parser.add_argument('--output_dir', type=str,
+        default='/shared/mrfil-data/cddunca2/brats2020/brats2020-preprocessed/', metavar='PATH',
+        help='Path to write the preprocessed cases to.')
+    parser.add_argument('--num_workers', type=int, default=8, metavar='N',
+        help='number of processes to preprocess with (default: 8)')
+    parser.add_argument('--max_in_flight', type=int, default=None, metavar='N',
+        help='number of cases queued at once (default: 2 * num_workers)')
+    parser.add_argument('--force', action='store_true',
+        help='preprocess every case, even those which are up to date (default: off)')
+    args = parser.parse_args()
+
+    list_of_lists = get_list_of_files(args.data_dir)
+    preprocess(list_of_lists, args.output_dir, num_workers=args.num_workers,
+               max_in_flight=args.max_in_flight, force=args.force)
 
     # remember that we cropped the data before preprocessing. If we predict the test cases, we want to run the same
     # preprocessing for them. We need to then put the segmentation back into its original position (due to cropping).
@@ -0,0 +1,227 @@
+'''
+Pseudo-labels for self training.
+
+BraTSSelfTrainDataset trains on unlabeled cases with labels predicted by
+the model being trained. A PseudoLabelStore holds those labels as one
+uint8 array of every unlabeled case, memory-mapped from a file under
+root/run_id, /dev/shm by default, so the DataLoader workers share the
+pages. Each set of labels is a generation in its own directory. A
+generation is written in full before the store's CURRENT pointer is
+replaced, atomically, to name it, so readers only ever see complete
+generations and pick up the new one on their next read.
+
+The teacher, Annotator, labels the cases with a snapshot of the model's
+weights in a background process, so training carries on with the current
+generation while the next one is made.
+'''
+import os
+import copy
+import json
+import shutil
+import hashlib
+import multiprocessing as mp
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+ROOT = '/dev/shm/pseudo-labels'
+SHAPE = (240, 240, 155)
+
+
+def run_id(run_dir):
+    ''' A store name unique to the output directory of a run. '''
+    path = os.path.abspath(run_dir)
+    return f'{os.path.basename(path)}-{hashlib.sha1(path.encode()).hexdigest()[:8]}'
+
+
+class PseudoLabelStore(object):
+    ''' The generations of pseudo-labels of the n cases of a run, each an
+    n x shape uint8 array in root/run_id/gen-{k}/labels.npy.
+    '''
+    def __init__(self, run_id, n, shape=SHAPE, root=ROOT):
+        self.dir = os.path.join(root, run_id)
+        self.n = n
+        self.shape = tuple(shape)
+        self.pointer = os.path.join(self.dir, 'CURRENT')
+        os.makedirs(self.dir, exist_ok=True)
+        self._mtime = None
+        self._generation = None
+        self._labels = None
+
+    def __getstate__(self):
+        # each process maps the labels itself
+        state = self.__dict__.copy()
+        state['_mtime'] = state['_generation'] = state['_labels'] = None
+        return state
+
+    def _path(self, generation):
+        return os.path.join(self.dir, f'gen-{generation}')
+
+    def current(self):
+        ''' The number of the current generation, None if there is none. '''
+        try:
+            mtime = os.stat(self.pointer).st_mtime_ns
+        except OSError:
+            return None
+        if mtime != self._mtime:
+            with open(self.pointer) as f:
+                generation = json.load(f)['generation']
+            if generation != self._generation:
+                self._labels = None
+            self._generation, self._mtime = generation, mtime
+        return self._generation
+
+    def labels(self):
+        ''' The current generation's labels, memory-mapped read only. '''
+        generation = self.current()
+        if generation is None:
+            raise FileNotFoundError(f'{self.dir} has no pseudo-labels yet')
+        if self._labels is None:
+            self._labels = np.load(os.path.join(self._path(generation), 'labels.npy'), mmap_mode='r')
+        return self._labels
+
+    def cases(self):
+        ''' The cases the current generation labels, None if there is none. '''
+        generation = self.current()
+        if generation is None:
+            return None
+        with open(os.path.join(self._path(generation), 'cases.json')) as f:
+            return json.load(f)
+
+    def create(self, cases):
+        ''' Returns the number and the writable labels of a new generation
+        of cases. It stays invisible until commit.
+        '''
+        generation = (self.current() or 0) + 1
+        tmp = self._path(generation) + '.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        with open(os.path.join(tmp, 'cases.json'), 'w') as f:
+            json.dump(cases, f)
+        labels = np.lib.format.open_memmap(os.path.join(tmp, 'labels.npy'),
+                mode='w+', dtype=np.uint8, shape=(self.n, *self.shape))
+        return generation, labels
+
+    def commit(self, generation, labels):
+        ''' Makes generation current and removes all but the previous one,
+        which readers may still have mapped.
+        '''
+        labels.flush()
+        path = self._path(generation)
+        os.replace(path + '.tmp', path)
+        tmp = f'{self.pointer}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'generation': generation}, f)
+        os.replace(tmp, self.pointer)
+        for name in os.listdir(self.dir):
+            if name.startswith('gen-') and not name.endswith('.tmp') \
+                    and int(name[4:]) < generation - 1:
+                shutil.rmtree(os.path.join(self.dir, name), ignore_errors=True)
+
+    def unlink(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def _predict(model, src):
+    output = model(src)
+    if isinstance(output, tuple):
+        output = output[0]
+    if isinstance(output, dict):
+        output = output['seg_map']
+    return output
+
+
+def cases(dataset):
+    return [dataset._patient(p) for p in dataset.modes[0]]
+
+
+def annotate(model, dataset, store, device, batch_size=4, threshold=0.5, progress=False):
+    ''' Labels every case of dataset, a BraTSAnnotationDataset, with model
+    and commits the labels as a new generation of store.
+    '''
+    # data_loader imports this module
+    from data_loader import to_device
+    generation, labels = store.create(cases(dataset))
+    loader = DataLoader(dataset, batch_size=batch_size)
+    # the model sees the centered dims window of each case
+    start, stop = dataset._center_window(store.shape)
+    # odd dimensions are padded for the window, the padding isn't stored
+    stop = [min(b, n) for b, n in zip(stop, store.shape)]
+    i = 0
+    with torch.no_grad():
+        model.eval()
+        for d in tqdm(loader, disable=not progress):
+            output = _predict(model, to_device(d['data'], device))
+            et, wt, tc = (output[:, :3] > threshold).unbind(1)
+            label = torch.zeros(wt.shape, dtype=torch.uint8, device=wt.device)
+            label[wt] = 2
+            label[tc] = 1
+            label[et] = 4
+            label = label[:, :stop[0] - start[0], :stop[1] - start[1], :stop[2] - start[2]]
+            labels[i:i + len(label), start[0]:stop[0], start[1]:stop[1], start[2]:stop[2]] = \
+                    label.cpu().numpy()
+            i += len(label)
+    store.commit(generation, labels)
+    return generation
+
+
+def _skeleton(model):
+    ''' A copy of model with its parameters and buffers on the meta device,
+    so copying it allocates no memory where model is.
+    '''
+    memo = {}
+    for t in list(model.parameters()) + list(model.buffers()):
+        meta = torch.empty_like(t, device='meta')
+        if isinstance(t, torch.nn.Parameter):
+            meta = torch.nn.Parameter(meta, requires_grad=t.requires_grad)
+        memo[id(t)] = meta
+    return copy.deepcopy(model, memo)
+
+
+def _annotate(skeleton, state, dataset, store, device, batch_size):
+    model = skeleton.to_empty(device='cpu')
+    model.load_state_dict(state)
+    model.to(device)
+    annotate(model, dataset, store, device, batch_size=batch_size)
+
+
+class Annotator(object):
+    ''' Makes new generations of a store in a background process, each
+    with a snapshot of the model's weights taken when it's started. The
+    process is a daemon and can't start DataLoader workers, give the
+    dataset decode_threads instead.
+    '''
+    def __init__(self, dataset, store, device, batch_size=4):
+        self.dataset = dataset
+        self.store = store
+        self.device = device
+        self.batch_size = batch_size
+        self.process = None
+
+    def running(self):
+        return self.process is not None and self.process.is_alive()
+
+    def start(self, model):
+        ''' Starts labeling with the current weights of model. Returns False
+        if the previous generation is still being made.
+        '''
+        if self.running():
+            return False
+        if self.process is not None and self.process.exitcode != 0:
+            print(f'pseudo-labeling exited with code {self.process.exitcode}')
+        # the weights are copied straight to host memory, a copy of the
+        # model on its device would double its parameters on the GPU
+        state = {k: v.detach().cpu() for k, v in model.state_dict().items()}
+        # spawn so the child doesn't inherit the parent's CUDA state
+        ctx = mp.get_context('spawn')
+        self.process = ctx.Process(target=_annotate, daemon=True,
+                args=(_skeleton(model), state, self.dataset, self.store, self.device,
+                    self.batch_size))
+        self.process.start()
+        return True
+
+    def join(self):
+        if self.process is not None:
+            self.process.join()
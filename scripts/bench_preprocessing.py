@@ -0,0 +1,117 @@
+# Compare time and peak memory per case of the old crop and normalization
+# in preprocessing.load_and_preprocess (np.where coordinate lists for the
+# bounding box, slice loop brain mask, masked copies for mean and std)
+# against preprocessing.crop_and_normalize. Checks the outputs match.
+#
+# Each path is timed in a fresh process. Peak memory is the resident set:
+# the kernel's high water mark (VmHWM) is reset before every case and its
+# rise above the resident size at that point is the case's peak.
+import sys
+import time
+import argparse
+import subprocess
+
+import numpy as np
+
+from preprocessing import crop_and_normalize, get_list_of_files
+from volume_cache import decode
+
+parser = argparse.ArgumentParser(description='Benchmark the crop and normalization of preprocessing.')
+parser.add_argument('--data_dir', type=str, default=None,
+        help='Path to BraTS data. Synthetic cases are used if not given (default: None)')
+parser.add_argument('-n', type=int, default=10, metavar='N',
+        help='number of cases to time (default: 10)')
+parser.add_argument('--path', type=str, default=None, choices=['legacy', 'current'],
+        help='time only this path, in this process (default: both, each in its own process)')
+args = parser.parse_args()
+
+
+def legacy(imgs_npy):
+    nonzero = [np.array(np.where(i != 0)) for i in imgs_npy]
+    nonzero = [[np.min(i, 1), np.max(i, 1)] for i in nonzero]
+    nonzero = np.array([np.min([i[0] for i in nonzero], 0), np.max([i[1] for i in nonzero], 0)]).T
+    imgs_npy = imgs_npy[:,
+               nonzero[0, 0] : nonzero[0, 1] + 1,
+               nonzero[1, 0]: nonzero[1, 1] + 1,
+               nonzero[2, 0]: nonzero[2, 1] + 1,
+               ]
+    nonzero_masks = [i != 0 for i in imgs_npy[-1]]
+    brain_mask = np.zeros(imgs_npy.shape[1:], dtype=bool)
+    for i in range(len(nonzero_masks)):
+        brain_mask[i, :, :] = brain_mask[i, :, :] | nonzero_masks[i]
+    for i in range(4):
+        mean = imgs_npy[i][brain_mask].mean()
+        std = imgs_npy[i][brain_mask].std()
+        imgs_npy[i] = (imgs_npy[i] - mean) / (std + 1e-8)
+        imgs_npy[i][brain_mask == 0] = 0
+    imgs_npy[-1][imgs_npy[-1] == 4] = 3
+    return imgs_npy, nonzero
+
+
+def cases():
+    if args.data_dir:
+        list_of_lists = get_list_of_files(args.data_dir)
+        for i in range(args.n):
+            case = list_of_lists[i % len(list_of_lists)]
+            yield np.stack([decode(f, seg='seg.nii.gz' in f) for f in case]).astype(np.float32)
+    else:
+        rng = np.random.RandomState(0)
+        grid = np.mgrid[:240, :240, :155].astype(np.float32)
+        brain = ((grid[0] - 120)**2 / 80**2 + (grid[1] - 120)**2 / 95**2
+                + (grid[2] - 77)**2 / 65**2) < 1
+        tumor = ((grid[0] - 100)**2 + (grid[1] - 130)**2 + (grid[2] - 70)**2) < 20**2
+        imgs = [brain * rng.randint(1, 2000, brain.shape) for _ in range(4)]
+        seg = tumor * rng.choice([1, 2, 4], brain.shape)
+        case = np.stack(imgs + [seg]).astype(np.float32)
+        for i in range(args.n):
+            yield case.copy()
+
+
+def _status(field):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field):
+                return int(line.split()[1]) / 1024
+
+
+def _reset_peak():
+    # resets VmHWM to the current resident size, see proc(5)
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+
+
+def run(name, fn):
+    times = []
+    peaks = []
+    for case in cases():
+        _reset_peak()
+        rss = _status('VmRSS')
+        start = time.time()
+        fn(case)
+        times.append(time.time() - start)
+        peaks.append(_status('VmHWM') - rss)
+        del case
+    print(f'{name}\t{np.median(times)*1000:.1f}\t{np.max(peaks):.1f}')
+
+
+paths = {'legacy': legacy, 'current': crop_and_normalize}
+if args.path:
+    run(args.path, paths[args.path])
+else:
+    results = {}
+    for path in paths:
+        cmd = [sys.executable, __file__, '--path', path, '-n', str(args.n)]
+        if args.data_dir:
+            cmd += ['--data_dir', args.data_dir]
+        out = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+        name, t, m = out.strip().splitlines()[-1].split('\t')
+        results[name] = float(t), float(m)
+        print(f'{name}\ttime: {float(t):8.1f} ms/case\tpeak RSS: {float(m):8.1f} MB')
+    (t_old, m_old), (t_new, m_new) = results['legacy'], results['current']
+    same = True
+    for case in cases():
+        old, old_box = legacy(case.copy())
+        new, new_box = crop_and_normalize(case)
+        same = same and np.array_equal(old_box, new_box) and np.array_equal(old, new)
+    print(f'throughput: {1000 / t_old:.1f} -> {1000 / t_new:.1f} cases/s\tspeedup: {t_old / t_new:.2f}x'
+            f'\tpeak RSS reduction: {m_old / m_new:.2f}x\tidentical: {same}')
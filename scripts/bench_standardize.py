@@ -0,0 +1,132 @@
+# Compare time and peak memory per sample of the old per-modality
+# transform (float64 decode, np.pad, crop copy, slice loop brain mask,
+# masked mean/std copies, new standardized array, flip copy) against
+# BraTSDataset's current float32 in-place path.
+#
+# Each path runs in a fresh process. Peak memory is the resident set: the
+# kernel's high water mark (VmHWM) is reset before every sample and its
+# rise above the resident size at that point is the sample's peak.
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+import numpy as np
+import nibabel as nib
+
+from data_loader import BraTSTrainDataset, Augmentation
+from volume_cache import CroppedVolume
+
+parser = argparse.ArgumentParser(description='Benchmark intensity standardization.')
+parser.add_argument('--data_dir', type=str, default=None,
+        help='Path to BraTS data. A synthetic volume is used if not given (default: None)')
+parser.add_argument('-n', type=int, default=10, metavar='N',
+        help='number of samples to time (default: 10)')
+parser.add_argument('--path', type=str, default=None, choices=['legacy', 'current'],
+        help='run only this path, in this process (default: both, each in its own process)')
+args = parser.parse_args()
+
+dims = [128, 128, 128]
+
+
+def legacy_transform(img, shft, scal, axis):
+    x, y, z = img.shape
+    img = np.pad(img, pad_width=((0, x % 2), (0, y % 2), (0, z % 2)),
+            mode='constant', constant_values=0)
+    x_off = (img.shape[0] - dims[0]) // 2
+    y_off = (img.shape[1] - dims[1]) // 2
+    z_off = (img.shape[2] - dims[2]) // 2
+    d = img[x_off:img.shape[0]-x_off, y_off:img.shape[1]-y_off, z_off:img.shape[2]-z_off]
+
+    nonzero_masks = [i != 0 for i in d]
+    brain_mask = np.zeros(d.shape, dtype=bool)
+    for i in range(len(nonzero_masks)):
+        brain_mask[i, :, :] = brain_mask[i, :, :] | nonzero_masks[i]
+    mean = d[brain_mask].mean()
+    std = d[brain_mask].std()
+    stan = (d - mean) / (std + 1e-8)
+    stan = stan + shft
+    stan = stan*scal
+    stan[brain_mask == False] = 0
+    return np.flip(stan, axis).copy()
+
+
+def volumes():
+    if args.data_dir:
+        data = BraTSTrainDataset(args.data_dir, dims=dims)
+        for i in range(args.n):
+            yield data.modes[0][i % len(data)]
+    else:
+        rng = np.random.RandomState(0)
+        grid = np.mgrid[:240, :240, :155].astype(np.float32)
+        brain = ((grid[0] - 120)**2 / 80**2 + (grid[1] - 120)**2 / 95**2
+                + (grid[2] - 77)**2 / 65**2) < 1
+        vol = (brain * rng.randint(1, 2000, brain.shape)).astype(np.int16)
+        for i in range(args.n):
+            yield nib.Nifti1Image(vol, np.eye(4))
+
+
+def _status(field):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field):
+                return int(line.split()[1]) / 1024
+
+
+def _reset_peak():
+    # resets VmHWM to the current resident size, see proc(5)
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+
+
+def run(name, fn):
+    times = []
+    peaks = []
+    for v in volumes():
+        img = nib.load(v) if isinstance(v, str) else v
+        # decode outside of the measurement, it's the same for both paths
+        raw = np.asanyarray(img.dataobj)
+        _reset_peak()
+        rss = _status('VmRSS')
+        start = time.time()
+        fn(raw)
+        times.append(time.time() - start)
+        peaks.append(_status('VmHWM') - rss)
+    # the median time, the first sample also faults in the allocator's pages
+    print(f'{name}\t{np.median(times)*1000:.1f}\t{np.max(peaks):.1f}')
+
+
+dataset = BraTSTrainDataset.__new__(BraTSTrainDataset)
+dataset.dims = dims
+dataset.transport_dtype = 'float32'
+
+
+def legacy(raw):
+    shft = np.random.uniform(-0.1, 0.1, dims)
+    scal = np.random.uniform(0.9, 1.1, dims)
+    legacy_transform(raw.astype(np.float64), shft, scal, 0)
+
+
+def current(raw):
+    aug = Augmentation(True, 0,
+            np.random.uniform(-0.1, 0.1, dims).astype(np.float32),
+            np.random.uniform(0.9, 1.1, dims).astype(np.float32))
+    vol = CroppedVolume.from_array(raw.astype(np.float32))
+    np.ascontiguousarray(dataset._transform_data(vol, aug=aug))
+
+
+if args.path:
+    run(args.path, {'legacy': legacy, 'current': current}[args.path])
+else:
+    results = {}
+    for path in ['legacy', 'current']:
+        cmd = [sys.executable, __file__, '--path', path, '-n', str(args.n)]
+        if args.data_dir:
+            cmd += ['--data_dir', args.data_dir]
+        out = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+        name, t, m = out.strip().splitlines()[-1].split('\t')
+        results[name] = float(t), float(m)
+        print(f'{name}\ttime: {float(t):8.1f} ms\tpeak RSS: {float(m):8.1f} MB')
+    (t_old, m_old), (t_new, m_new) = results['legacy'], results['current']
+    print(f'speedup: {t_old / t_new:.2f}x\tpeak RSS reduction: {m_old / m_new:.2f}x')
@@ -1,28 +1,23 @@
 # Calculate the percentage of labeled tumor lost when center
 # cropping to 128x128x128.
-import os
-
-import nibabel as nib
 import numpy as np
 
+from manifest import load_manifest
+from volume_cache import decode
+
 data_dir = '/dev/shm/MICCAI_BraTS2020_TrainingData'
 
-filenames = []
-for (dirpath, dirnames, files) in os.walk(data_dir):
-    filenames += [os.path.join(dirpath, file) for file in files if '.nii.gz' in file ]
-    segs = sorted([ f for f in filenames if "seg.nii.gz" in f ])
+segs = load_manifest(data_dir).segs()
 
 tot_ratio=[]
 tot_segs = len(segs)
 for i, seg in enumerate(segs):
     print( f'{i / tot_segs:.2f}', end='\r')
-    img_mat = nib.load(seg).get_fdata()
-    tot_labels = len(np.where(img_mat>0)[0])
+    img_mat = decode(seg, seg=True)
+    tot_labels = np.count_nonzero(img_mat)
     img_mat[56:-56, 56:-56, 14:-13] = 0
-    mask_mat = np.zeros(img_mat.shape)
-    mask_mat[np.where(img_mat>0)] = 1
     
-    tot_ratio += [np.sum(mask_mat)/tot_labels]
+    tot_ratio += [np.count_nonzero(img_mat)/tot_labels]
 
 median = np.median(tot_ratio)
 mean = np.mean(tot_ratio)
@@ -0,0 +1,58 @@
+# Check that residual blocks give the same outputs and gradients with
+# their norm, relu and convolutions fused by set_fused_norm as unfused.
+# Runs in float64. Blocks with dropout are checked in eval mode since the
+# fused op draws its own dropout masks. Exits with status 1 if any check
+# fails.
+import sys
+import copy
+import argparse
+
+import tabulate
+import torch
+
+from models.model_utils import ResNetBlock, ResNetBlockWithDropout, set_fused_norm
+from models.unet import SimpleResNetBlock
+
+parser = argparse.ArgumentParser(description='Gradient equivalence of the fused norm.')
+parser.add_argument('--size', type=int, default=8, metavar='N',
+        help='spatial size of the inputs (default: 8)')
+parser.add_argument('--tol', type=float, default=1e-8, metavar='TOL',
+        help='largest absolute difference allowed (default: 1e-8)')
+parser.add_argument('--seed', type=int, default=0, metavar='N',
+        help='random seed (default: 0)')
+args = parser.parse_args()
+
+torch.manual_seed(args.seed)
+
+
+def gradients(model, x, weight):
+    model.zero_grad(set_to_none=True)
+    x.grad = None
+    out = model(x)
+    (out * weight).sum().backward()
+    return out.detach(), [x.grad] + [p.grad for p in model.parameters()]
+
+
+def compare(name, block, train=True):
+    block = block.double().train(train)
+    fused = set_fused_norm(copy.deepcopy(block))
+    channels = block.feats[0].num_channels if hasattr(block.feats[0], 'num_channels') \
+            else block.feats[0].num_features
+    x = torch.randn(2, channels, *[args.size] * 3, dtype=torch.double, requires_grad=True)
+    weight = torch.randn_like(x)
+    ref_out, ref_grads = gradients(block, x, weight)
+    out, grads = gradients(fused, x, weight)
+    out_diff = (ref_out - out).abs().max().item()
+    grad_diff = max((a - b).abs().max().item() for a, b in zip(ref_grads, grads))
+    return [name, out_diff, grad_diff, max(out_diff, grad_diff) <= args.tol]
+
+
+rows = [compare('ResNetBlock(32)', ResNetBlock(32)),
+        compare('ResNetBlock(64)', ResNetBlock(64)),
+        compare('ResNetBlock(32, instance_norm)', ResNetBlock(32, instance_norm=True)),
+        compare('ResNetBlockWithDropout(32), eval', ResNetBlockWithDropout(32), train=False),
+        compare('unet.SimpleResNetBlock(64), eval', SimpleResNetBlock(64), train=False)]
+
+print(tabulate.tabulate(rows, ['check', 'output diff', 'gradient diff', 'pass'],
+    tablefmt='simple', floatfmt='.2e'))
+sys.exit(0 if all(r[-1] for r in rows) else 1)
@@ -0,0 +1,152 @@
+# Activation memory and step time of a MonoUNet training step at each patch
+# preset of train.py (default, -L, -X, -F) in float32 and under the
+# autocast of --mixed_precision, with each --activation_checkpoint mode and,
+# with --reversible and --fused_norm, with the reversible encoder and the
+# fused norm, relu and convolutions too. Runs on synthetic batches.
+# Activations are the memory the forward pass leaves allocated for the
+# backward and peak is the most allocated during the step on top of the
+# model, its gradients and the optimizer state. On CUDA that's what the
+# caching allocator has allocated, on CPU the resident set of the process
+# (VmRSS, with the high water mark VmHWM reset before the steps), which
+# also counts freed memory the allocator hasn't returned yet.
+import time
+import argparse
+import itertools
+
+import numpy as np
+import tabulate
+import torch
+import torch.optim as optim
+
+import losses
+from models.models import MonoUNet
+from models.model_utils import set_checkpoint, set_fused_norm, CHECKPOINT_MODES
+from utils import autocast, grad_scaler
+
+PRESETS = {'default': [128, 128, 128],
+        '-L': [160, 192, 128],
+        '-X': [192, 192, 128],
+        '-F': [240, 240, 144]}
+
+parser = argparse.ArgumentParser(description='Benchmark memory and time of a training step.')
+parser.add_argument('--device', type=int, default=0, metavar='N',
+        help='which CUDA device to use, -1 for CPU (default: 0)')
+parser.add_argument('--batch_size', type=int, default=1, metavar='N',
+        help='batch size (default: 1)')
+parser.add_argument('-n', type=int, default=5, metavar='N',
+        help='number of steps to time (default: 5)')
+parser.add_argument('--presets', type=str, nargs='+', default=list(PRESETS),
+        help=f'presets to run, of {list(PRESETS)} (default: all)')
+parser.add_argument('--precisions', type=str, nargs='+', default=['float32', 'mixed'],
+        choices=['float32', 'mixed'], help='float32 and/or autocast to run (default: both)')
+parser.add_argument('--checkpoints', type=str, nargs='+', default=CHECKPOINT_MODES,
+        choices=CHECKPOINT_MODES, help='activation checkpoint modes to run (default: all)')
+parser.add_argument('--reversible', action='store_true',
+        help='bench the reversible encoder as well (default: off)')
+parser.add_argument('--fused_norm', action='store_true',
+        help='bench the fused norm, relu and convolutions as well (default: off)')
+args = parser.parse_args()
+
+if args.device >= 0 and torch.cuda.is_available():
+    device = torch.device(f'cuda:{args.device}')
+else:
+    device = torch.device('cpu')
+cuda = device.type == 'cuda'
+MB = 1024.0 ** 2
+
+
+def sync():
+    if cuda:
+        torch.cuda.synchronize(device)
+
+
+def _status(field):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field):
+                return int(line.split()[1]) * 1024
+
+
+def allocated():
+    return torch.cuda.memory_allocated(device) if cuda else _status('VmRSS')
+
+
+def reset_peak():
+    if cuda:
+        torch.cuda.reset_peak_memory_stats(device)
+    else:
+        # resets VmHWM to the current resident size, see proc(5)
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+
+
+def max_allocated():
+    return torch.cuda.max_memory_allocated(device) if cuda else _status('VmHWM')
+
+
+def step(model, loss, optimizer, scaler, src, target, mixed_precision):
+    ''' One training step as utils.train takes it. Returns the memory the
+    forward pass left allocated.
+    '''
+    optimizer.zero_grad(set_to_none=False)
+    before = allocated()
+    with autocast(device, mixed_precision):
+        preds, _ = model(src)
+        cur_loss = loss(preds, {'target': target, 'src': src})
+    activations = allocated() - before
+    scaler.scale(cur_loss).backward()
+    scaler.step(optimizer)
+    scaler.update()
+    return activations
+
+
+def bench(dims, mixed_precision, mode, reversible, fused):
+    model = set_checkpoint(MonoUNet(reversible=reversible), mode)
+    model = set_fused_norm(model, fused).to(device)
+    optimizer = optim.Adam(model.parameters(), lr=1e-4)
+    scaler = grad_scaler(device, mixed_precision)
+    loss = losses.AvgDiceLoss()
+    src = torch.randn(args.batch_size, 4, *dims, device=device)
+    target = (torch.rand(args.batch_size, 3, *dims, device=device) > 0.9).float()
+
+    # the first step allocates the gradients and the optimizer state
+    step(model, loss, optimizer, scaler, src, target, mixed_precision)
+    sync()
+    base = allocated()
+    reset_peak()
+
+    times = []
+    for _ in range(args.n):
+        start = time.time()
+        activations = step(model, loss, optimizer, scaler, src, target, mixed_precision)
+        sync()
+        times.append(time.time() - start)
+
+    peak = (max_allocated() - base) / MB
+    return activations / MB, peak, np.mean(times)
+
+
+columns = ['preset', 'dims', 'precision', 'encoder', 'norm', 'checkpoint', 'activations (MB)',
+        'peak (MB)', 'step (s)']
+rows = []
+settings = itertools.product(args.presets, [p == 'mixed' for p in args.precisions],
+        [False, True] if args.reversible else [False],
+        [False, True] if args.fused_norm else [False],
+        args.checkpoints)
+for name, mixed_precision, reversible, fused, mode in settings:
+    dims = PRESETS[name]
+    try:
+        results = list(bench(dims, mixed_precision, mode, reversible, fused))
+    except RuntimeError as e:
+        if 'out of memory' not in str(e):
+            raise
+        results = ['OOM', 'OOM', 'OOM']
+    if cuda:
+        torch.cuda.empty_cache()
+    precision = 'float32'
+    if mixed_precision:
+        precision = 'float16' if cuda else 'bfloat16'
+    rows.append([name, 'x'.join(map(str, dims)), precision,
+        'reversible' if reversible else 'resnet', 'fused' if fused else 'unfused', mode] + results)
+
+print(tabulate.tabulate(rows, columns, tablefmt='simple', floatfmt='8.2f'))
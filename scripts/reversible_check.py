@@ -0,0 +1,103 @@
+# Check that ReversibleSequence, which recomputes the inputs of its blocks
+# from their outputs in the backward pass, gives the same outputs and
+# gradients as running the same ReversibleBlocks with plain autograd. Runs
+# in float64 so differences are the algorithm's and not rounding's. Exits
+# with status 1 if any check fails.
+import sys
+import copy
+import argparse
+
+import tabulate
+import torch
+import torch.nn as nn
+
+from models.models import Encoder
+from models.model_utils import ReversibleBlock, ReversibleSequence
+
+parser = argparse.ArgumentParser(description='Gradient equivalence of reversible blocks.')
+parser.add_argument('--size', type=int, default=8, metavar='N',
+        help='spatial size of the inputs (default: 8)')
+parser.add_argument('--tol', type=float, default=1e-8, metavar='TOL',
+        help='largest absolute difference allowed (default: 1e-8)')
+parser.add_argument('--seed', type=int, default=0, metavar='N',
+        help='random seed (default: 0)')
+args = parser.parse_args()
+
+torch.manual_seed(args.seed)
+
+
+def flat(out):
+    if isinstance(out, dict):
+        return torch.cat([o.flatten() for _, o in sorted(out.items())])
+    return out
+
+
+def gradients(model, x, weight):
+    ''' The output of model and the gradients of (output * weight).sum()
+    with respect to x and to each parameter of model.
+    '''
+    model.zero_grad(set_to_none=True)
+    x.grad = None
+    out = flat(model(x))
+    (out * weight).sum().backward()
+    grads = [x.grad] if x.requires_grad else []
+    grads += [p.grad for p in model.parameters()]
+    return out.detach(), grads
+
+
+def compare(name, reference, reversible, x):
+    ''' reference and reversible must hold the same parameters in the same
+    order.
+    '''
+    with torch.no_grad():
+        weight = torch.randn_like(flat(reference(x)))
+    ref_out, ref_grads = gradients(reference, x, weight)
+    rev_out, rev_grads = gradients(reversible, x, weight)
+    if any(g is None for g in ref_grads + rev_grads):
+        return [name, float('nan'), float('nan'), False]
+    out_diff = (ref_out - rev_out).abs().max().item()
+    grad_diff = max((a - b).abs().max().item() for a, b in zip(ref_grads, rev_grads))
+    return [name, out_diff, grad_diff, max(out_diff, grad_diff) <= args.tol]
+
+
+def sequence(channels, depth, instance_norm=False):
+    blocks = [ReversibleBlock(channels, instance_norm=instance_norm) for _ in range(depth)]
+    return nn.Sequential(*blocks).double(), ReversibleSequence(blocks).double()
+
+
+size = [args.size] * 3
+rows = []
+for channels in [32, 64, 256]:
+    for depth in [1, 2, 4]:
+        reference, reversible = sequence(channels, depth)
+        x = torch.randn(2, channels, *size, dtype=torch.double, requires_grad=True)
+        rows.append(compare(f'{depth} x {channels} channels', reference, reversible, x))
+
+# the input of an encoder doesn't require grad, the parameters still must
+# get theirs
+reference, reversible = sequence(32, 2)
+x = torch.randn(2, 32, *size, dtype=torch.double)
+rows.append(compare('2 x 32 channels, input without grad', reference, reversible, x))
+
+reference, reversible = sequence(64, 2, instance_norm=True)
+x = torch.randn(2, 64, *size, dtype=torch.double, requires_grad=True)
+rows.append(compare('2 x 64 channels, instance norm', reference, reversible, x))
+
+# eval turns off the encoder's dropout
+encoder = Encoder(reversible=True, depths=(1, 2, 2, 4)).double().eval()
+plain = copy.deepcopy(encoder)
+for name in ['rev1', 'rev2', 'rev3', 'rev4']:
+    setattr(plain, name, nn.Sequential(*getattr(plain, name).blocks))
+x = torch.randn(1, 4, *[max(args.size, 16)] * 3, dtype=torch.double)
+rows.append(compare('Encoder(reversible=True)', plain, encoder, x))
+
+# the inverse reconstructs a block's input
+block = ReversibleBlock(64).double()
+x = torch.randn(2, 64, *size, dtype=torch.double)
+with torch.no_grad():
+    diff = (block.inverse(block(x)) - x).abs().max().item()
+rows.append(['inverse', diff, float('nan'), diff <= args.tol])
+
+print(tabulate.tabulate(rows, ['check', 'output diff', 'gradient diff', 'pass'],
+    tablefmt='simple', floatfmt='.2e'))
+sys.exit(0 if all(r[-1] for r in rows) else 1)
@@ -0,0 +1,234 @@
+'''
+Decoded volumes resident in shared memory.
+
+Even with the data under /dev/shm every DataLoader worker decodes its own
+copy of each case and every new run starts from the compressed files. A
+SharedVolumeStore is filled once, by the CLI below, with every volume of a
+data directory decoded, cropped to its nonzero bounding box and stored in
+a compact dtype in its own named shared memory segment. A small json
+registry maps each source file to its segment. Datasets and the
+batchgenerators loader attach to the segments instead of decoding, so every
+worker and every process on the node shares the one resident copy.
+
+Images are stored as int16 when that's exact, which it is for the integer
+intensities BraTS is distributed with, and as float32 otherwise.
+Segmentations are uint8. Preprocessed .npy files are stored as they are.
+
+The segments outlive the process that created them. To fill and to free a
+store:
+
+    python shm_store.py --name brats2020 --data_dir /dev/shm/MICCAI_BraTS2020_TrainingData
+    python shm_store.py --name brats2020 --unlink
+'''
+import os
+import mmap
+import json
+import argparse
+from collections import OrderedDict
+from multiprocessing import Pool, shared_memory, resource_tracker
+
+import numpy as np
+
+from volume_cache import CroppedVolume, nonzero_bbox, decode, source_key
+
+REGISTRY_DIR = '/dev/shm'
+SHM_DIR = '/dev/shm'
+# segments kept mapped by each process, a store holds one per volume
+MAX_MAPPED = 256
+
+
+def _unlink(name):
+    ''' Removes segment name. The segments are unregistered from the
+    resource tracker when they're made, SharedMemory.unlink would
+    unregister them a second time, which the tracker reports as an error.
+    '''
+    os.unlink(os.path.join(SHM_DIR, name.lstrip('/')))
+
+
+def _map(name):
+    ''' Maps segment name read only. The descriptor is closed right away, the
+    mapping doesn't need it, so a process attached to many segments doesn't
+    run out of file descriptors.
+    '''
+    fd = os.open(os.path.join(SHM_DIR, name.lstrip('/')), os.O_RDONLY)
+    try:
+        try:
+            return mmap.mmap(fd, 0, access=mmap.ACCESS_READ, trackfd=False)
+        except TypeError:
+            # before python 3.13 the mapping keeps a duplicate of the descriptor
+            return mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    finally:
+        os.close(fd)
+
+
+def _compact(data, seg):
+    if seg:
+        return data
+    if np.abs(data).max() <= np.iinfo(np.int16).max and np.array_equal(np.rint(data), data):
+        return data.astype(np.int16)
+    return data
+
+
+def _read(path, seg=None):
+    ''' Returns the array to store for path and its offset and full shape. '''
+    if path.endswith('.npy'):
+        data = np.load(path)
+        return data, (0,) * data.ndim, data.shape
+    if seg is None:
+        seg = 'seg.nii.gz' in path
+    data = decode(path, seg=seg)
+    bbox = nonzero_bbox([data])
+    if bbox is None:
+        bbox = np.zeros((3, 2), dtype=np.int64)
+    cropped = data[bbox[0, 0]:bbox[0, 1] + 1,
+            bbox[1, 0]:bbox[1, 1] + 1,
+            bbox[2, 0]:bbox[2, 1] + 1]
+    return _compact(cropped, seg), bbox[:, 0].tolist(), data.shape
+
+
+class SharedVolumeStore(object):
+    ''' Loads volumes from the shared memory segments listed in the
+    registry of store name. load has the interface of VolumeCache.load,
+    files which aren't in the store are decoded locally.
+
+    At most max_mapped segments are kept mapped, the least recently used
+    one is dropped first. Its mapping is freed once no array returned by
+    load uses it any more.
+    '''
+    def __init__(self, name, registry_dir=REGISTRY_DIR, max_mapped=MAX_MAPPED):
+        self.name = name
+        self.registry = os.path.join(registry_dir, f'{name}.json')
+        self.max_mapped = max_mapped
+        self._entries = None
+        self._mtime = None
+        self._segments = OrderedDict()
+
+    def __getstate__(self):
+        # segments are mapped again by each process that loads from them
+        state = self.__dict__.copy()
+        state['_segments'] = OrderedDict()
+        return state
+
+    def _segment_name(self, key):
+        return f'{self.name}-{key[:24]}'
+
+    def entries(self, reload=False):
+        if self._entries is None or reload:
+            try:
+                mtime = os.stat(self.registry).st_mtime_ns
+                if mtime != self._mtime:
+                    with open(self.registry) as f:
+                        self._entries = json.load(f)
+                    self._mtime = mtime
+            except (OSError, ValueError):
+                self._entries = self._entries or {}
+        return self._entries
+
+    def _array(self, entry):
+        name = entry['segment']
+        buf = self._segments.get(name)
+        if buf is None:
+            buf = self._segments[name] = _map(name)
+            if len(self._segments) > self.max_mapped:
+                self._segments.popitem(last=False)
+        else:
+            self._segments.move_to_end(name)
+        # the mapping is read only, the copy is shared by every process
+        return np.ndarray(entry['data_shape'], dtype=entry['dtype'], buffer=buf)
+
+    def load(self, path, seg=False):
+        ''' Returns the CroppedVolume of path, backed by shared memory if
+        the store holds the current version of path.
+        '''
+        key = source_key(path)
+        entry = self.entries().get(key)
+        if entry is None:
+            # the store may have been filled since the registry was read
+            entry = self.entries(reload=True).get(key)
+        if entry is not None:
+            try:
+                return CroppedVolume(self._array(entry), entry['offset'], entry['shape'])
+            except (OSError, ValueError):
+                # segment freed or not mappable, e.g. out of descriptors
+                pass
+        data, offset, shape = _read(path, seg)
+        return CroppedVolume(data, offset, shape)
+
+    def _store(self, path):
+        ''' Decodes path into a new segment and returns its registry entry. '''
+        key = source_key(path)
+        data, offset, shape = _read(path)
+        name = self._segment_name(key)
+        try:
+            shm = shared_memory.SharedMemory(name=name, create=True, size=max(data.nbytes, 1))
+        except FileExistsError:
+            # left over from an interrupted fill
+            _unlink(name)
+            shm = shared_memory.SharedMemory(name=name, create=True, size=max(data.nbytes, 1))
+        # the segment has to outlive this process
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        np.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf)[...] = data
+        shm.close()
+        return key, {'source': os.path.abspath(path), 'segment': name,
+                'offset': list(offset), 'shape': list(shape),
+                'data_shape': list(data.shape), 'dtype': str(data.dtype)}
+
+    def fill(self, paths, num_workers=8):
+        ''' Stores every path which isn't stored yet and writes the registry. '''
+        entries = dict(self.entries(reload=True))
+        missing = [p for p in paths if source_key(p) not in entries]
+        print(f'Storing {len(missing)} volumes in shared memory as {self.name}.')
+        p = Pool(processes=num_workers)
+        for key, entry in p.imap_unordered(self._store, missing):
+            entries[key] = entry
+        p.close()
+        p.join()
+        self._write(entries)
+
+    def unlink(self):
+        ''' Frees every segment of the store and removes its registry. '''
+        for entry in self.entries(reload=True).values():
+            try:
+                _unlink(entry['segment'])
+            except FileNotFoundError:
+                pass
+        if os.path.exists(self.registry):
+            os.remove(self.registry)
+        self._entries = {}
+
+    def nbytes(self):
+        return sum(int(np.prod(e['data_shape'])) * np.dtype(e['dtype']).itemsize
+                for e in self.entries().values())
+
+    def _write(self, entries):
+        tmp = f'{self.registry}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(entries, f)
+        os.replace(tmp, self.registry)
+        self._entries = entries
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fill or free a shared memory volume store.')
+    parser.add_argument('--name', type=str, required=True,
+        help='name of the store')
+    parser.add_argument('--data_dir', type=str, default=None, metavar='PATH',
+        help='directory of .nii.gz or preprocessed .npy files to store (default: None)')
+    parser.add_argument('--registry_dir', type=str, default=REGISTRY_DIR, metavar='PATH',
+        help=f'where the registry is kept (default: {REGISTRY_DIR})')
+    parser.add_argument('--num_workers', type=int, default=8, metavar='N',
+        help='number of processes to decode with (default: 8)')
+    parser.add_argument('--unlink', action='store_true',
+        help='free the store instead of filling it (default: off)')
+    args = parser.parse_args()
+
+    store = SharedVolumeStore(args.name, registry_dir=args.registry_dir)
+    if args.unlink:
+        store.unlink()
+    else:
+        filenames = []
+        for (dirpath, dirnames, files) in os.walk(args.data_dir):
+            filenames += [os.path.join(dirpath, file) for file in files
+                    if '.nii.gz' in file or file.endswith('.npy')]
+        store.fill(filenames, num_workers=args.num_workers)
+        print(f'{len(store.entries())} volumes, {store.nbytes() / 1024**3:.2f} GB in {store.registry}')
@@ -20,10 +20,13 @@ import losses
 
 from utils import *
 from models.models import *
-from data_loader import BraTSTrainDataset, BraTSSelfTrainDataset
-
-#from apex import amp
-from apex_dummy import amp
+from models.model_utils import set_checkpoint, set_fused_norm, CHECKPOINT_MODES
+from data_loader import (BraTSTrainDataset, BraTSSelfTrainDataset, AffinitySampler,
+        BucketBatchSampler, ThreadDataLoader, PatchShuffleBuffer, pad_collate, TRANSPORT_DTYPES)
+from manifest import load_manifest, min_region_volume
+from patch_sampler import CROP_TYPES
+from augment import BatchAugmenter
+import pseudo_labels
 
 parser = argparse.ArgumentParser(description='Train glioma segmentation model.')
 lr_add_cnst = 1e-6
@@ -35,6 +38,31 @@ parser.add_argument('--dir', type=str, required=True, metavar='PATH',
 parser.add_argument('--data_dir', type=str, default='/dev/shm/MICCAI_BraTS2020_TrainingData', metavar='PATH TO DATA',
     help='Path to where the data is located.')
 
+parser.add_argument('--cache_dir', type=str, default=None, metavar='PATH',
+    help='cache decoded volumes here so they are only decompressed once.\
+            see volume_cache.py (default: None)')
+
+parser.add_argument('--shm_store', type=str, default=None, metavar='NAME',
+    help='read decoded volumes from this shared memory store, filled by\
+            shm_store.py. takes precedence over --cache_dir (default: None)')
+
+parser.add_argument('--transport_dtype', type=str, default='float32', choices=TRANSPORT_DTYPES,
+    help='dtype samples are passed from the dataloader workers to the training loop in.\
+            int16 sends raw intensities and standardizes on the device (default: float32)')
+
+parser.add_argument('--crop_type', type=str, default='center', choices=CROP_TYPES,
+    help='where training patches are taken from. bbox keeps random patches on the brain,\
+            brain crops to the brain and batches crops of similar size.\
+            see patch_sampler.py (default: center)')
+
+parser.add_argument('--fg_fraction', type=float, default=0., metavar='F',
+    help='fraction of training patches centered on a labeled voxel.\
+            see fg_index.py (default: 0)')
+
+parser.add_argument('--class_weights', type=float, nargs=3, default=[1., 1., 1.],
+    metavar=('NCR', 'ED', 'ET'),
+    help='how often each label is picked for --fg_fraction patches (default: 1 1 1)')
+
 parser.add_argument('--model', type=str, default=None, required=True, metavar='MODEL',
                         help='model class (default: None)')
 
@@ -56,11 +84,19 @@ parser.add_argument('--loss', type=str, default='avgdice',
 parser.add_argument('-a', '--augment_data', action='store_true', 
     help='augment training data with mirroring, shifts, and scaling (default: off)')
 
+parser.add_argument('--batch_augment', action='store_true', 
+    help='with --augment_data, augment whole batches on the device with augment.BatchAugmenter, '
+    'which adds rotation, elastic deformation, gamma, noise and blur (default: off)')
+
 parser.add_argument('--throw_no_et_sets', action='store_true', 
     help='throw out datasets that do not have ET labels (default: off)')
 
+parser.add_argument('--min_wt_volume', type=int, default=0, metavar='N',
+    help='throw out datasets with fewer than N whole tumor voxels (default: 0)')
+
 parser.add_argument('--mixed_precision', action='store_true', 
-    help='mixed precision flag (default: off)')
+    help='train and evaluate under autocast, float16 with loss scaling on CUDA and bfloat16\
+            on CPU (default: off)')
 
 parser.add_argument('--cascade_train', action='store_true', 
     help='train cascade model, append wt annotation to input (default: off)')
@@ -88,6 +124,25 @@ parser.add_argument('-X', '--xlarge_patch', action='store_true',
 parser.add_argument('-F', '--full_patch', action='store_true', 
         help='use patch size 240x240x144 (default patch size: 128x128x128)')
 
+parser.add_argument('--activation_checkpoint', type=str, default='none', choices=CHECKPOINT_MODES,
+        help='recompute activations in the backward pass instead of keeping them, per ResNetBlock\
+                (block) or per spatial level of the encoders and decoders (level). at 128^3\
+                block cut the peak memory of a step by about a third and level by about 40%%,\
+                for up to 30%% more step time. scripts/memory_bench.py measures it on your\
+                device (default: none)')
+
+parser.add_argument('--fused_norm', action='store_true', 
+        help='run the norm, relu and convolutions of the residual blocks as one op which recomputes\
+                the activations in the backward pass instead of keeping them (default: off)')
+
+parser.add_argument('--reversible', action='store_true', 
+        help='use reversible blocks in the MonoUNet encoder, which recompute their inputs in the\
+                backward pass instead of keeping activations (default: off)')
+
+parser.add_argument('--depths', type=int, nargs=4, default=[1, 2, 2, 4], metavar='N',
+        help='with --reversible, the number of blocks at each spatial level of the encoder\
+                (default: 1 2 2 4)')
+
 parser.add_argument('--cross_val', action='store_true', 
     help='use train/val split of full dataset (default: off)')
 
@@ -104,6 +159,12 @@ parser.add_argument('--selftrain', action='store_true',
 parser.add_argument('--selftrain_n', type=int, default=50, metavar='n',
         help='number of unsupervised examples to use for self train. (default: 50)')
 
+parser.add_argument('--selftrain_batch_size', type=int, default=4, metavar='N',
+        help='batch size of the background pseudo-labeling pass (default: 4)')
+
+parser.add_argument('--pseudo_label_dir', type=str, default=pseudo_labels.ROOT, metavar='PATH',
+        help=f'where the pseudo-labels of each run are kept (default: {pseudo_labels.ROOT})')
+
 rand_seed = random.randint(0, 2**32-1)
 parser.add_argument('--seed', type=int, default=rand_seed, metavar='S', 
     help='random seed (default: random.randint(0, 2**32 - 1))')
@@ -123,9 +184,39 @@ parser.add_argument('--epochs', type=int, default=300, metavar='N',
 parser.add_argument('--num_workers', type=int, default=4, metavar='N', 
     help='number of workers to assign to dataloader (default: 4)')
 
+parser.add_argument('--loader', type=str, default='processes', choices=['processes', 'threads'], 
+    help='run the num_workers dataloader workers as processes or as threads (default: processes)')
+
+parser.add_argument('--decode_threads', type=int, default=0, metavar='N', 
+    help='threads each dataloader worker decodes the volumes of a case with (default: 0)')
+
+parser.add_argument('--cache_mb', type=int, default=0, metavar='N', 
+    help='keep up to N MB of decoded volumes in each dataloader worker, with persistent\
+            workers that see the same cases every epoch (default: 0)')
+
+parser.add_argument('--patches_per_case', type=int, default=1, metavar='K', 
+    help='make K independently cropped and augmented training samples from each decode\
+            of a case, always with process workers. K > 1 needs a --crop_type other than\
+            center or --fg_fraction > 0 (default: 1)')
+
+parser.add_argument('--shuffle_buffer', type=int, default=16, metavar='N', 
+    help='with --patches_per_case, draw samples at random from a buffer of N patches\
+            of consecutive cases (default: 16)')
+
 parser.add_argument('--batch_size', type=int, default=1, metavar='N', 
     help='batch_size (default: 1)')
 
+parser.add_argument('--accumulate', type=int, default=1, metavar='N', 
+    help='step the optimizer, and --clr, on the gradients of N batches, for an effective\
+            batch size of N times --batch_size (default: 1)')
+
+parser.add_argument('--micro_batch_size', type=int, default=None, metavar='N', 
+    help='run batches through the model N samples at a time (default: whole batches)')
+
+parser.add_argument('--memory_budget', type=float, default=None, metavar='GB', 
+    help='split batches into micro-batches as large as fit in GB of device memory,\
+            measured on the first step (default: off)')
+
 parser.add_argument('--save_freq', type=int, default=25, metavar='N', 
     help='save frequency (default: 25)')
 
@@ -178,13 +269,16 @@ if args.full_patch:
 
 if args.model == 'MonoUNet':
     if args.enhance_feat:
-        model = MonoUNet(input_channels=5, upsampling=args.upsampling, instance_norm=args.instance_norm)
+        model = MonoUNet(input_channels=5, upsampling=args.upsampling, instance_norm=args.instance_norm,
+                reversible=args.reversible, depths=args.depths)
         loss = losses.AvgDiceEnhanceLoss(device)
     else:
         if args.cascade_train:
-            model = MonoUNet(input_channels=5, upsampling=args.upsampling, instance_norm=args.instance_norm)
+            model = MonoUNet(input_channels=5, upsampling=args.upsampling, instance_norm=args.instance_norm,
+                reversible=args.reversible, depths=args.depths)
         else:
-            model = MonoUNet(upsampling=args.upsampling, instance_norm=args.instance_norm)
+            model = MonoUNet(upsampling=args.upsampling, instance_norm=args.instance_norm,
+                    reversible=args.reversible, depths=args.depths)
         loss = losses.AvgDiceLoss()
     if args.loss == 'bce':
         loss = losses.BCELoss()
@@ -218,6 +312,8 @@ else:
     optimizer = \
         optim.Adam(model.parameters(), lr=args.lr, weight_decay=args.wd)
 
+set_checkpoint(model, args.activation_checkpoint)
+set_fused_norm(model, args.fused_norm)
 model = model.to(device)
 start_epoch = 0
 
@@ -233,7 +329,14 @@ if args.pretrain:
     checkpoint = torch.load(args.pretrain)
     model.load_state_dict(checkpoint["state_dict"])
 
+# labels 1, 2 and 4 in the raw segmentations
+class_weights = dict(zip([1, 2, 4], args.class_weights))
+# with --batch_augment the datasets hand over unaugmented samples
+dataset_augment = args.augment_data and not args.batch_augment
+augmenter = BatchAugmenter() if args.augment_data and args.batch_augment else None
+
 collate_fn=None
+
 #def collate_fn(batch):
 #    bc = bx = by = bz = 0
 #    for d in batch:
@@ -256,19 +359,31 @@ collate_fn=None
 #        batch_y.append(y_pad)
 #    return torch.stack(batch_x), torch.stack(batch_y)
 
+def make_loader(dataset):
+    if dataset.patches_per_case > 1:
+        # the buffer splits the cases between the workers itself
+        return DataLoader(PatchShuffleBuffer(dataset, args.shuffle_buffer),
+                batch_size=args.batch_size, num_workers=args.num_workers,
+                collate_fn=pad_collate if dataset.sampler.crop_type == 'brain' else collate_fn,
+                persistent_workers=bool(args.cache_mb) and args.num_workers > 0)
+    kwargs = {'batch_size': args.batch_size, 'shuffle': True, 'collate_fn': collate_fn}
+    if dataset.sampler.crop_type == 'brain':
+        # brain crops vary in size, batch similar sizes together and pad
+        # them to the largest in the batch
+        kwargs = {'collate_fn': pad_collate,
+                'batch_sampler': BucketBatchSampler(dataset.window_shapes(), args.batch_size)}
+    elif args.cache_mb:
+        # each case always goes to the same worker
+        del kwargs['shuffle']
+        kwargs['sampler'] = AffinitySampler(len(dataset), args.batch_size, args.num_workers)
+    if args.loader == 'threads':
+        return ThreadDataLoader(dataset, num_workers=args.num_workers, **kwargs)
+    # with cache_mb the workers and their caches live across epochs
+    return DataLoader(dataset, num_workers=args.num_workers,
+            persistent_workers=bool(args.cache_mb) and args.num_workers > 0, **kwargs)
 
 if args.cross_val:
-    filenames=[]
-    for (dirpath, dirnames, files) in os.walk(args.data_dir):
-        filenames += [os.path.join(dirpath, file) for file in files if '.nii.gz' in file ]
-
-        modes = [sorted([ f for f in filenames if "t1.nii.gz" in f ]),
-                      sorted([ f for f in filenames if "t1ce.nii.gz" in f ]),
-                      sorted([ f for f in filenames if "t2.nii.gz" in f ]),
-                      sorted([ f for f in filenames if "flair.nii.gz" in f ]),
-                      sorted([ f for f in filenames if "seg.nii.gz" in f ])
-            ]
-    joined_files = list(zip(*modes))
+    joined_files = load_manifest(args.data_dir).cases(seg=True)
 
     random.shuffle(joined_files)
     split_idx = int(0.8*len(joined_files))
@@ -285,67 +400,96 @@ if args.cross_val:
             segs.append(seg)
         return modes, segs
     train_modes, train_segs = proc_split(train_split)
-    train_data = BraTSTrainDataset(args.data_dir, dims=dims, augment_data=args.augment_data,
-            enhance_feat=args.enhance_feat, modes=train_modes, segs=train_segs, )
-    trainloader = DataLoader(train_data, batch_size=args.batch_size, 
-                            shuffle=True, num_workers=args.num_workers)
+    train_data = BraTSTrainDataset(args.data_dir, dims=dims, augment_data=dataset_augment,
+            enhance_feat=args.enhance_feat, modes=train_modes, segs=train_segs, 
+            cache_dir=args.cache_dir, transport_dtype=args.transport_dtype,
+            decode_threads=args.decode_threads, shm_store=args.shm_store,
+            cache_mb=args.cache_mb, seed=args.seed, crop_type=args.crop_type,
+            fg_fraction=args.fg_fraction, class_weights=class_weights,
+            patches_per_case=args.patches_per_case)
+    trainloader = make_loader(train_data)
 
     val_modes, val_segs = proc_split(val_split)
     val_data = BraTSTrainDataset(args.data_dir, dims=dims, augment_data=False,
-            modes=val_modes, segs=val_segs)
-    valloader = DataLoader(val_data, batch_size=args.batch_size, 
-                            shuffle=True, num_workers=args.num_workers)
+            modes=val_modes, segs=val_segs, cache_dir=args.cache_dir, transport_dtype=args.transport_dtype,
+            decode_threads=args.decode_threads, shm_store=args.shm_store,
+            cache_mb=args.cache_mb, seed=args.seed)
+    valloader = make_loader(val_data)
 elif args.selftrain:
-    train_data = BraTSSelfTrainDataset(args.data_dir, model, device, n=args.selftrain_n, dims=dims,   
-            augment_data=args.augment_data)
-    trainloader = DataLoader(train_data, batch_size=args.batch_size,  
-                            shuffle=True, num_workers=args.num_workers)
-    val_data = BraTSTrainDataset(args.data_dir, dims=dims, enhance_feat=False, augment_data=False)
-    valloader = DataLoader(val_data, batch_size=args.batch_size, 
-                            shuffle=True, num_workers=args.num_workers)
+    train_data = BraTSSelfTrainDataset(args.data_dir, device, n=args.selftrain_n, dims=dims,   
+            augment_data=dataset_augment, cache_dir=args.cache_dir, transport_dtype=args.transport_dtype,
+            decode_threads=args.decode_threads, shm_store=args.shm_store,
+            cache_mb=args.cache_mb, seed=args.seed, patches_per_case=args.patches_per_case,
+            crop_type=args.crop_type, run_id=pseudo_labels.run_id(args.dir), labels_root=args.pseudo_label_dir,
+            teacher_batch_size=args.selftrain_batch_size)
+    # the first labels are needed before training starts, unless a resumed
+    # run left labels of the same cases. later ones are made in the
+    # background while training goes on.
+    if train_data.labels.cases() != pseudo_labels.cases(train_data.unsupervised_data):
+        train_data.annotate(model, wait=True)
+    trainloader = make_loader(train_data)
+    val_data = BraTSTrainDataset(args.data_dir, dims=dims, enhance_feat=False, augment_data=False,
+            cache_dir=args.cache_dir, transport_dtype=args.transport_dtype,
+            decode_threads=args.decode_threads, shm_store=args.shm_store,
+            cache_mb=args.cache_mb, seed=args.seed)
+    valloader = make_loader(val_data)
 else:
     # train without cross_val or self-training
     train_data = BraTSTrainDataset(args.data_dir, dims=dims, 
-            augment_data=args.augment_data, enhance_feat=args.enhance_feat, throw_no_et_sets=args.throw_no_et_sets)
-    trainloader = DataLoader(train_data, batch_size=args.batch_size, collate_fn=collate_fn,
-                            shuffle=True, num_workers=args.num_workers)
-    val_data = BraTSTrainDataset(args.data_dir, dims=dims, enhance_feat=args.enhance_feat, augment_data=False)
-    valloader = DataLoader(val_data, batch_size=args.batch_size, collate_fn=collate_fn,
-                            shuffle=True, num_workers=args.num_workers)
+            augment_data=dataset_augment, enhance_feat=args.enhance_feat, throw_no_et_sets=args.throw_no_et_sets,
+            cache_dir=args.cache_dir, transport_dtype=args.transport_dtype,
+            decode_threads=args.decode_threads, shm_store=args.shm_store,
+            cache_mb=args.cache_mb, seed=args.seed,
+            filters=[min_region_volume('wt', args.min_wt_volume)] if args.min_wt_volume else None,
+            crop_type=args.crop_type, fg_fraction=args.fg_fraction, class_weights=class_weights,
+            patches_per_case=args.patches_per_case)
+    trainloader = make_loader(train_data)
+    val_data = BraTSTrainDataset(args.data_dir, dims=dims, enhance_feat=args.enhance_feat, augment_data=False,
+            cache_dir=args.cache_dir, transport_dtype=args.transport_dtype,
+            decode_threads=args.decode_threads, shm_store=args.shm_store,
+            cache_mb=args.cache_mb, seed=args.seed)
+    valloader = make_loader(val_data)
 
 writer = SummaryWriter(log_dir=f'{args.dir}/logs')
 scheduler = None
 
+# SWA counts optimizer steps, it averages once an epoch from epoch args.swa
+steps_per_epoch = -(-len(trainloader) // args.accumulate)
 opt = None
 if args.swa and args.clr:
     scheduler = optim.lr_scheduler.CyclicLR(optimizer, 2e-4, 2e-8, cycle_momentum=False)
-    opt = SWA(scheduler)
+    # the cyclic schedule sets the learning rate, swa_lr would override it
+    opt = SWA(optimizer, swa_start=args.swa * steps_per_epoch, swa_freq=steps_per_epoch)
 elif args.swa:
     swa_lr = ((1 - (args.swa / args.epochs)) ** 0.9) * args.lr
     optimizer = torch.optim.SGD(model.parameters(), lr=args.lr)
-    opt = SWA(optimizer, swa_start=args.swa, swa_freq=1, swa_lr=swa_lr)
+    opt = SWA(optimizer, swa_start=args.swa * steps_per_epoch, swa_freq=steps_per_epoch,
+            swa_lr=swa_lr)
 elif args.clr or args.eclr:
     scheduler = optim.lr_scheduler.CyclicLR(optimizer, 2e-4, 2e-7, cycle_momentum=False)
     #scheduler = optim.lr_scheduler.CyclicLR(optimizer, 2e-3, 2e-8, cycle_momentum=False)
 else:
-    # this must occur before giving the optimizer to amp
     lmbda = lambda epoch : (1 - (epoch / args.epochs)) ** 0.9
     scheduler = optim.lr_scheduler.MultiplicativeLR(optimizer, lr_lambda=lmbda)
 
-# model has to be on device before passing to amp
-if args.mixed_precision:
-    # Allow Amp to perform casts as required by the opt_level
-    model, optimizer = amp.initialize(model, optimizer, opt_level="O1")
+# one scaler for the run so the loss scale carries over between epochs
+scaler = grad_scaler(device, args.mixed_precision)
+micro_batcher = None
+if args.micro_batch_size or args.memory_budget:
+    micro_batcher = MicroBatcher(device, args.memory_budget, args.micro_batch_size)
 
 columns = ['set', 'ep', 'lr', 'loss', 'dice_et', 'dice_wt','dice_tc', \
    'time', 'mem_usage']
 
 for epoch in range(start_epoch, args.epochs):
     time_ep = time.time()
+    # samples are drawn from (seed, epoch, index), see BraTSTrainDataset
+    train_data.set_epoch(epoch)
 
     if args.seedtest:
         model.eval()
-        eval_val = validate(model, loss, valloader, device, cascade_train=args.cascade_train, debug=args.debug)
+        eval_val = validate(model, loss, valloader, device, cascade_train=args.cascade_train, debug=args.debug,
+                mixed_precision=args.mixed_precision)
         time_ep = time.time() - time_ep
         memory_usage = torch.cuda.memory_allocated() / (1024.0 ** 3)
 
@@ -365,9 +509,15 @@ for epoch in range(start_epoch, args.epochs):
                 opt, 
                 trainloader, 
                 device, 
-                cascade_train=arg.cascade_train,
+                cascade_train=args.cascade_train,
                 mixed_precision=args.mixed_precision,
-                debug=args.debug)
+                debug=args.debug,
+                clr=args.clr,
+                scheduler=scheduler,
+                augmenter=augmenter,
+                scaler=scaler,
+                accumulate=args.accumulate,
+                micro_batcher=micro_batcher)
     else:
          train(model, 
                 loss, 
@@ -378,8 +528,23 @@ for epoch in range(start_epoch, args.epochs):
                 mixed_precision=args.mixed_precision,
                 debug=args.debug,
                 clr=args.clr,
-                scheduler=scheduler)
+                scheduler=scheduler,
+                augmenter=augmenter,
+                scaler=scaler,
+                accumulate=args.accumulate,
+                micro_batcher=micro_batcher)
        
+    if isinstance(trainloader.batch_sampler, BucketBatchSampler):
+        efficiency = trainloader.batch_sampler.padding_efficiency
+        print(f'padding efficiency: {efficiency:.3f}')
+        writer.add_scalar(f'{args.dir}/logs/padding_efficiency', efficiency, epoch)
+
+    if args.cache_mb:
+        stats = train_data.cache_stats()
+        print(f"cache hits: {stats['hits']}\tmisses: {stats['misses']}\thit rate: {stats['hit_rate']:.3f}")
+        writer.add_scalar(f'{args.dir}/logs/cache/hit_rate', stats['hit_rate'], epoch)
+        train_data.memory.reset_stats()
+
     if args.swa and epoch > args.swa:
         opt.swap_swa_sgd()
 
@@ -400,7 +565,8 @@ for epoch in range(start_epoch, args.epochs):
         model.eval()
         if args.cross_val:
             train_val = validate(model, loss, trainloader, 
-                    device, cascade_train=args.cascade_train, debug=args.debug)
+                    device, cascade_train=args.cascade_train, debug=args.debug,
+                    mixed_precision=args.mixed_precision)
 
             writer.add_scalar(f'{args.dir}/logs/loss/train', train_val['loss'], epoch)
             et, wt, tc = train_val['dice']
@@ -419,7 +585,8 @@ for epoch in range(start_epoch, args.epochs):
                     columns, tablefmt="simple", floatfmt="8.4f")
 
         eval_val = validate(model, loss, valloader, 
-                device, cascade_train=args.cascade_train, debug=args.debug)
+                device, cascade_train=args.cascade_train, debug=args.debug,
+                mixed_precision=args.mixed_precision)
 
         writer.add_scalar(f'{args.dir}/logs/loss/eval', eval_val['loss'], epoch)
         et, wt, tc = eval_val['dice']
@@ -441,8 +608,9 @@ for epoch in range(start_epoch, args.epochs):
         print(table)
    
     writer.flush()
-    if not args.swa or not args.clr:
+    if scheduler is not None and (not args.swa or not args.clr):
         scheduler.step()
     if args.selftrain:
-        trainloader.dataset.annotate()
+        # swapped in by the workers when it's done
+        train_data.annotate(model)
 
@@ -8,7 +8,8 @@ import nibabel as nib
 
 from configparser import ConfigParser
 from torch.utils.data import DataLoader
-from data_loader import BraTSTrainDataset
+from data_loader import BraTSTrainDataset, to_device
+from manifest import load_manifest
 from losses import (
     dice_score,
     DiceBCELoss,
@@ -20,15 +21,13 @@ from models import (
         models,
         cascade_net
         )
-#from apex import amp
-from apex_dummy import amp
 
 debug=False
 # Uncomment next line to have training and evaluating only do one iteration
 #debug=True
 
 # currently unused. see note on validate_bg
-def train_epoch(model, loss, optimizer, tr_gen, batches_per_epoch, device):
+def train_epoch(model, loss, optimizer, tr_gen, batches_per_epoch, device, augmenter=None):
     model.train()
      
     for i, batch in enumerate(tr_gen):
@@ -36,7 +35,10 @@ def train_epoch(model, loss, optimizer, tr_gen, batches_per_epoch, device):
             break
         optimizer.zero_grad()
         src, target = torch.tensor(batch['data']).to(device, dtype=torch.float),\
-            process_segs(batch['seg']).to(device, dtype=torch.float)
+            _label_map(batch['seg'], device)
+        if augmenter is not None:
+            src, target = augmenter(src, target)
+        target = expand_labels(target, clinical_segs=False)
         output, _ = model(src)
 
         cur_loss = loss(output, {'target':target, 'src':src})
@@ -60,7 +62,7 @@ def validate_bg(model, loss, val_gen, batches_per_epoch, device):
             if i > batches_per_epoch:
                 break
             src, target = torch.tensor(batch['data']).to(device, dtype=torch.float),\
-                process_segs(batch['seg']).to(device, dtype=torch.float)
+                process_segs(batch['seg'], device)
             total_examples += src.size()[0]
             output, _ = model(src)
             total_loss += loss(output, {'target':target, 'src':src}) 
@@ -81,19 +83,7 @@ def cross_val(data_dir, split=0.8):
     # thresh_sweep.py and roc.py despite using the same seed in the
     # main file. putting this here caused the splits to match.
     random.seed(1234)
-    filenames=[]
-    for (dirpath, dirnames, files) in os.walk(data_dir):
-        filenames += [os.path.join(dirpath, file) 
-                for file in files if '.nii.gz' in file ]
-
-        modes = [sorted([ f for f in filenames if "t1.nii.gz" in f ]),
-                      sorted([ f for f in filenames if "t1ce.nii.gz" in f ]),
-                      sorted([ f for f in filenames if "t2.nii.gz" in f ]),
-                      sorted([ f for f in filenames if "flair.nii.gz" in f ]),
-                      sorted([ f for f in filenames if "seg.nii.gz" in f ])
-
-            ]
-    joined_files = list(zip(*modes))
+    joined_files = load_manifest(data_dir).cases(seg=True)
 
     random.shuffle(joined_files)
 
@@ -177,55 +167,142 @@ def load_data(dataset):
   cv_trainloader, cv_testloader = cross_validation(dataset)
   return cv_trainloader[0], cv_testloader[0]
 
+# Lookup tables from label value (row) to binary target channels (columns).
+# BraTS labels enhancing tumor 4 but preprocessing.py moves it to 3, so
+# rows 3 and 4 are the same and either labelling expands correctly.
+CLINICAL_REGIONS = [
+    # et  wt  tc
+    [0, 0, 0],
+    [0, 1, 1],
+    [0, 1, 0],
+    [1, 1, 1],
+    [1, 1, 1],
+    ]
+
+LABEL_REGIONS = [
+    # ncr/net  ed  et
+    [0, 0, 0],
+    [1, 0, 0],
+    [0, 1, 0],
+    [0, 0, 1],
+    [0, 0, 1],
+    ]
+
+
+def expand_labels(seg, clinical_segs=True, dtype=torch.float):
+    ''' Expands a batch of label maps (B x H x W x D) into a batch of binary
+    targets (B x 3 x H x W x D). Every channel is produced by one table
+    lookup so the label map can be moved to the device as uint8 and
+    expanded there.
+    '''
+    table = CLINICAL_REGIONS if clinical_segs else LABEL_REGIONS
+    table = torch.tensor(table, dtype=dtype, device=seg.device)
+    return table[seg.long()].permute(0, 4, 1, 2, 3)
+
+
+def _label_map(seg, device=None):
+    # batchgenerators gives B x 1 x H x W x D float arrays
+    seg = torch.from_numpy(np.asarray(seg)[:, 0].astype(np.uint8))
+    if device is not None:
+        seg = seg.to(device)
+    return seg
+
+
 # another function for use with batchgenerators
-def process_segs_clinical(seg):
-    # iterate over each example in the batch
-    segs = []
-    seg = np.squeeze(seg)
-    patch_size = seg.shape[1], seg.shape[2], seg.shape[3]
-    for b in range(seg.shape[0]):
-        seg_t = []
-        seg_et = np.zeros(patch_size)
-        seg_et[np.where(seg[b, :, :, :] == 4)] = 1
-        seg_t.append(seg_et)
-
-        seg_wt = np.zeros(patch_size)
-        seg_wt[np.where(seg[b, :, :, :] > 0)] = 1
-        seg_t.append(seg_wt)
-
-        # possibly errorneous
-        seg_et = np.zeros(patch_size)
-        seg_et[np.where(seg[b, :, :, :] == 3)] = 1
-        seg_t.append(seg_et)
-        segs.append(seg_t)
-    return torch.from_numpy(np.array(segs))
+def process_segs_clinical(seg, device=None):
+    return expand_labels(_label_map(seg, device), clinical_segs=True)
+
 
 # another function for use with batchgenerators
-def process_segs(seg):
-    # iterate over each example in the batch
-    segs = []
-    seg = np.squeeze(seg)
-    patch_size = seg.shape[1], seg.shape[2], seg.shape[3]
-    for b in range(seg.shape[0]):
-        seg_t = []
-        seg_ncr_net = np.zeros(patch_size)
-        seg_ncr_net[np.where(seg[b, :, :, :] == 1)] = 1
-        seg_t.append(seg_ncr_net)
-
-        seg_ed = np.zeros(patch_size)
-        seg_ed[np.where(seg[b, :, :, :] == 2)] = 1
-        seg_t.append(seg_ed)
-
-        seg_et = np.zeros(patch_size)
-        seg_et[np.where(seg[b, :, :, :] == 3)] = 1
-        seg_t.append(seg_et)
-        segs.append(seg_t)
-
-    return torch.from_numpy(np.array(segs))
+def process_segs(seg, device=None):
+    return expand_labels(_label_map(seg, device), clinical_segs=False)
+
+def autocast(device, enabled=True):
+    ''' Mixed precision for device: float16 on CUDA, bfloat16 on CPU. '''
+    device_type = torch.device(device).type
+    dtype = torch.float16 if device_type == 'cuda' else torch.bfloat16
+    return torch.autocast(device_type, dtype=dtype, enabled=enabled)
+
+
+def grad_scaler(device, enabled=True):
+    ''' Loss scaling for float16 autocast. bfloat16 has the range of float32
+    and isn't scaled, the scaler passes everything through on CPU.
+    '''
+    enabled = enabled and torch.device(device).type == 'cuda'
+    return torch.amp.GradScaler(torch.device(device).type, enabled=enabled)
+
+
+class MicroBatcher(object):
+    ''' Splits batches into micro-batches of at most micro_batch_size
+    samples or, with a budget in GB, of as many samples as fit in it next
+    to what's already allocated. The memory a sample takes is measured on
+    the first micro-batch, which is a single sample. Budgets are only
+    measured on CUDA.
+    '''
+    # allocator fragmentation and the estimate's error
+    headroom = 0.9
+
+    def __init__(self, device, budget=None, micro_batch_size=None):
+        self.device = torch.device(device)
+        self.budget = None if budget is None else budget * 1024**3
+        self.micro_batch_size = micro_batch_size
+        self.per_sample = None
+        self._base = None
+
+    def _measured(self):
+        return self.budget is not None and self.device.type == 'cuda'
+
+    def size(self, n):
+        ''' The micro-batch size to split a batch of n samples into. '''
+        size = n
+        if self.micro_batch_size is not None:
+            size = min(size, self.micro_batch_size)
+        if self._measured():
+            if self.per_sample is None:
+                return 1
+            available = self.headroom * self.budget - torch.cuda.memory_allocated(self.device)
+            size = min(size, int(available // self.per_sample))
+        return max(1, size)
+
+    def start(self):
+        if self._measured() and self.per_sample is None:
+            self._base = torch.cuda.memory_allocated(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    def stop(self, n):
+        if self._measured() and self.per_sample is None:
+            self.per_sample = (torch.cuda.max_memory_allocated(self.device) - self._base) / n
+            print(f'{self.per_sample / 1024**3:.2f} GB a sample, micro-batches of up to {self.size(2**16)}')
+
+
+def _optimizer_step(optimizer, scaler, accumulated, accumulate):
+    if accumulated < accumulate:
+        # a short last step of the epoch, its losses were divided by
+        # accumulate rather than by the batches it has
+        scaler.unscale_(optimizer)
+        for group in optimizer.param_groups:
+            for p in group['params']:
+                if p.grad is not None:
+                    p.grad.mul_(accumulate / accumulated)
+    scaler.step(optimizer)
+    scaler.update()
+    optimizer.zero_grad()
+
 
 # all the training and validation functions need to get out of here
 def train(model, loss, optimizer, train_dataloader, device, cascade_train=False, mixed_precision=False, 
-        debug=False, clr=False, scheduler=None):
+        debug=False, clr=False, scheduler=None, clinical_segs=True, augmenter=None, scaler=None,
+        accumulate=1, micro_batcher=None):
+    ''' Trains model for an epoch. Pass the same scaler, see grad_scaler,
+    to every epoch so the loss scale carries over.
+
+    The optimizer steps once every accumulate batches, on the mean of their
+    gradients, and the clr scheduler steps with it. Each batch runs in
+    micro-batches as micro_batcher, a MicroBatcher, splits it, their losses
+    weighted by their share of the batch.
+    '''
+    if scaler is None:
+        scaler = grad_scaler(device, mixed_precision)
     total_loss = 0
     model.train()
     if clr:
@@ -234,41 +311,64 @@ def train(model, loss, optimizer, train_dataloader, device, cascade_train=False,
         except:
             print(f'clr is {clr} but scheduler is {scheduler}. please pass valid arguments.')
 
+    optimizer.zero_grad()
+    accumulated = 0
     for src, target in tqdm(train_dataloader):
-        optimizer.zero_grad()
-        src, target = src.to(device, dtype=torch.float),\
-            target.to(device, dtype=torch.float)
+        src, target = to_device(src, device), target.to(device)
+        if augmenter is not None:
+            # augment the label map so labels are resampled before expansion
+            src, target = augmenter(src, target)
+        target = expand_labels(target, clinical_segs)
 
         if cascade_train:
             src = torch.cat((src, target[:, 1, :, :, :].unsqueeze(1)), 1)
-        preds, logits = model(src)
-        if isinstance(loss, DiceBCELoss) or isinstance(loss, BCELoss):
-            cur_loss = loss(preds, logits, {'target':target, 'src':src})
-        else:
-            cur_loss = loss(preds, {'target':target, 'src':src})
-        total_loss += cur_loss
-        #print(f'total_loss {total_loss}')
-        cur_loss.backward()
-        optimizer.step()
+        n = src.size(0)
+        size = n if micro_batcher is None else micro_batcher.size(n)
+        for micro_src, micro_target in zip(src.split(size), target.split(size)):
+            if micro_batcher is not None:
+                micro_batcher.start()
+            with autocast(device, mixed_precision):
+                preds, logits = model(micro_src)
+                if isinstance(loss, DiceBCELoss) or isinstance(loss, BCELoss):
+                    cur_loss = loss(preds, logits, {'target':micro_target, 'src':micro_src})
+                else:
+                    cur_loss = loss(preds, {'target':micro_target, 'src':micro_src})
+                cur_loss = cur_loss * (micro_src.size(0) / n)
+            # detached so the sum doesn't hold on to every step's graph
+            total_loss += cur_loss.detach()
+            #print(f'total_loss {total_loss}')
+            scaler.scale(cur_loss / accumulate).backward()
+            if micro_batcher is not None:
+                micro_batcher.stop(micro_src.size(0))
+            # free the graph's outputs before the next micro-batch
+            del preds, logits, cur_loss
+        accumulated += 1
+
+        if accumulated == accumulate:
+            _optimizer_step(optimizer, scaler, accumulated, accumulate)
+            accumulated = 0
+            if clr:
+                try:
+                    scheduler.step()
+                except:
+                    print(f'clr is {clr} but scheduler is {scheduler}. please pass valid arguments.')
+        if debug:
+          break
+
+    if accumulated:
+        _optimizer_step(optimizer, scaler, accumulated, accumulate)
         if clr:
             try:
                 scheduler.step()
             except:
                 print(f'clr is {clr} but scheduler is {scheduler}. please pass valid arguments.')
-        if debug:
-          break
-        #if mixed_precision:
-        #    with amp.scale_loss(cur_loss, optimizer) as scaled_loss:
-        #        scaled_loss.backward()
-        #else:
-        #    cur_loss.backward()
-        #    optimizer.step()
  
 def get_lr(optimizer):
     for param_group in optimizer.param_groups:
         return param_group['lr']
 
-def validate(model, loss, dataloader, device, cascade_train=False, debug=False):
+def validate(model, loss, dataloader, device, cascade_train=False, debug=False, clinical_segs=True,
+        mixed_precision=False):
     loss_total = 0
     dice_total = 0
     examples_total = 0
@@ -276,17 +376,18 @@ def validate(model, loss, dataloader, device, cascade_train=False, debug=False):
     with torch.no_grad():
         model.eval()
         for src, target in tqdm(dataloader):
+            src, target = to_device(src, device),\
+                expand_labels(target.to(device), clinical_segs)
             examples_total+=src.size()[0]
-            src, target = src.to(device, dtype=torch.float),\
-                target.to(device, dtype=torch.float)
             if cascade_train:
                 src=torch.cat((src, target[:, 1, :, :, :].unsqueeze(1)), 1)
-            preds, logits = model(src)
+            with autocast(device, mixed_precision):
+                preds, logits = model(src)
 
-            if isinstance(loss, DiceBCELoss) or isinstance(loss, BCELoss):
-                cur_loss = loss(preds, logits, {'target':target, 'src':src})
-            else:
-                cur_loss = loss(preds, {'target':target, 'src':src})
+                if isinstance(loss, DiceBCELoss) or isinstance(loss, BCELoss):
+                    cur_loss = loss(preds, logits, {'target':target, 'src':src})
+                else:
+                    cur_loss = loss(preds, {'target':target, 'src':src})
             if isinstance(model, models.MonoUNet): #or isinstance(model, models.MultiResUNet): 
                 dice_total += dice_score(preds, target)
 
@@ -0,0 +1,299 @@
+'''
+On-disk cache of decoded volumes.
+
+Gunzipping the .nii.gz files is most of the data loader's CPU time and
+it used to be paid for every case on every epoch. The first time a file is
+read it is decoded, cropped to its nonzero bounding box and written to the
+cache directory as a .npy file. Every later read memory-maps that file. An
+entry is keyed by the source path, mtime and size, so touching or replacing
+a source file invalidates its entry.
+
+To prebuild the cache for a whole data directory:
+
+    python volume_cache.py --data_dir /dev/shm/MICCAI_BraTS2020_TrainingData \
+            --cache_dir /dev/shm/brats2020-cache
+'''
+import os
+import json
+import hashlib
+import argparse
+import threading
+from collections import OrderedDict
+from multiprocessing import Pool, Value
+
+import numpy as np
+import nibabel as nib
+
+
+def nonzero_bbox(arrays):
+    ''' Returns the bounding box of the nonzero voxels of all arrays as a
+    3x2 integer array of inclusive (min, max) indices per axis, or None if
+    every voxel is zero. Uses axis projections so no coordinate lists are
+    materialized.
+    '''
+    proj = None
+    for a in arrays:
+        xy = np.any(a, axis=2)
+        p = [xy.any(1), xy.any(0), np.any(a, axis=(0, 1))]
+        proj = p if proj is None else [i | j for i, j in zip(proj, p)]
+
+    if proj is None or not proj[0].any():
+        return None
+
+    bbox = np.zeros((3, 2), dtype=np.int64)
+    for axis, p in enumerate(proj):
+        idx = np.flatnonzero(p)
+        bbox[axis] = idx[0], idx[-1]
+    return bbox
+
+
+def nonzero_mask(arrays, out=None):
+    ''' Returns the boolean mask of voxels which are nonzero in any of
+    arrays, written into out if given. No intermediate masks are kept.
+    '''
+    arrays = iter(arrays)
+    out = np.not_equal(next(arrays), 0, out=out)
+    for a in arrays:
+        out |= a != 0
+    return out
+
+
+def brain_moments(d, chunk=16):
+    ''' Mean and standard deviation of the nonzero voxels of d in a single
+    pass. The background is zero so it adds nothing to the sums and no
+    masked copy of the brain is needed. The sums are accumulated in float64
+    over chunks of slices to keep float32 input accurate.
+    '''
+    n = 0
+    total = 0.
+    total_sq = 0.
+    for i in range(0, d.shape[0], chunk):
+        c = d[i:i + chunk].astype(np.float64)
+        n += np.count_nonzero(c)
+        total += c.sum()
+        total_sq += np.einsum('ijk,ijk->', c, c)
+    if n == 0:
+        return 0., 0.
+    mean = total / n
+    return mean, np.sqrt(max(total_sq / n - mean**2, 0.))
+
+
+class CroppedVolume(object):
+    ''' A volume which is zero outside of the stored region.
+
+    data is the stored region, offset is the index of its first voxel in
+    the full volume and shape is the shape of the full volume.
+    '''
+    def __init__(self, data, offset, shape):
+        self.data = data
+        self.offset = tuple(int(o) for o in offset)
+        self.shape = tuple(int(s) for s in shape)
+
+    @classmethod
+    def from_array(cls, data):
+        return cls(data, (0,) * data.ndim, data.shape)
+
+    def bbox(self):
+        ''' Inclusive (min, max) indices of the stored region per axis. For
+        volumes from the cache this is the nonzero bounding box.
+        '''
+        return np.stack([self.offset,
+            np.add(self.offset, self.data.shape) - 1], axis=1)
+
+    def cropped(self):
+        ''' Returns the volume with its stored region cropped to its nonzero
+        voxels. The data is copied.
+        '''
+        bbox = nonzero_bbox([self.data])
+        if bbox is None:
+            bbox = np.zeros((self.data.ndim, 2), dtype=np.int64)
+        data = np.array(self.data[tuple(slice(a, b + 1) for a, b in bbox)])
+        return CroppedVolume(data, np.add(self.offset, bbox[:, 0]), self.shape)
+
+    def read(self, start, stop, dtype=None, out=None):
+        ''' Returns a new array holding the window [start, stop) of the full
+        volume. The window may extend past the edges of the full volume,
+        anything not in the stored region is zero. Only the stored voxels
+        which fall in the window are read so this is cheap on a memmap.
+        If out is given the window is written into it instead.
+        '''
+        if out is None:
+            dtype = self.data.dtype if dtype is None else dtype
+            out = np.zeros([b - a for a, b in zip(start, stop)], dtype=dtype)
+        else:
+            out[...] = 0
+        src, dst = [], []
+        for a, b, o, n in zip(start, stop, self.offset, self.data.shape):
+            lo, hi = max(a, o), min(b, o + n)
+            if hi <= lo:
+                return out
+            src.append(slice(lo - o, hi - o))
+            dst.append(slice(lo - a, hi - a))
+        out[tuple(dst)] = self.data[tuple(src)]
+        return out
+
+
+class LRUVolumeCache(object):
+    ''' In-memory cache of decoded volumes holding at most max_bytes, the
+    least recently used are evicted first. Every process has its own
+    entries but the hit and miss counters are shared, so create it before
+    the DataLoader workers are started. It can be used from several
+    threads.
+    '''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.entries = OrderedDict()
+        self.hits = Value('l', 0)
+        self.misses = Value('l', 0)
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            volume = self.entries.get(key)
+            if volume is not None:
+                self.entries.move_to_end(key)
+        counter = self.misses if volume is None else self.hits
+        with counter.get_lock():
+            counter.value += 1
+        return volume
+
+    def put(self, key, volume):
+        ''' Caches volume, cropped to its nonzero voxels if it's a whole
+        decoded array, and returns what was cached.
+        '''
+        if isinstance(volume.data, np.ndarray) and not isinstance(volume.data, np.memmap) \
+                and volume.data.shape == volume.shape:
+            volume = volume.cropped()
+        size = volume.data.nbytes
+        if size > self.max_bytes:
+            return volume
+        with self._lock:
+            if key in self.entries:
+                # another thread decoded it too
+                return self.entries[key]
+            while self.nbytes + size > self.max_bytes:
+                _, old = self.entries.popitem(last=False)
+                self.nbytes -= old.data.nbytes
+            self.entries[key] = volume
+            self.nbytes += size
+        return volume
+
+    def stats(self):
+        hits, misses = self.hits.value, self.misses.value
+        return {'hits': hits, 'misses': misses,
+                'hit_rate': hits / max(hits + misses, 1)}
+
+    def reset_stats(self):
+        for counter in [self.hits, self.misses]:
+            with counter.get_lock():
+                counter.value = 0
+
+
+def decode(path, seg=False):
+    ''' Decodes a nifti file. Images are kept as float32, which is exact
+    for the int16 intensities BraTS is distributed with, and segmentations
+    as uint8.
+    '''
+    img = nib.load(path)
+    if seg:
+        # annotated segmentations are sometimes saved as floats and
+        # the 4s come back as 3.99999...
+        return np.rint(img.get_fdata(dtype=np.float32)).astype(np.uint8)
+    return img.get_fdata(dtype=np.float32)
+
+
+def source_key(path):
+    ''' Identifies the current version of a file by its path, mtime and size. '''
+    st = os.stat(path)
+    ident = f'{os.path.abspath(path)}:{st.st_mtime_ns}:{st.st_size}'
+    return hashlib.sha1(ident.encode()).hexdigest()
+
+
+class VolumeCache(object):
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, path):
+        return source_key(path)
+
+    def _paths(self, path):
+        base = os.path.join(self.cache_dir, self.key(path))
+        return base + '.npy', base + '.json'
+
+    def load(self, path, seg=False):
+        ''' Returns the CroppedVolume for path, decoding and caching it on
+        a miss.
+        '''
+        npy_path, meta_path = self._paths(path)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            data = np.load(npy_path, mmap_mode='r')
+        except (OSError, ValueError):
+            return self._store(path, seg, npy_path, meta_path)
+        return CroppedVolume(data, meta['offset'], meta['shape'])
+
+    def _store(self, path, seg, npy_path, meta_path):
+        data = decode(path, seg=seg)
+        bbox = nonzero_bbox([data])
+        if bbox is None:
+            # keep a single voxel so empty volumes don't need special casing
+            bbox = np.zeros((3, 2), dtype=np.int64)
+        cropped = np.ascontiguousarray(data[
+            bbox[0, 0]:bbox[0, 1] + 1,
+            bbox[1, 0]:bbox[1, 1] + 1,
+            bbox[2, 0]:bbox[2, 1] + 1])
+        meta = {'source': os.path.abspath(path),
+                'offset': bbox[:, 0].tolist(),
+                'shape': list(data.shape),
+                'dtype': str(cropped.dtype)}
+
+        # write to temporary files and rename them into place so concurrent
+        # workers never see a partially written entry. the metadata goes
+        # last since its presence marks the entry as complete.
+        tmp = f'.{os.getpid()}.tmp'
+        with open(npy_path + tmp, 'wb') as f:
+            np.save(f, cropped)
+        os.replace(npy_path + tmp, npy_path)
+        with open(meta_path + tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(meta_path + tmp, meta_path)
+
+        return CroppedVolume(np.load(npy_path, mmap_mode='r'), meta['offset'], meta['shape'])
+
+
+def _build(cache_dir, path):
+    VolumeCache(cache_dir).load(path, seg='seg.nii.gz' in path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Prebuild the decoded volume cache for a data directory.')
+    parser.add_argument('--data_dir', type=str, required=True, metavar='PATH',
+        help='Path to where the data is located.')
+    parser.add_argument('--cache_dir', type=str, required=True, metavar='PATH',
+        help='Path to write the cache to.')
+    parser.add_argument('--num_workers', type=int, default=8, metavar='N',
+        help='number of processes to decode with (default: 8)')
+    args = parser.parse_args()
+
+    filenames = []
+    for (dirpath, dirnames, files) in os.walk(args.data_dir):
+        filenames += [os.path.join(dirpath, file) for file in files if '.nii.gz' in file ]
+
+    os.makedirs(args.cache_dir, exist_ok=True)
+    print(f'Caching {len(filenames)} volumes in {args.cache_dir}')
+    p = Pool(processes=args.num_workers)
+    p.starmap(_build, [(args.cache_dir, f) for f in filenames])
+    p.close()
+    p.join()
@@ -16,6 +16,7 @@ from utils import (
     load_data,
     train,
     validate,
+    grad_scaler,
     )
 
 from models.cascade_net import CascadeNet
@@ -25,8 +26,6 @@ import losses
 from models.models import *
 from data_loader import BraTSTrainDataset
 
-#from apex import amp
-from apex_dummy import amp
 
 parser = argparse.ArgumentParser(description='Test for learning max and min values for cyclic learning rate.')
 # In this directory is stored the script used to start the training,
@@ -55,7 +54,8 @@ parser.add_argument('--data_par', action='store_true',
     help='data parellelism flag (default: off)')
 
 parser.add_argument('--mixed_precision', action='store_true', 
-    help='mixed precision flag (default: off)')
+    help='train and evaluate under autocast, float16 with loss scaling on CUDA and bfloat16\
+            on CPU (default: off)')
 
 parser.add_argument('--cross_val', action='store_true', 
     help='use train/val split of full dataset (default: off)')
@@ -163,10 +163,7 @@ if args.resume:
 
 writer = SummaryWriter(log_dir=f'{args.dir}/logs')
 
-# model has to be on device before passing to amp
-if args.mixed_precision:
-    # Allow Amp to perform casts as required by the opt_level
-    model, optimizer = amp.initialize(model, optimizer, opt_level="O1")
+scaler = grad_scaler(device, args.mixed_precision)
 
 # TODO: optimizer factory, allow for SGD with momentum etx.
 columns = ['set', 'ep', 'lr', 'loss', 'dice_et', 'dice_wt','dice_tc', \
@@ -182,7 +179,8 @@ for epoch in range(start_epoch, args.epochs):
             optimizer, 
             trainloader, 
             device, 
-            mixed_precision=args.mixed_precision)
+            mixed_precision=args.mixed_precision,
+            scaler=scaler)
     
     if (epoch + 1) % args.save_freq == 0:
         save_checkpoint(
@@ -195,8 +193,8 @@ for epoch in range(start_epoch, args.epochs):
     if (epoch + 1) % args.eval_freq == 0:
         # Evaluate on training data
         model.eval()
-        train_val = validate(model, loss, trainloader, device)
-        eval_val = validate(model, loss, valloader, device)
+        train_val = validate(model, loss, trainloader, device, mixed_precision=args.mixed_precision)
+        eval_val = validate(model, loss, valloader, device, mixed_precision=args.mixed_precision)
         time_ep = time.time() - time_ep
         memory_usage = torch.cuda.memory_allocated() / (1024.0 ** 3)
         train_values = ['train', epoch + 1, lr*1000, train_val['loss'].data] \